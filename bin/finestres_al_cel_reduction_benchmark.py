@@ -0,0 +1,120 @@
+"""Benchmark the reduction steps on synthetic frames"""
+import argparse
+import json
+import sys
+
+from finestres_al_cel_reduction.benchmark import (
+    BENCHMARK_STAGES, DEFAULT_DEPTHS, DEFAULT_SHAPES, compare_results, run_benchmarks,
+)
+from finestres_al_cel_reduction.combine import DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS
+from finestres_al_cel_reduction.precision import VALID_PRECISIONS, set_working_precision
+
+def parse_shape(text):
+    """Parse a frame size given as ROWSxCOLUMNS
+
+    Arguments
+    ---------
+    text: str
+    The frame size, e.g. 2048x3072.
+
+    Returns
+    -------
+    shape: tuple of int
+    The (rows, columns) of the frames.
+
+    Raises
+    ------
+    argparse.ArgumentTypeError: If the frame size is not valid.
+    """
+    try:
+        rows, cols = (int(value) for value in text.lower().split("x"))
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            f"Invalid frame size '{text}', expected ROWSxCOLUMNS.") from error
+    return rows, cols
+
+def main(cmdargs=None):
+    """Parse the arguments and run the benchmarks
+
+    Arguments
+    ---------
+    cmdargs: list of str or None - Default None
+    Command line arguments. If None, sys.argv is used.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=(
+            "Measure the time and peak memory of loading, calibrating, combining, "
+            "colour combining and saving synthetic frames, and the size of the files "
+            "saved with and without compression"))
+    parser.add_argument(
+        "--shapes", type=parse_shape, nargs="+",
+        default=DEFAULT_SHAPES, metavar="ROWSxCOLUMNS",
+        help="Frame sizes")
+    parser.add_argument(
+        "--depths", type=int, nargs="+", default=DEFAULT_DEPTHS,
+        help="Numbers of frames stacked")
+    parser.add_argument(
+        "--stages", nargs="+", default=BENCHMARK_STAGES, choices=BENCHMARK_STAGES,
+        help="Steps of the reduction benchmarked")
+    parser.add_argument(
+        "--repeats", type=int, default=3,
+        help="Number of timed runs of each step, the fastest one is reported")
+    parser.add_argument(
+        "--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET / 1024**2,
+        help="Approximate memory used while combining frames, in MB")
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS,
+        help=("Number of processes used to combine frames. The memory of the "
+              "worker processes is not included in the peak memory"))
+    parser.add_argument(
+        "--precision", default="float64", choices=VALID_PRECISIONS,
+        help="Floating point type used to load, combine and save the frames")
+    parser.add_argument(
+        "--folder", default=None,
+        help="Folder where the synthetic frames are written. Defaults to a temporary folder")
+    parser.add_argument(
+        "--output", default=None,
+        help="JSON file where the results are written. Defaults to the standard output")
+    parser.add_argument(
+        "--compare", default=None, metavar="BASELINE",
+        help="JSON file of a previous run, the ratios to its results are printed")
+    args = parser.parse_args(cmdargs)
+
+    set_working_precision(args.precision)
+
+    benchmarks = run_benchmarks(
+        shapes=args.shapes,
+        depths=args.depths,
+        stages=args.stages,
+        repeats=args.repeats,
+        folder=args.folder,
+        memory_budget=int(args.memory_budget * 1024**2),
+        workers=args.workers,
+        progress_callback=lambda done, total: print(
+            f"Benchmarked {done}/{total} configurations", file=sys.stderr))
+
+    if args.output is None:
+        json.dump(benchmarks, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(benchmarks, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        print(
+            f"{'stage':<16}{'shape':>12}{'depth':>7}{'time':>9}{'memory':>9}{'size':>9}",
+            file=sys.stderr)
+        for item in compare_results(baseline, benchmarks):
+            shape = f"{item['shape'][0]}x{item['shape'][1]}"
+            print(
+                f"{item['stage']:<16}{shape:>12}{item['depth']:>7}"
+                f"{item['time_ratio']:>9.2f}{item['memory_ratio']:>9.2f}"
+                f"{item['size_ratio']:>9.2f}",
+                file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""Run the reduction of a night without the graphical interface"""
+import argparse
+import logging
+import sys
+
+from finestres_al_cel_reduction.combine import (
+    DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS, VALID_AVERAGE_METHODS,
+)
+from finestres_al_cel_reduction.compression import (
+    VALID_COMPRESSIONS, VALID_DITHERS, OutputCompression,
+)
+from finestres_al_cel_reduction.decompression_cache import (
+    DEFAULT_SCRATCH_FOLDER, DEFAULT_SCRATCH_SIZE, DecompressionCache,
+)
+from finestres_al_cel_reduction.instrumentation import (
+    enable_instrumentation, export_records, summarize_records,
+)
+from finestres_al_cel_reduction.live_reduction import (
+    DEFAULT_POLL_INTERVAL, DEFAULT_QUEUE_SIZE, DEFAULT_SETTLE_TIME, run_live_reduction,
+)
+from finestres_al_cel_reduction.pipeline import run_pipeline
+from finestres_al_cel_reduction.precision import VALID_PRECISIONS, set_working_precision
+from finestres_al_cel_reduction.registration import (
+    DEFAULT_REGISTRATION_WORKERS, VALID_REGISTRATION_METHODS,
+)
+from finestres_al_cel_reduction.running_stack_fits_file import VALID_RUNNING_AVERAGE_METHODS
+
+def parse_compression(text):
+    """Parse a compression given as METHOD or METHOD:QUANTIZE_LEVEL
+
+    Arguments
+    ---------
+    text: str
+    The compression, e.g. rice, rice:8 or gzip:0 (lossless).
+
+    Returns
+    -------
+    method: str
+    The compression method.
+
+    quantize_level: float or None
+    The quantization level, None if it is not given.
+
+    Raises
+    ------
+    argparse.ArgumentTypeError: If the compression is not valid.
+    """
+    method, _, level = text.partition(":")
+    if method not in VALID_COMPRESSIONS:
+        raise argparse.ArgumentTypeError(
+            f"Invalid compression '{method}', expected one of {VALID_COMPRESSIONS}.")
+    if not level:
+        return method, None
+    try:
+        return method, float(level)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            f"Invalid quantization level '{level}', expected a number.") from error
+
+def main(cmdargs=None):
+    """Parse the arguments and run the pipeline
+
+    Arguments
+    ---------
+    cmdargs: list of str or None - Default None
+    Command line arguments. If None, sys.argv is used.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=(
+            "Generate master darks and flats, calibrate all light frames and "
+            "stack them by filter"))
+    parser.add_argument(
+        "raw_folder",
+        help="Folder with the light frames (and optionally the calibration frames)")
+    parser.add_argument(
+        "--calibration-folder", default=None,
+        help="Folder with the calibration frames. Defaults to raw_folder")
+    parser.add_argument(
+        "--output-folder", default=None,
+        help="Folder where the products are written. Defaults to raw_folder/reduced")
+    parser.add_argument(
+        "--average", default="median", choices=VALID_AVERAGE_METHODS,
+        help="Method used to combine the calibration frames")
+    parser.add_argument(
+        "--stack-average", default="median", choices=VALID_AVERAGE_METHODS,
+        help="Method used to combine the light frames")
+    parser.add_argument(
+        "--registration", default="none", choices=VALID_REGISTRATION_METHODS,
+        help="Transforms corrected when aligning the light frames before stacking them")
+    parser.add_argument(
+        "--registration-workers", type=int, default=DEFAULT_REGISTRATION_WORKERS,
+        help="Number of light frames registered at the same time")
+    parser.add_argument(
+        "--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET / 1024**2,
+        help="Approximate memory used while combining frames, in MB")
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS,
+        help="Number of processes used to combine frames")
+    parser.add_argument(
+        "--precision", default="float64", choices=VALID_PRECISIONS,
+        help="Floating point type used to load, combine and save the frames")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Rebuild all masters, even if their input frames have not changed")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help=("Keep watching raw_folder and calibrate and stack the new light frames "
+              "as they are written, until interrupted with Ctrl+C. The stacks are "
+              "updated incrementally, so --stack-average must be mean, median or sigma_clip, "
+              "and the frames are not aligned, so --registration cannot be used"))
+    parser.add_argument(
+        "--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between two scans of raw_folder in watch mode")
+    parser.add_argument(
+        "--settle-time", type=float, default=DEFAULT_SETTLE_TIME,
+        help="Seconds a new file must stay unchanged before it is processed in watch mode")
+    parser.add_argument(
+        "--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+        help="Maximum number of new files waiting to be processed in watch mode")
+    parser.add_argument(
+        "--compress-masters", type=parse_compression, default="none",
+        metavar="METHOD[:LEVEL]",
+        help=(f"Tile compression of the master biases, darks and flats. METHOD is one of "
+              f"{VALID_COMPRESSIONS} and LEVEL the quantization of floating point data, "
+              f"relative to the noise of each row (negative values are absolute steps, "
+              f"0 is lossless and only valid for gzip)"))
+    parser.add_argument(
+        "--compress-lights", type=parse_compression, default="none",
+        metavar="METHOD[:LEVEL]",
+        help="Tile compression of the calibrated light frames, see --compress-masters")
+    parser.add_argument(
+        "--compress-stacks", type=parse_compression, default="none",
+        metavar="METHOD[:LEVEL]",
+        help="Tile compression of the stacks, see --compress-masters")
+    parser.add_argument(
+        "--dither", default="subtractive", choices=VALID_DITHERS,
+        help="Dither applied before quantizing compressed floating point data")
+    parser.add_argument(
+        "--decompress-to", nargs="?", const=DEFAULT_SCRATCH_FOLDER, default=None,
+        metavar="SCRATCH_FOLDER",
+        help=(f"Decompress gzipped frames in parallel to SCRATCH_FOLDER (default "
+              f"{DEFAULT_SCRATCH_FOLDER}) and read them from there. The copies are "
+              f"kept for the next runs, up to --scratch-size"))
+    parser.add_argument(
+        "--scratch-size", type=float, default=DEFAULT_SCRATCH_SIZE / 1024**3,
+        help="Maximum size of the decompressed copies kept in the scratch folder, in GB")
+    parser.add_argument(
+        "--profile", default=None, metavar="FILE",
+        help=("Record the time, bytes read and written and peak memory of each stage "
+              "and write them to FILE (.json or .csv)"))
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="Report the progress of each step")
+    args = parser.parse_args(cmdargs)
+    if args.watch:
+        if args.stack_average not in VALID_RUNNING_AVERAGE_METHODS:
+            parser.error(
+                f"--stack-average must be one of {VALID_RUNNING_AVERAGE_METHODS} with --watch")
+        if (args.registration != "none" or
+                args.registration_workers != DEFAULT_REGISTRATION_WORKERS):
+            parser.error(
+                "--registration and --registration-workers cannot be used with --watch, "
+                "the live stacks are not aligned")
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(levelname)s: %(message)s")
+
+    set_working_precision(args.precision)
+
+    try:
+        compressions = [
+            OutputCompression(method, dither=args.dither) if quantize_level is None else
+            OutputCompression(method, quantize_level=quantize_level, dither=args.dither)
+            for method, quantize_level in (
+                args.compress_masters, args.compress_lights, args.compress_stacks)]
+    except ValueError as error:
+        logging.error(str(error))
+        return 1
+    args.master_compression, args.light_compression, args.stack_compression = compressions
+
+    args.decompression_cache = None
+    if args.decompress_to is not None:
+        try:
+            args.decompression_cache = DecompressionCache(
+                args.decompress_to, max_size=int(args.scratch_size * 1024**3))
+        except (OSError, ValueError) as error:
+            logging.error(str(error))
+            return 1
+
+    if args.profile is not None:
+        if not args.profile.lower().endswith((".json", ".csv")):
+            logging.error("The profile file must end in .json or .csv")
+            return 1
+        enable_instrumentation()
+
+    try:
+        return run(args)
+    finally:
+        if args.profile is not None:
+            export_records(args.profile)
+            for summary in summarize_records():
+                logging.info(
+                    "%s: %d calls, %.3f s", summary["stage"], summary["calls"], summary["seconds"])
+
+def run(args):
+    """Run the pipeline, or watch the raw folder
+
+    Arguments
+    ---------
+    args: argparse.Namespace
+    The parsed command line arguments.
+
+    Returns
+    -------
+    status: int
+    The exit status.
+    """
+    if args.watch:
+        try:
+            run_live_reduction(
+                args.raw_folder,
+                calibration_folder=args.calibration_folder,
+                output_folder=args.output_folder,
+                average=args.average,
+                stack_average=args.stack_average,
+                memory_budget=int(args.memory_budget * 1024**2),
+                workers=args.workers,
+                use_cache=not args.no_cache,
+                poll_interval=args.poll_interval,
+                settle_time=args.settle_time,
+                queue_size=args.queue_size,
+                master_compression=args.master_compression,
+                light_compression=args.light_compression,
+                stack_compression=args.stack_compression,
+                decompression_cache=args.decompression_cache)
+        except ValueError as error:
+            logging.error(str(error))
+            return 1
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        return 0
+
+    try:
+        master_darks, master_flats, stacks = run_pipeline(
+            args.raw_folder,
+            calibration_folder=args.calibration_folder,
+            output_folder=args.output_folder,
+            average=args.average,
+            stack_average=args.stack_average,
+            memory_budget=int(args.memory_budget * 1024**2),
+            workers=args.workers,
+            use_cache=not args.no_cache,
+            registration=args.registration,
+            registration_workers=args.registration_workers,
+            master_compression=args.master_compression,
+            light_compression=args.light_compression,
+            stack_compression=args.stack_compression,
+            decompression_cache=args.decompression_cache)
+    except ValueError as error:
+        logging.error(str(error))
+        return 1
+
+    print(
+        f"Reduction finished: {len(master_darks)} master darks, "
+        f"{len(master_flats)} master flats, {len(stacks)} stacks")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
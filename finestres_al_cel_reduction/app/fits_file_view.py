@@ -1,10 +1,19 @@
 """FITS file viewer"""
 import numpy as np
 
+from PyQt6.QtCore import QRectF, QThreadPool, pyqtSlot
 from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import QWidget, QVBoxLayout, QLabel
 import pyqtgraph as pg
 
+from finestres_al_cel_reduction.app.error_dialog import ErrorDialog
+from finestres_al_cel_reduction.app.worker import Worker
+from finestres_al_cel_reduction.instrumentation import instrumented
+
+# Fraction of the visible range rendered on each side of it, so that small
+# pans do not need a new tile
+RENDER_MARGIN = 0.25
+
 class FitsFileView(QWidget):
     """Widget for displaying FITS file information"""
 
@@ -18,6 +27,11 @@ class FitsFileView(QWidget):
         """
         # initialize plotting
         super().__init__()
+
+        # the plot is out of date, it is refreshed when the view is visible
+        self.dirty = False
+        self.refreshWorker = None
+
         self.show()
 
         self.fits_file = fits_file
@@ -25,9 +39,16 @@ class FitsFileView(QWidget):
         # Create plot widget
         self.plotWidget = pg.PlotWidget()
         self.imageItem = None
+        self.tileItem = None
         self.colorBar = None
         self.colorBarValues = None
 
+        # the whole image is shown at the coarsest level of the pyramid, and
+        # the visible region is overlaid at the level matching the zoom
+        self.pyramid = None
+        self.renderedLevel = None
+        self.renderedBounds = None
+
         # Create label for pixel value
         self.pixelValueLabel = QLabel("Pixel value: ")
         #self.pixelValueLabel.setStyleSheet("background: #222; color: #fff; padding: 2px;")
@@ -44,6 +65,67 @@ class FitsFileView(QWidget):
         # Connect mouse move event
         self.plotWidget.scene().sigMouseMoved.connect(self.onMouseMoved)
 
+        # Render the visible region again when zooming or panning
+        self.plotWidget.getViewBox().sigRangeChanged.connect(self.renderVisibleRegion)
+
+    @pyqtSlot(object)
+    def applyRender(self, render):
+        """Show the result of prepareRender, updating the plot items in place
+
+        Arguments
+        ---------
+        render: tuple
+        The pyramid, the image at its coarsest level with its bounds, and the
+        colorbar range, as returned by prepareRender.
+        """
+        pyramid, image, bounds, (vmin, vmax) = render
+        self.pyramid = pyramid
+        rect = QRectF(bounds[0], bounds[2], bounds[1] - bounds[0], bounds[3] - bounds[2])
+
+        if self.imageItem is None:
+            # plot the whole image at the coarsest level of the pyramid
+            self.imageItem = pg.ImageItem(image)
+            self.imageItem.setRect(rect)
+            self.plotWidget.addItem(self.imageItem)
+
+            # finer tile of the visible region, it does not change the auto range
+            self.tileItem = pg.ImageItem()
+            self.tileItem.hide()
+            self.plotWidget.addItem(self.tileItem, ignoreBounds=True)
+
+            colorMap = pg.colormap.get("CET-L2")  # choose perceptually uniform, diverging color map
+
+            # generate an adjustabled color bar
+            self.colorBar = pg.ColorBarItem(
+                values=(vmin, vmax),
+                colorMap=colorMap)
+
+            # link color bar and color map to correlogram, and show it in plotItem:
+            self.colorBar.setImageItem(
+                [self.imageItem, self.tileItem], insert_in=self.plotWidget.getPlotItem())
+
+            # load plot settings
+            self.setPlot()
+        else:
+            self.imageItem.setImage(image, autoLevels=False)
+            self.imageItem.setRect(rect)
+            self.colorBar.setLevels(values=(vmin, vmax))
+
+        # the tile is rendered again from the new pyramid
+        self.renderedLevel = None
+        self.renderVisibleRegion()
+
+    @pyqtSlot()
+    def markDirty(self):
+        """Mark the plot as out of date
+
+        Visible views are refreshed in the background straight away, the
+        others when they are shown.
+        """
+        self.dirty = True
+        if self.isVisible():
+            self.refresh()
+
     def onMouseMoved(self, pos):
         """Handle mouse movement over the plot
         
@@ -73,20 +155,119 @@ class FitsFileView(QWidget):
             self.pixelValueLabel.setText("Pixel value: ")
 
 
-    def resetPlot(self):
-        """Reset plot"""
-        # reset labels
-        self.plotWidget.setLabel(axis='left', text='')
-        self.plotWidget.setLabel(axis='bottom', text='')
-        # Remove existing items if they exists
-        if self.colorBar is not None:
-            self.plotWidget.getPlotItem().layout.removeItem(self.colorBar)
-            self.colorBar = None
-        if self.imageItem is not None:
-            self.plotWidget.getPlotItem().removeItem(self.imageItem)
-            self.imageItem = None
-        # reset plot
-        self.plotWidget.clear()
+    @pyqtSlot()
+    def onRefreshFinished(self):
+        """Start another refresh if the plot changed while refreshing"""
+        self.refreshWorker = None
+        if self.dirty and self.isVisible():
+            self.refresh()
+
+    @instrumented("prepare_render", get_file=lambda view, *args, **kwargs: view.fits_file.title)
+    def prepareRender(self, progress_callback=None): # pylint: disable=unused-argument
+        """Compute what is needed to render the plot
+
+        This does not touch any plot item, so it can run in a background thread.
+
+        Arguments
+        ---------
+        progress_callback: function or None - Default None
+        Unused, required to run in a Worker
+
+        Returns
+        -------
+        render: tuple
+        The pyramid of the data, the image at its coarsest level, the bounds
+        of that image and the (vmin, vmax) range of the colorbar.
+
+        Raises
+        ------
+        ValueError: If the FITS file has no data
+        """
+        # the shape is taken from the header if the data is not loaded, so
+        # full-resolution data is only read to build the pyramid
+        shape = self.fits_file.shape
+        if shape is None:
+            raise ValueError("No data in FITS file.")
+
+        pyramid = self.fits_file.get_pyramid()
+        image, bounds = pyramid.get_region(pyramid.num_levels - 1, 0, shape[0], 0, shape[1])
+
+        # if color image, the luminance is used for colorbar scaling
+        if len(shape) == 3 and shape[-1] == 3:
+            vmin, vmax = self.fits_file.get_display_percentiles(5, 95)
+        else:
+            # For grayscale images, use the data directly
+            vmin, vmax = self.fits_file.get_display_percentiles(3, 97)
+        if vmin == vmax:
+            vmax = vmin + 1  # avoid zero range
+
+        return pyramid, image, bounds, (vmin, vmax)
+
+    def refresh(self):
+        """Refresh the plot in the background if it is out of date
+
+        Only one refresh runs at a time. Changes made meanwhile are picked up
+        when it finishes.
+        """
+        if not self.dirty or self.refreshWorker is not None:
+            return
+        self.dirty = False
+        self.refreshWorker = Worker(self.prepareRender)
+        self.refreshWorker.signals.result.connect(self.applyRender)
+        self.refreshWorker.signals.error.connect(
+            lambda message: ErrorDialog(
+                f"Error displaying {self.fits_file.title}: {message}").exec())
+        self.refreshWorker.signals.finished.connect(self.onRefreshFinished)
+        QThreadPool.globalInstance().start(self.refreshWorker)
+
+    def renderVisibleRegion(self):
+        """Render the visible region at the resolution matching the zoom
+
+        Full-resolution data is only read when zooming in. Nothing is done
+        if the current tile already covers the visible region at the right level.
+        """
+        if self.imageItem is None or self.pyramid is None:
+            return
+        viewBox = self.plotWidget.getViewBox()
+        pixelSize = viewBox.viewPixelSize()
+        if min(pixelSize) <= 0:
+            return
+        level = self.pyramid.select_level(min(pixelSize))
+        if level == self.pyramid.num_levels - 1:
+            # the coarsest level is already shown for the whole image
+            self.tileItem.hide()
+            self.renderedLevel = None
+            return
+
+        # the first axis of the data is shown along x
+        (xMin, xMax), (yMin, yMax) = viewBox.viewRange()
+        if (self.renderedLevel == level and
+                self.renderedBounds[0] <= max(xMin, 0) and
+                self.renderedBounds[1] >= min(xMax, self.pyramid.shape[0]) and
+                self.renderedBounds[2] <= max(yMin, 0) and
+                self.renderedBounds[3] >= min(yMax, self.pyramid.shape[1])):
+            return
+        xMargin = RENDER_MARGIN * (xMax - xMin)
+        yMargin = RENDER_MARGIN * (yMax - yMin)
+        tile, bounds = self.pyramid.get_region(
+            level,
+            int(np.floor(xMin - xMargin)), int(np.ceil(xMax + xMargin)),
+            int(np.floor(yMin - yMargin)), int(np.ceil(yMax + yMargin)))
+        if tile.shape[0] == 0 or tile.shape[1] == 0:
+            self.tileItem.hide()
+            return
+
+        self.tileItem.setImage(tile, autoLevels=False)
+        self.tileItem.setRect(QRectF(
+            bounds[0], bounds[2], bounds[1] - bounds[0], bounds[3] - bounds[2]))
+        self.tileItem.show()
+        self.renderedLevel = level
+        self.renderedBounds = bounds
+
+    def showEvent(self, event):
+        """Refresh the plot when the view is shown, if it is out of date"""
+        super().showEvent(event)
+        self.refresh()
 
     def setPlot(self):
         """Load plot settings"""
@@ -105,50 +286,8 @@ class FitsFileView(QWidget):
         leftAxis.setTickFont(font)
         bottomAxis.setTickFont(font)
 
+    @instrumented("update_plot", get_file=lambda view: view.fits_file.title)
     def updatePlot(self):
-        """Update plot"""
-        # keep colorbar values before reset
-        if self.colorBar is not None:
-            self.colorBarValues = self.colorBar.values
-
-        # reset plot
-        self.resetPlot()
-
-        # check data shape
-        self.plotWidget.clear()
-        data = self.fits_file.data
-        if data is None:
-            raise ValueError("No data in FITS file.")
-        if data.ndim > 2:
-            print(f"Data has shape {data.shape}, showing first slice.")
-            data = data[0]
-        
-        # plot image
-        self.imageItem = pg.ImageItem(self.fits_file.data)
-        self.plotWidget.addItem(self.imageItem)
-
-        colorMap = pg.colormap.get("CET-L2")  # choose perceptually uniform, diverging color map
-
-        # generate an adjustabled color bar
-        # if color image, compute luminance for colorbar scaling
-        if data.ndim == 3 and data.shape[-1] == 3:
-            # Standard luminance formula for RGB
-            luminance = 0.299 * data[..., 0] + 0.587 * data[..., 1] + 0.114 * data[..., 2]
-            vmin = np.nanpercentile(luminance, 5)
-            vmax = np.nanpercentile(luminance, 95)
-        else:
-            # For grayscale images, use the data directly
-            vmin = np.nanpercentile(self.fits_file.data, 3)
-            vmax = np.nanpercentile(self.fits_file.data, 97)
-        if vmin == vmax:
-            vmax = vmin + 1  # avoid zero range
-
-        self.colorBar = pg.ColorBarItem(
-            values=(vmin, vmax),
-            colorMap=colorMap)
-        
-        # link color bar and color map to correlogram, and show it in plotItem:
-        self.colorBar.setImageItem(self.imageItem, insert_in=self.plotWidget.getPlotItem())
-
-        # load plot settings
-        self.setPlot()
+        """Update plot, synchronously"""
+        self.dirty = False
+        self.applyRender(self.prepareRender())
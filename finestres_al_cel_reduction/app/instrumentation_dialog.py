@@ -0,0 +1,141 @@
+""" Dialog to record and inspect the time spent in each reduction stage"""
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import (
+    QCheckBox, QComboBox, QDialog, QDialogButtonBox, QFileDialog, QGridLayout,
+    QPushButton, QTableWidget, QTableWidgetItem,
+)
+
+from finestres_al_cel_reduction.app.error_dialog import ErrorDialog
+from finestres_al_cel_reduction.instrumentation import (
+    RECORD_FIELDS, SUMMARY_FIELDS,
+    clear_records, disable_instrumentation, enable_instrumentation, export_records,
+    get_records, is_instrumentation_enabled, summarize_records,
+)
+
+# Milliseconds between two refreshes of the table while recording
+REFRESH_INTERVAL = 1000
+
+# Ways of showing the records
+VIEWS = ["Summary by stage", "All records"]
+
+class InstrumentationDialog(QDialog):
+    """ Class to define the profiling panel
+
+    The panel can be left open while working, the table is refreshed
+    periodically while the stages are being recorded.
+    """
+    def __init__(self):
+        """Initialize instance"""
+        super().__init__()
+
+        self.setWindowTitle("Profiling")
+
+        # Record the instrumented stages
+        self.enableCheckBox = QCheckBox("Record stages")
+        self.enableCheckBox.setChecked(is_instrumentation_enabled())
+        self.enableCheckBox.toggled.connect(self.set_enabled)
+
+        # Measure the peak memory of the stages
+        self.traceMemoryCheckBox = QCheckBox("Measure peak memory (slower)")
+        self.traceMemoryCheckBox.setChecked(True)
+        self.traceMemoryCheckBox.toggled.connect(self.set_enabled)
+
+        # Summary or individual records
+        self.viewComboBox = QComboBox()
+        self.viewComboBox.addItems(VIEWS)
+        self.viewComboBox.currentTextChanged.connect(self.update_table)
+
+        self.table = QTableWidget()
+        self.table.setSortingEnabled(True)
+
+        # Buttons
+        self.refreshButton = QPushButton("Refresh")
+        self.refreshButton.clicked.connect(self.update_table)
+        self.clearButton = QPushButton("Clear")
+        self.clearButton.clicked.connect(self.clear)
+        self.exportButton = QPushButton("Export...")
+        self.exportButton.clicked.connect(self.export)
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.StandardButton.Close)
+        self.buttonBox.rejected.connect(self.reject)
+
+        # Refresh the table while recording
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.update_table)
+
+        # Layout
+        layout = QGridLayout()
+        layout.addWidget(self.enableCheckBox, 0, 0)
+        layout.addWidget(self.traceMemoryCheckBox, 0, 1)
+        layout.addWidget(self.viewComboBox, 0, 2)
+        layout.addWidget(self.table, 1, 0, 1, 3)
+        layout.addWidget(self.refreshButton, 2, 0)
+        layout.addWidget(self.clearButton, 2, 1)
+        layout.addWidget(self.exportButton, 2, 2)
+        layout.addWidget(self.buttonBox, 3, 0, 1, 3)
+        self.setLayout(layout)
+        self.resize(900, 500)
+
+        self.update_table()
+        if is_instrumentation_enabled():
+            self.timer.start()
+
+    def clear(self):
+        """Remove all the records"""
+        clear_records()
+        self.update_table()
+
+    def export(self):
+        """Export the records to a JSON or CSV file"""
+        filename, _ = QFileDialog.getSaveFileName(
+            self,
+            "Export Records",
+            "profile.json",
+            "JSON (*.json);;CSV (*.csv)",
+        )
+        if not filename:
+            return
+        try:
+            export_records(filename)
+        except (OSError, ValueError) as error:
+            ErrorDialog(f"Error exporting records: {str(error)}").exec()
+
+    def set_enabled(self):
+        """Start or stop recording the stages, following the check boxes"""
+        if self.enableCheckBox.isChecked():
+            enable_instrumentation(trace_memory=self.traceMemoryCheckBox.isChecked())
+            self.timer.start()
+        else:
+            disable_instrumentation()
+            self.timer.stop()
+        self.update_table()
+
+    def update_table(self):
+        """Show the records, or their summary, in the table"""
+        if self.viewComboBox.currentText() == VIEWS[0]:
+            fields = SUMMARY_FIELDS
+            rows = summarize_records()
+        else:
+            fields = RECORD_FIELDS
+            rows = get_records()
+
+        self.table.setSortingEnabled(False)
+        self.table.clear()
+        self.table.setColumnCount(len(fields))
+        self.table.setHorizontalHeaderLabels(fields)
+        self.table.setRowCount(len(rows))
+        for row_index, row in enumerate(rows):
+            for column_index, field in enumerate(fields):
+                value = row[field]
+                item = QTableWidgetItem()
+                if value is None:
+                    item.setText("")
+                elif isinstance(value, float):
+                    item.setData(0, round(value, 4))
+                elif isinstance(value, int):
+                    item.setData(0, value)
+                else:
+                    item.setText(str(value))
+                self.table.setItem(row_index, column_index, item)
+        self.table.setSortingEnabled(True)
+        self.table.resizeColumnsToContents()
@@ -50,6 +50,22 @@ def loadCalibrationMenuActions(window):
     calibrate_option.triggered.connect(window.calibrateAll)
     menuActions.append(calibrate_option)
 
+    calibrate_to_disk_option = QAction(
+        "Calibrate &Files to Disk",
+        window)
+    calibrate_to_disk_option.setStatusTip("Calibrate Files to Disk")
+    calibrate_to_disk_option.triggered.connect(window.calibrateToDisk)
+    menuActions.append(calibrate_to_disk_option)
+
+    single_precision_option = QAction(
+        "Single &Precision (float32)",
+        window)
+    single_precision_option.setStatusTip(
+        "Load, calibrate and combine new files in single precision")
+    single_precision_option.setCheckable(True)
+    single_precision_option.toggled.connect(window.setSinglePrecision)
+    menuActions.append(single_precision_option)
+
     return menuActions
 
 def loadFileMenuActions(window):
@@ -109,4 +125,44 @@ def loadStackMenuActions(window):
     color_stack_option.triggered.connect(window.colorStack)
     menuActions.append(color_stack_option)
 
-    return menuActions
\ No newline at end of file
+    return menuActions
+
+def loadToolsMenuActions(window):
+    """Load tools menu actions
+
+    Arguments
+    ---------
+    window: MainWindow
+    Window where the actions will act
+
+    Returns
+    -------
+    menuAction: list of QAction
+    List of actions in the tools menu
+    """
+    menuActions = []
+
+    decompression_option = QAction(
+        "&Decompress Gzipped Files...",
+        window)
+    decompression_option.setStatusTip(
+        "Read gzipped files from decompressed copies kept in a scratch folder")
+    decompression_option.setCheckable(True)
+    decompression_option.toggled.connect(window.setDecompressionCache)
+    menuActions.append(decompression_option)
+
+    memory_option = QAction(
+        "Memory &Budget...",
+        window)
+    memory_option.setStatusTip("Set the memory kept for the pixel data of the open files")
+    memory_option.triggered.connect(window.setMemoryBudget)
+    menuActions.append(memory_option)
+
+    profiling_option = QAction(
+        "&Profiling",
+        window)
+    profiling_option.setStatusTip("Record the time spent in each reduction stage")
+    profiling_option.triggered.connect(window.showProfiling)
+    menuActions.append(profiling_option)
+
+    return menuActions
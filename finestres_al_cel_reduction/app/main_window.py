@@ -6,6 +6,7 @@ from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import (
     QDialog,
     QFileDialog,
+    QInputDialog,
     QLabel,
     QMainWindow,
     QMdiArea,
@@ -22,16 +23,26 @@ from finestres_al_cel_reduction.app.environment import (
 )
 from finestres_al_cel_reduction.app.error_dialog import ErrorDialog
 from finestres_al_cel_reduction.app.fits_file_view import FitsFileView
+from finestres_al_cel_reduction.app.instrumentation_dialog import InstrumentationDialog
 from finestres_al_cel_reduction.app.load_actions import (
     loadCalibrationMenuActions, loadFileMenuActions,
-    loadStackMenuActions, 
+    loadStackMenuActions, loadToolsMenuActions,
 )
 from finestres_al_cel_reduction.app.set_calibration_dialog import SetCalibrationDialog
 from finestres_al_cel_reduction.app.success_dialog import SuccessDialog
 from finestres_al_cel_reduction.app.stack_dialog import StackDialog
 from finestres_al_cel_reduction.app.warning_dialog import WarningDialog
+from finestres_al_cel_reduction.app.worker import Worker, startWorker
 
-from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.batch_calibration import calibrate_frames, group_frames
+from finestres_al_cel_reduction.dark_library import DarkLibrary
+from finestres_al_cel_reduction.data_cache import DataCache
+from finestres_al_cel_reduction.decompression_cache import (
+    DEFAULT_SCRATCH_FOLDER, DEFAULT_SCRATCH_SIZE, DecompressionCache,
+)
+from finestres_al_cel_reduction.fits_loader import load_fits_files
+from finestres_al_cel_reduction.pipeline import calibrate_lights_streaming
+from finestres_al_cel_reduction.precision import set_working_precision
 
 class MainWindow(QMainWindow):
     """Main Window
@@ -76,6 +87,7 @@ class MainWindow(QMainWindow):
         self.fileActions = loadFileMenuActions(self)
         self.calibrateActions = loadCalibrationMenuActions(self)
         self.stackActions = loadStackMenuActions(self)
+        self.toolsActions = loadToolsMenuActions(self)
 
         # Create menues
         self._createToolBar()
@@ -84,8 +96,18 @@ class MainWindow(QMainWindow):
 
         # define variables
         self.files = []
+        self.master_biases = []
         self.master_darks = {}
         self.master_flats = {}
+        self.profilingDialog = None
+
+        # pixel data of the open files, the least recently used is dropped
+        # from memory when the session exceeds its memory budget
+        self.data_cache = DataCache()
+
+        # decompressed copies of gzipped files, disabled until a scratch
+        # folder is chosen (see setDecompressionCache)
+        self.decompression_cache = None
 
     def _createToolBar(self):
         """Create tool bars"""
@@ -116,10 +138,43 @@ class MainWindow(QMainWindow):
             stackMenu.addAction(menuAction)
             stackMenu.addSeparator()
 
+        toolsMenu = menu.addMenu("&Tools")
+        for menuAction in self.toolsActions:
+            toolsMenu.addAction(menuAction)
+            toolsMenu.addSeparator()
+
     def _createStatusBar(self):
         """Create status bar"""
         self.setStatusBar(QStatusBar(self))
 
+    @pyqtSlot(object)
+    def addFile(self, file):
+        """Add a loaded file to the session and display it
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The loaded file
+        """
+        self.files.append(file)
+        self.data_cache.add(file)
+        if file.type == "IMAGE":
+            # load image view
+            fileView = FitsFileView(file)
+
+            # display in subwindow
+            subWindow = QMdiSubWindow()
+            subWindow.setWidget(fileView)
+            subWindow.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+            subWindow.setWindowTitle(file.title)
+            # files that are not displayed do not need their data in memory
+            subWindow.destroyed.connect(lambda *_, file=file: self.data_cache.evict_file(file))
+
+            subWindow.setFixedSize(SUB_WINDOW_SIZE, SUB_WINDOW_SIZE)
+
+            self.mdiArea.addSubWindow(subWindow)
+            subWindow.show()
+
     @pyqtSlot()
     def calibrateAll(self):
         """Set calibration for all file views"""
@@ -130,48 +185,111 @@ class MainWindow(QMainWindow):
             errorDialog.exec()
             return
 
-        for file in self.files:
-            if file.type == "IMAGE":
-                # Calibrate the file with the master dark and flat frames
-                dark_list = self.master_darks.get(file.exposure_time, None)
-                if dark_list is None:
-                    dark = None
-                    warningDialog = WarningDialog(
-                        f"Warning: No master dark found for {file.exposure_time}s exposure time.\n"
-                        "Calibration will proceed without dark subtraction.")
-                    warningDialog.exec()
-                    if warningDialog.result() == QDialog.DialogCode.Rejected:
-                        return
-                    
-                else:
-                    dark = dark_list[0]
-                flat_list = self.master_flats.get(file.filter, None)
-                if flat_list is None:
-                    flat = None
-                    warningDialog = WarningDialog(
-                        f"Warning: No master flat found for filter {file.filter}.\n"
-                        "Calibration will proceed without flat division.")
-                    warningDialog.exec()
-                    if warningDialog.result() == QDialog.DialogCode.Rejected:
-                        return
-                else:
-                    flat = flat_list[0]
-                try:
-                    file.calibrate(dark=dark, flat=flat)
-                except Exception as e:
-                    errorDialog = ErrorDialog(f"Error calibrating {file.title}: {str(e)}")
-                    errorDialog.exec()
-
-        # Update all FitsFileView plots
+        # masters are looked up once per (exposure time, filter) group
+        images = [file for file in self.files if file.type == "IMAGE"]
+        groups = group_frames(images)
+        # master darks are scaled to the exposure times without a master dark
+        master_darks = self.getDarkLibrary()
+        for exposure_time in dict.fromkeys(key[0] for key in groups):
+            try:
+                dark = master_darks.get(exposure_time, None)
+            except ValueError as e:
+                errorDialog = ErrorDialog(f"Error scaling master dark: {str(e)}")
+                errorDialog.exec()
+                return
+            if dark is None:
+                warningDialog = WarningDialog(
+                    f"Warning: No master dark found for {exposure_time}s exposure time.\n"
+                    "Calibration will proceed without dark subtraction.")
+                warningDialog.exec()
+                if warningDialog.result() == QDialog.DialogCode.Rejected:
+                    return
+        master_flats = {}
+        for filter_name in dict.fromkeys(key[1] for key in groups):
+            flat_list = self.master_flats.get(filter_name, None)
+            if flat_list is None:
+                warningDialog = WarningDialog(
+                    f"Warning: No master flat found for filter {filter_name}.\n"
+                    "Calibration will proceed without flat division.")
+                warningDialog.exec()
+                if warningDialog.result() == QDialog.DialogCode.Rejected:
+                    return
+            else:
+                master_flats[filter_name] = flat_list[0]
+
+        # Calibrate each group of files with their master dark and flat frames
+        numFiles = 0
+        numBytes = 0
+        seconds = 0.0
+        for group in groups.values():
+            # refreshes in the background must not evict the frames while
+            # they are modified in place
+            self.data_cache.acquire(group)
+            try:
+                stats = calibrate_frames(group, master_darks, master_flats)
+            except Exception as e:
+                errorDialog = ErrorDialog(
+                    f"Error calibrating {', '.join(file.title for file in group)}: {str(e)}")
+                errorDialog.exec()
+                continue
+            finally:
+                self.data_cache.release(group)
+            numFiles += stats["frames"]
+            numBytes += stats["bytes"]
+            seconds += stats["seconds"]
+        if seconds > 0:
+            self.statusBar().showMessage(
+                f"Calibrated {numFiles} files in {seconds:.2f} s "
+                f"({numFiles / seconds:.1f} files/s, {numBytes / 1024**2 / seconds:.1f} MB/s)")
+
+        # Mark all FitsFileView plots as out of date, only the visible ones
+        # are refreshed now, in the background
         for subwindow in self.mdiArea.subWindowList():
             widget = subwindow.widget()
             if isinstance(widget, FitsFileView):
-                widget.updatePlot()
+                widget.markDirty()
+
+    @pyqtSlot()
+    def calibrateToDisk(self):
+        """Calibrate files one at a time and save them, without loading them in the app"""
+        if len(self.master_darks) == 0 or len(self.master_flats) == 0:
+            errorDialog = ErrorDialog(
+                "Error: No master dark or flat frames found. "
+                "Please set calibration frames before calibrating files.")
+            errorDialog.exec()
+            return
+
+        filenames, _ = QFileDialog.getOpenFileNames(
+            self,
+            "Select File (s) to Calibrate",
+            "${HOME}",
+            "Fits (*.fits *.fit *.fits.gz)",
+        )
+        if not filenames:
+            return
+        output_folder = QFileDialog.getExistingDirectory(self, "Select Output Folder")
+        if not output_folder:
+            return
+
+        worker = Worker(
+            calibrate_lights_streaming,
+            filenames,
+            self.getDarkLibrary(),
+            {filter_name: flats[0] for filter_name, flats in self.master_flats.items()},
+            output_folder)
+        worker.signals.result.connect(
+            lambda calibrated: SuccessDialog(
+                f"{len(calibrated)} files calibrated and saved to {output_folder}.").exec())
+        worker.signals.error.connect(
+            lambda message: self.showError(f"Error calibrating files: {message}"))
+        startWorker(self, worker, "Calibrating files...")
 
     def closeEvent(self, event):
         """Ensure all subwindows are closed when main window closes."""
         if hasattr(self, "mdiArea"):
             self.mdiArea.closeAllSubWindows()
+        if hasattr(self, "data_cache"):
+            self.data_cache.close()
         super().closeEvent(event)
 
     @pyqtSlot()
@@ -181,6 +299,7 @@ class MainWindow(QMainWindow):
         if color_stack_window.exec() == QDialog.DialogCode.Accepted:
             file = color_stack_window.color_stack
             self.files.append(file)
+            self.data_cache.add(file)
 
             fileView = FitsFileView(file)
 
@@ -189,6 +308,7 @@ class MainWindow(QMainWindow):
             subWindow.setWidget(fileView)
             subWindow.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
             subWindow.setWindowTitle(file.title)
+            subWindow.destroyed.connect(lambda *_, file=file: self.data_cache.evict_file(file))
 
             subWindow.setFixedSize(SUB_WINDOW_SIZE, SUB_WINDOW_SIZE)
 
@@ -196,6 +316,18 @@ class MainWindow(QMainWindow):
             subWindow.show()
 
 
+    def getDarkLibrary(self):
+        """Get the master darks, scaled with the master bias when there is one
+
+        Returns
+        -------
+        darks: finestres_al_cel_reduction.dark_library.DarkLibrary
+        The master darks, with the exposure time as key.
+        """
+        return DarkLibrary(
+            {exposure_time: darks[0] for exposure_time, darks in self.master_darks.items()},
+            self.master_biases[0] if self.master_biases else None)
+
     @pyqtSlot()
     def openFile(self):
         """Open dialog to select and open file"""
@@ -207,41 +339,27 @@ class MainWindow(QMainWindow):
         )
 
         if filenames:
-            for filename in filenames:
-                # fits files
-                if filename.endswith(".fits") or filename.endswith(".fit") or filename.endswith(".fits.gz"):
-                    try:
-                        file = FitsFile(filename)
-                    
-                    except Exception as e:
-                        # Show error dialog
-                        errorDialog = ErrorDialog(str(e))
-                        errorDialog.exec()
-                        raise e
-                    
-                    self.files.append(file)
-                    if file.type == "IMAGE":
-                        # load image view
-                        fileView = FitsFileView(file)
-
-                        # display in subwindow
-                        subWindow = QMdiSubWindow()
-                        subWindow.setWidget(fileView)
-                        subWindow.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
-                        subWindow.setWindowTitle(file.title)
-            
-                        subWindow.setFixedSize(SUB_WINDOW_SIZE, SUB_WINDOW_SIZE)
+            # fits files
+            fitsFilenames = [
+                filename for filename in filenames
+                if filename.endswith(".fits") or filename.endswith(".fit") or filename.endswith(".fits.gz")
+            ]
+            # TODO: add other file types
+
+            # load files in the background, each one is shown as soon as it is loaded
+            worker = Worker(
+                load_fits_files, fitsFilenames, memmap=True,
+                decompression_cache=self.decompression_cache)
+            worker.signals.itemReady.connect(self.addFile)
+            worker.signals.error.connect(self.showError)
+            startWorker(self, worker, "Loading files...")
 
-                        self.mdiArea.addSubWindow(subWindow)
-                        subWindow.show()
-
-                # TODO: add other file types
-        
     @pyqtSlot()
     def setCalibration(self):
         """Set calibration for the current file view"""
-        set_calibration_window = SetCalibrationDialog()
+        set_calibration_window = SetCalibrationDialog(self.decompression_cache)
         if set_calibration_window.exec() == QDialog.DialogCode.Accepted:
+            self.master_biases = set_calibration_window.master_biases
             self.master_darks = set_calibration_window.master_darks
             self.master_flats = set_calibration_window.master_flats
             
@@ -256,6 +374,101 @@ class MainWindow(QMainWindow):
                 errorDialog.exec()
                 return
     
+    @pyqtSlot(bool)
+    def setDecompressionCache(self, checked):
+        """Enable or disable the decompressed copies of gzipped files
+
+        When enabled, the pixel data of gzipped files is read from copies
+        decompressed to a scratch folder, which are kept between sessions up
+        to a size limit.
+
+        Arguments
+        ---------
+        checked: bool
+        If True, ask for the scratch folder and its size limit. Otherwise,
+        gzipped files are read directly.
+        """
+        self.decompression_cache = None
+        if not checked:
+            return
+
+        folder = QFileDialog.getExistingDirectory(
+            self, "Select Scratch Folder for Decompressed Files", DEFAULT_SCRATCH_FOLDER)
+        size = 0.0
+        accepted = False
+        if folder:
+            size, accepted = QInputDialog.getDouble(
+                self,
+                "Scratch Folder Size",
+                "Maximum size of the decompressed files kept (GB):",
+                DEFAULT_SCRATCH_SIZE / 1024**3,
+                0.1,
+                10240.0,
+                1)
+        if accepted:
+            try:
+                self.decompression_cache = DecompressionCache(
+                    folder, max_size=int(size * 1024**3))
+            except (OSError, ValueError) as e:
+                self.showError(f"Error creating the scratch folder: {str(e)}")
+        if self.decompression_cache is None:
+            # cancelled or failed, leave the option unchecked
+            action = self.sender()
+            if action is not None:
+                action.setChecked(False)
+            return
+        self.statusBar().showMessage(
+            f"Gzipped files are decompressed to {folder} (up to {size:.1f} GB)")
+
+    @pyqtSlot()
+    def setMemoryBudget(self):
+        """Set the memory kept for the pixel data of the open files"""
+        budget, accepted = QInputDialog.getDouble(
+            self,
+            "Memory Budget",
+            "Memory for the pixel data of the open files (GB):",
+            self.data_cache.memory_budget / 1024**3,
+            0.1,
+            1024.0,
+            1)
+        if accepted:
+            self.data_cache.set_memory_budget(int(budget * 1024**3))
+            self.statusBar().showMessage(
+                f"Pixel data in memory: {self.data_cache.memory_used / 1024**3:.2f} GB "
+                f"of {budget:.1f} GB")
+
+    @pyqtSlot(bool)
+    def setSinglePrecision(self, checked):
+        """Set the working precision of the files loaded from now on
+
+        Arguments
+        ---------
+        checked: bool
+        If True, use single precision (float32). Otherwise, use double
+        precision (float64).
+        """
+        set_working_precision("float32" if checked else "float64")
+
+    @pyqtSlot(str)
+    def showError(self, message):
+        """Show an error message
+
+        Arguments
+        ---------
+        message: str
+        The error message
+        """
+        errorDialog = ErrorDialog(message)
+        errorDialog.exec()
+
+    @pyqtSlot()
+    def showProfiling(self):
+        """Show the panel with the time spent in each reduction stage"""
+        if self.profilingDialog is None:
+            self.profilingDialog = InstrumentationDialog()
+        self.profilingDialog.show()
+        self.profilingDialog.raise_()
+
     @pyqtSlot()
     def stackFiles(self):
         """Stack images to improve SNR"""
@@ -264,6 +477,7 @@ class MainWindow(QMainWindow):
 
             for file in stack_window.stack.values():
                 self.files.append(file)
+                self.data_cache.add(file)
 
                 # display in subwindow
                 fileView = FitsFileView(file)
@@ -271,6 +485,8 @@ class MainWindow(QMainWindow):
                 subWindow.setWidget(fileView)
                 subWindow.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
                 subWindow.setWindowTitle(file.title)
+                subWindow.destroyed.connect(
+                    lambda *_, file=file: self.data_cache.evict_file(file))
     
                 subWindow.setFixedSize(SUB_WINDOW_SIZE, SUB_WINDOW_SIZE)
 
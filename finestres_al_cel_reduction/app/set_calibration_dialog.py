@@ -3,15 +3,17 @@ import os
 
 from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import (
-    QDialog, QDialogButtonBox, QFileDialog, QGridLayout, 
-    QLabel, QListWidget, QListWidgetItem, QPushButton,
+    QCheckBox, QComboBox, QDialog, QDialogButtonBox, QFileDialog, QGridLayout, 
+    QLabel, QListWidget, QListWidgetItem, QPushButton, QSpinBox,
 )
 
 
 from finestres_al_cel_reduction.app.error_dialog import ErrorDialog
-from finestres_al_cel_reduction.master_fits_file import MasterFitsFile
-from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.calibration_catalog import CalibrationCatalog
+from finestres_al_cel_reduction.combine import VALID_AVERAGE_METHODS
+from finestres_al_cel_reduction.pipeline import generate_masters
 from finestres_al_cel_reduction.app.warning_dialog import WarningDialog
+from finestres_al_cel_reduction.app.worker import Worker, startWorker
 
 class SetCalibrationDialog(QDialog):
     """ Class to define the settings for the stellar finder
@@ -38,16 +40,26 @@ class SetCalibrationDialog(QDialog):
     thresholdQuestion: QLineEdit
     Field to modify the detection threshold
     """
-    def __init__(self):
-        """Initialize instance"""
+    def __init__(self, decompression_cache=None):
+        """Initialize instance
+
+        Arguments
+        ---------
+        decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+        If not None, gzipped calibration frames are decompressed to the cache
+        and read from the decompressed copies.
+        """
         super().__init__()
 
         # Initialize variables
+        self.decompression_cache = decompression_cache
         self.calibration_folder = None
+        self.biases = []
         self.darks = {}
         self.flats = {}
         self.fitsListWidget = QListWidget()
         self.mastersListWidget = QListWidget()
+        self.master_biases = []
         self.master_darks = {}
         self.master_flats = {} 
         
@@ -68,10 +80,24 @@ class SetCalibrationDialog(QDialog):
         # Add QListWidget for FITS files
         self.fitsListWidget.setMinimumHeight(self.fitsListWidget.sizeHintForRow(0) * 5 + 2 * self.fitsListWidget.frameWidth())
         
+        # Combination method for the masters
+        self.averageComboBox = QComboBox()
+        self.averageComboBox.addItems(VALID_AVERAGE_METHODS)
+        self.averageComboBox.setCurrentText("median")
+
+        # Number of processes used to combine the masters
+        self.workersSpinBox = QSpinBox()
+        self.workersSpinBox.setRange(1, os.cpu_count() or 1)
+        self.workersSpinBox.setValue(os.cpu_count() or 1)
+
         # Generate masters button
-        self.generateMastersButton = QPushButton("Generate Masters (replace existing)")
+        self.generateMastersButton = QPushButton("Generate Masters")
         self.generateMastersButton.clicked.connect(self.generate_masters)
 
+        # Reuse masters whose input frames have not changed
+        self.useCacheCheckBox = QCheckBox("Reuse unchanged masters")
+        self.useCacheCheckBox.setChecked(True)
+
         # Add QListWidget for FITS files
         self.mastersListWidget.setMinimumHeight(self.mastersListWidget.sizeHintForRow(0) * 5 + 2 * self.mastersListWidget.frameWidth())
 
@@ -80,8 +106,13 @@ class SetCalibrationDialog(QDialog):
         layout.addWidget(self.selectCalibrationFolderButton, 0, 0)
         layout.addWidget(self.selectedCalibrationFolderLabel, 0, 1)
         layout.addWidget(self.fitsListWidget, 1, 0, 1, 2)
-        layout.addWidget(self.generateMastersButton, 3, 0)
-        layout.addWidget(self.mastersListWidget, 4, 0, 1, 2)
+        layout.addWidget(QLabel("Combine method:"), 2, 0)
+        layout.addWidget(self.averageComboBox, 2, 1)
+        layout.addWidget(QLabel("Workers:"), 3, 0)
+        layout.addWidget(self.workersSpinBox, 3, 1)
+        layout.addWidget(self.generateMastersButton, 4, 0)
+        layout.addWidget(self.useCacheCheckBox, 4, 1)
+        layout.addWidget(self.mastersListWidget, 5, 0, 1, 2)
         layout.addWidget(self.buttonBox)
         self.setLayout(layout)
 
@@ -89,6 +120,15 @@ class SetCalibrationDialog(QDialog):
         """Add items to a QListWidget with headers"""
         self.fitsListWidget.clear()
 
+        # Add biases to the list qwidget
+        header = QListWidgetItem("Biases")
+        font = QFont()
+        font.setBold(True)
+        header.setFont(font)
+        self.fitsListWidget.addItem(header)
+        for file in self.biases:
+            self.fitsListWidget.addItem(f"    {file.title}")
+
         # Add grouped darks to the list qwidget
         header = QListWidgetItem("Darks")
         font = QFont()
@@ -117,7 +157,16 @@ class SetCalibrationDialog(QDialog):
         """Add items to the masters QListWidget with headers"""
         self.mastersListWidget.clear()
 
-        # Add grouped items to the masters' list widget
+        # Add biases to the masters' list widget
+        header = QListWidgetItem("Biases")
+        font = QFont()
+        font.setBold(True)
+        header.setFont(font)
+        self.mastersListWidget.addItem(header)
+        for file in self.master_biases:
+            self.mastersListWidget.addItem(f"    {file.title}")
+
+        # Add grouped darks to the masters' list widget
         header = QListWidgetItem("Darks")
         font = QFont()
         font.setBold(True)
@@ -142,7 +191,7 @@ class SetCalibrationDialog(QDialog):
                 self.mastersListWidget.addItem(f"    {file.title}")
 
     def generate_masters(self):
-        """Generate master darks and flats from the selected folder"""
+        """Generate master biases, darks and flats from the selected folder"""
         # first generate the master darks
         if not self.calibration_folder:
             errorDialog = ErrorDialog("Calibration folder not selected.")
@@ -155,76 +204,21 @@ class SetCalibrationDialog(QDialog):
             errorDialog.exec()
             return
         
-        # Generate master darks
-        self.master_darks = {}
-        for exposure_time, files in self.darks.items():
-            if len(files) == 0:
-                continue
-            filename = os.path.join(self.calibration_folder, f"master_dark_{exposure_time}s.fits")
-            try:
-                # Create master flat file
-                master_dark = MasterFitsFile(filename, files, average="median")
-                master_dark.save()
-                if exposure_time not in self.master_darks:
-                    self.master_darks[exposure_time] = [master_dark]
-                else:
-                    self.master_darks[exposure_time].append(master_dark)
-            except Exception as e:
-                errorDialog = ErrorDialog(f"Error generating master dark for {exposure_time}s: {str(e)}")
-                errorDialog.exec()
-                return
-            
-        # check that list of mater darks are one per exposure time
-        for exposure_time, files in self.master_darks.items():
-            if len(files) != 1:
-                errorDialog = ErrorDialog(f"Error: More than one master dark for {exposure_time}s exposure time.")
-                errorDialog.exec()
-                return
-            
-        # Generate master flats
-        self.master_flats = {}
-        for filter_name, files in self.flats.items():
-            if len(files) == 0:
-                continue
-
-            filename = os.path.join(self.calibration_folder, f"master_flat_{filter_name}.fits")
-            try:        
-                for file in files:
-                    # Calibrate flat files
-                    dark_list = self.master_darks.get(file.exposure_time, None)
-                    if dark_list is None:
-                        dark_list = None
-                    else:
-                        dark = dark_list[0]
-                        
-                    file.calibrate(
-                        dark=dark,
-                        flat=None,  # No flat calibration for flats
-                    )
-
-                # Create master flat file
-                master_flat = MasterFitsFile(filename, files, average="median")
-                master_flat.normalize()  # Normalize the master flat
-                master_flat.save()
-                if filter_name not in self.master_flats:
-                    self.master_flats[filter_name] = [master_flat]
-                else:
-                    self.master_flats[filter_name].append(master_flat)
-            except Exception as e:
-                errorDialog = ErrorDialog(f"Error generating master flat for filter {filter_name}: {str(e)}")
-                errorDialog.exec()
-                raise e
-                return
-        
-        # check that list of mater flats are one per exposure time and filter
-        for filter_name, files in self.master_flats.items():
-            if len(files) != 1:
-                errorDialog = ErrorDialog(
-                    f"Error: More than one master flat for filter {filter_name}.")
-                errorDialog.exec()
-                return
-    
-        self.add_items_to_masters_list_widget()
+        # Generate master darks and flats in the background
+        worker = Worker(
+            generate_masters,
+            self.darks,
+            self.flats,
+            self.calibration_folder,
+            average=self.averageComboBox.currentText(),
+            workers=self.workersSpinBox.value(),
+            use_cache=self.useCacheCheckBox.isChecked(),
+            biases=self.biases,
+            master_bias=self.master_biases[0] if self.master_biases else None,
+            decompression_cache=self.decompression_cache)
+        worker.signals.result.connect(self.set_masters)
+        worker.signals.error.connect(lambda message: ErrorDialog(message).exec())
+        startWorker(self, worker, "Generating masters...")
 
     def select_calibration_folder(self):
         """Select calibration folder"""
@@ -235,64 +229,36 @@ class SetCalibrationDialog(QDialog):
             self.selectedCalibrationFolderLabel.setText(
                 self.calibration_folder if self.calibration_folder is not None else "None")
 
-            # List FITS files
-            self.darks = {}
-            self.flats = {}
-            self.master_darks = {}
-            self.master_flats = {}
-            for fname in os.listdir(folder):
-                if fname.lower().endswith((".fits", ".fit", ".fits.gz")):
-                    # Open file to get header information
-                    file = FitsFile(os.path.join(folder, fname))
-                    if file.type != "IMAGE":
-                        continue # Skip non-image files
-                    if file.exposure_time is None:
-                        warningDialog = WarningDialog(
-                        f"Warning: No exposure time in {file.filename}. Skipping.")
-                        warningDialog.exec()
-                        continue
-                    # Dark frames
-                    if file.image_type == "Dark Frame":
-                        exposure_time = file.exposure_time
-                        if exposure_time not in self.darks:
-                            self.darks[exposure_time] = [file]
-                        else:
-                            self.darks[exposure_time].append(file)
-                    # Flat frames
-                    elif file.image_type == "Flat":
-                        filter_name = file.filter
-                        if filter_name is None:
-                            warningDialog = WarningDialog(
-                            f"Warning: No filter in {file.filename}. Skipping.")
-                            warningDialog.exec()
-                            continue
-                        if filter_name not in self.darks:
-                            self.flats[filter_name] = [file]
-                        else:
-                            self.flats[filter_name].append(file)
-                    # Master dark frames
-                    elif file.image_type == "Master Dark Frame":
-                        exposure_time = file.exposure_time
-                        if exposure_time not in self.master_darks:
-                            self.master_darks[exposure_time] = [file]
-                        else:
-                            self.master_darks[exposure_time].append(file)
-                    # Master flat frames
-                    elif file.image_type == "Master Flat":
-                        filter_name = file.filter
-                        if filter_name not in self.master_flats:
-                            self.master_flats[filter_name] = []
-                        self.master_flats[filter_name].append(file)
-                    # Light frames
-                    elif file.image_type == "Light Frame":
-                        continue
-                    # Unknown image type
-                    else:
-                        warningDialog = WarningDialog(
-                            f"Warning: Unknown image type '{file.image_type}' in {file.filename}. Skipping.")
-                        warningDialog.exec()
-                        continue
+            # Classify FITS files from their headers only
+            catalog = CalibrationCatalog(folder, decompression_cache=self.decompression_cache)
+            for _, reason in catalog.skipped:
+                warningDialog = WarningDialog(f"Warning: {reason} Skipping.")
+                warningDialog.exec()
+            self.biases = catalog.biases
+            self.darks = catalog.darks
+            self.flats = catalog.flats
+            self.master_biases = catalog.master_biases
+            self.master_darks = catalog.master_darks
+            self.master_flats = catalog.master_flats
 
             self.add_items_to_list_widget()
             self.add_items_to_masters_list_widget()
 
+    def set_masters(self, masters):
+        """Set the generated masters and list them
+
+        Arguments
+        ---------
+        masters: (dict, dict, FitsFile or None)
+        The master darks, with the exposure time as key, the master flats,
+        with the filter as key, and the master bias.
+        """
+        master_darks, master_flats, master_bias = masters
+        if master_bias is not None:
+            self.master_biases = [master_bias]
+        self.master_darks = {
+            exposure_time: [master_dark] for exposure_time, master_dark in master_darks.items()}
+        self.master_flats = {
+            filter_name: [master_flat] for filter_name, master_flat in master_flats.items()}
+
+        self.add_items_to_masters_list_widget()
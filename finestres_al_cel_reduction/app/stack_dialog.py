@@ -4,11 +4,18 @@ import os
 from PyQt6.QtCore import Qt
 from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import (
-    QDialog, QDialogButtonBox, QGridLayout, 
-    QLabel, QListWidget, QListWidgetItem, QPushButton,
+    QComboBox, QDialog, QDialogButtonBox, QGridLayout, 
+    QLabel, QListWidget, QListWidgetItem, QPushButton, QSpinBox,
 )
 
+from finestres_al_cel_reduction.app.error_dialog import ErrorDialog
+from finestres_al_cel_reduction.app.worker import Worker, startWorker
+from finestres_al_cel_reduction.combine import VALID_AVERAGE_METHODS
 from finestres_al_cel_reduction.master_fits_file import MasterFitsFile
+from finestres_al_cel_reduction.pipeline import align_lights
+from finestres_al_cel_reduction.registration import (
+    DEFAULT_REGISTRATION_WORKERS, VALID_REGISTRATION_METHODS,
+)
 
 class StackDialog(QDialog):
     """ Class to define the settings for the stacking process"""
@@ -51,6 +58,26 @@ class StackDialog(QDialog):
         self.addButton.clicked.connect(self.move_to_selected)
         self.removeButton.clicked.connect(self.move_to_unselected)
 
+        # Combination method
+        self.averageComboBox = QComboBox()
+        self.averageComboBox.addItems(VALID_AVERAGE_METHODS)
+        self.averageComboBox.setCurrentText("median")
+
+        # Alignment of the images before combining them
+        self.registrationComboBox = QComboBox()
+        self.registrationComboBox.addItems(VALID_REGISTRATION_METHODS)
+        self.registrationComboBox.setCurrentText("none")
+
+        # Number of threads used to align the images
+        self.registrationWorkersSpinBox = QSpinBox()
+        self.registrationWorkersSpinBox.setRange(1, os.cpu_count() or 1)
+        self.registrationWorkersSpinBox.setValue(DEFAULT_REGISTRATION_WORKERS)
+
+        # Number of processes used to combine the images
+        self.workersSpinBox = QSpinBox()
+        self.workersSpinBox.setRange(1, os.cpu_count() or 1)
+        self.workersSpinBox.setValue(os.cpu_count() or 1)
+
         # OK/Cancel
         QButtons = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
         self.buttonBox = QDialogButtonBox(QButtons)
@@ -65,19 +92,39 @@ class StackDialog(QDialog):
         layout.addWidget(self.addButton, 1, 1)
         layout.addWidget(self.removeButton, 2, 1)
         layout.addWidget(self.selectedList, 1, 2, 2, 1)
-        layout.addWidget(self.buttonBox, 3, 0, 1, 3)
+        layout.addWidget(QLabel("Combine method:"), 3, 0)
+        layout.addWidget(self.averageComboBox, 3, 1, 1, 2)
+        layout.addWidget(QLabel("Alignment:"), 4, 0)
+        layout.addWidget(self.registrationComboBox, 4, 1, 1, 2)
+        layout.addWidget(QLabel("Alignment workers:"), 5, 0)
+        layout.addWidget(self.registrationWorkersSpinBox, 5, 1, 1, 2)
+        layout.addWidget(QLabel("Workers:"), 6, 0)
+        layout.addWidget(self.workersSpinBox, 6, 1, 1, 2)
+        layout.addWidget(self.buttonBox, 7, 0, 1, 3)
         self.setLayout(layout)
 
     def accept(self):
-        """Run stacking before accepting the dialog."""
-        # Gather selected files
-        for filter_name, files in self.selected_files.items():
-            filename = os.path.join(
-                os.path.dirname(files[0].filename), 
-                f"master_stack_{filter_name}.fits"
-            )
-            self.stack[filter_name] = MasterFitsFile(
-                filename, files, average="median")
+        """Run stacking in the background, the dialog is accepted when it finishes."""
+        worker = Worker(
+            self.stack_files,
+            self.selected_files,
+            average=self.averageComboBox.currentText(),
+            workers=self.workersSpinBox.value(),
+            registration=self.registrationComboBox.currentText(),
+            registration_workers=self.registrationWorkersSpinBox.value())
+        worker.signals.result.connect(self.finish_stacking)
+        worker.signals.error.connect(lambda message: ErrorDialog(message).exec())
+        startWorker(self, worker, "Stacking files...")
+
+    def finish_stacking(self, stack):
+        """Store the stacked files and accept the dialog.
+
+        Arguments
+        ---------
+        stack: dict
+        The stacked files, with the filter as key.
+        """
+        self.stack = stack
 
         # Now accept/close the dialog
         super().accept()
@@ -124,6 +171,55 @@ class StackDialog(QDialog):
         self.update_selected_list()
         self.update_unselected_list()
         
+    @staticmethod
+    def stack_files(selected_files, average, workers, registration="none",
+                    registration_workers=DEFAULT_REGISTRATION_WORKERS,
+                    progress_callback=None):
+        """Stack the selected files of each filter.
+
+        This runs in a background thread.
+
+        Arguments
+        ---------
+        selected_files: dict
+        Lists of files to stack, with the filter as key.
+
+        average: str
+        The method used to combine the files.
+
+        workers: int
+        Number of worker processes used to combine the files.
+
+        registration: str - Default "none"
+        The transforms corrected when aligning the files of each filter. See
+        finestres_al_cel_reduction.registration.VALID_REGISTRATION_METHODS.
+
+        registration_workers: int - Default DEFAULT_REGISTRATION_WORKERS
+        Number of threads used to align the files.
+
+        progress_callback: function or None - Default None
+        If not None, called as progress_callback(done, total) after each filter.
+
+        Returns
+        -------
+        stack: dict
+        The stacked files, with the filter as key.
+        """
+        stack = {}
+        for filter_name, files in selected_files.items():
+            filename = os.path.join(
+                os.path.dirname(files[0].filename), 
+                f"master_stack_{filter_name}.fits"
+            )
+            files = align_lights(
+                files, registration=registration, workers=registration_workers)
+            stack[filter_name] = MasterFitsFile(
+                filename, files, average=average, workers=workers)
+            if progress_callback is not None:
+                progress_callback(len(stack), len(selected_files))
+
+        return stack
+
     def update_selected_list(self):
         """Update the selected list with files grouped by filter."""
         self.selectedList.clear()
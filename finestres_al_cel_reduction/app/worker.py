@@ -0,0 +1,156 @@
+""" Background workers to keep the interface responsive during long operations"""
+import threading
+
+from PyQt6.QtCore import QObject, QRunnable, Qt, QThreadPool, pyqtSignal, pyqtSlot
+from PyQt6.QtWidgets import QProgressDialog
+
+from finestres_al_cel_reduction.pipeline import ReductionCancelled
+
+class WorkerSignals(QObject):
+    """ Signals emitted by a Worker
+
+    Signals
+    -------
+    progress: (int, int)
+    Number of items done and total number of items
+
+    itemReady: object
+    Partial result, emitted as soon as it is available
+
+    result: object
+    Value returned by the function
+
+    error: str
+    Error message, emitted if the function raises an exception
+
+    cancelled:
+    Emitted if the function was cancelled
+
+    finished:
+    Emitted when the function is done, whatever the outcome
+    """
+    progress = pyqtSignal(int, int)
+    itemReady = pyqtSignal(object)
+    result = pyqtSignal(object)
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal()
+    finished = pyqtSignal()
+
+class Worker(QRunnable):
+    """ Class to run a function in a QThreadPool
+
+    The function is called with an additional keyword argument
+    progress_callback. The function should call it as
+    progress_callback(done, total, item=None) to report its progress and,
+    optionally, a partial result. If the worker has been cancelled, the
+    callback raises finestres_al_cel_reduction.pipeline.ReductionCancelled
+    to stop the function.
+
+    Methods
+    -------
+    (see QRunnable)
+    __init__
+    cancel
+    reportProgress
+    run
+
+    Attributes
+    ----------
+    (see QRunnable)
+
+    signals: WorkerSignals
+    Signals used to communicate with the main thread
+    """
+    def __init__(self, function, *args, **kwargs):
+        """Initialize instance
+
+        Arguments
+        ---------
+        function: function
+        The function to run
+
+        *args, **kwargs:
+        Arguments passed to the function
+        """
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelEvent = threading.Event()
+
+    def cancel(self):
+        """Request the function to stop at its next progress report"""
+        self.cancelEvent.set()
+
+    def reportProgress(self, done, total, item=None):
+        """Progress callback passed to the function
+
+        Arguments
+        ---------
+        done: int
+        Number of items done
+
+        total: int
+        Total number of items
+
+        item: object or None - Default None
+        Partial result to deliver to the main thread
+
+        Raises
+        ------
+        ReductionCancelled: If the worker has been cancelled
+        """
+        if item is not None:
+            self.signals.itemReady.emit(item)
+        self.signals.progress.emit(done, total)
+        if self.cancelEvent.is_set():
+            raise ReductionCancelled()
+
+    @pyqtSlot()
+    def run(self):
+        """Run the function and emit the corresponding signals"""
+        try:
+            result = self.function(
+                *self.args, progress_callback=self.reportProgress, **self.kwargs)
+        except ReductionCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self.signals.error.emit(str(e))
+        else:
+            self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+def startWorker(parent, worker, label):
+    """Start a worker in the global thread pool and show its progress
+
+    Arguments
+    ---------
+    parent: QWidget
+    Widget blocked while the worker runs
+
+    worker: Worker
+    The worker to start
+
+    label: str
+    Text shown in the progress dialog
+
+    Returns
+    -------
+    progressDialog: QProgressDialog
+    Dialog showing the progress. Its cancel button cancels the worker
+    """
+    progressDialog = QProgressDialog(label, "Cancel", 0, 0, parent)
+    progressDialog.setWindowModality(Qt.WindowModality.WindowModal)
+    progressDialog.setMinimumDuration(0)
+    progressDialog.canceled.connect(worker.cancel)
+
+    def updateProgress(done, total):
+        progressDialog.setMaximum(total)
+        progressDialog.setValue(done)
+
+    worker.signals.progress.connect(updateProgress)
+    worker.signals.finished.connect(progressDialog.reset)
+    QThreadPool.globalInstance().start(worker)
+    return progressDialog
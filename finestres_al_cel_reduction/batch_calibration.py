@@ -0,0 +1,159 @@
+"""Calibration of many frames at once, grouped by the masters they need."""
+import logging
+import time
+
+import numpy as np
+
+from finestres_al_cel_reduction.instrumentation import instrumented
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+logger = logging.getLogger(__name__)
+
+@instrumented("calibrate_frames")
+def calibrate_frames(files, master_darks, master_flats=None, progress_callback=None):
+    """Dark subtract and flat divide many frames, one vectorized pass per frame.
+
+    Frames are grouped by exposure time and filter, so the masters are looked
+    up and converted to the working precision once per group. Frames whose
+    data is already in memory in the working precision are calibrated in
+    place. The others (e.g. memory-mapped or integer data) are converted to
+    the working precision by the dark subtraction itself, which writes into
+    a new array owned by the frame.
+
+    Frames without a matching master dark or master flat are calibrated
+    without it, and a warning is logged once per group.
+
+    Arguments
+    ---------
+    files: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The frames to calibrate. They are calibrated in place.
+
+    master_darks: dict
+    Master darks, with the exposure time as key.
+
+    master_flats: dict or None - Default None
+    Master flats, with the filter as key. If None, the frames are not flat divided.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    frame and after each frame. It may raise ReductionCancelled to stop.
+
+    Returns
+    -------
+    stats: dict
+    Throughput of the calibration, with keys "frames", "bytes", "seconds",
+    "frames_per_second" and "megabytes_per_second".
+
+    Raises
+    ------
+    ValueError: If a frame has no data or its shape does not match its masters.
+    All the frames are checked first, so none is modified if any of them is
+    not valid.
+    """
+    start_time = time.perf_counter()
+    dtype = get_working_dtype()
+    num_frames = 0
+    num_bytes = 0
+    done = 0
+    if progress_callback is not None:
+        progress_callback(done, len(files))
+
+    # every group is checked before any frame is modified
+    groups = []
+    for (exposure_time, filter_name), group in group_frames(files).items():
+        dark = master_darks.get(exposure_time, None)
+        if dark is None:
+            logger.warning(
+                "No master dark found for %ss exposure time. "
+                "%d frames will not be dark subtracted.", exposure_time, len(group))
+        flat = None
+        if master_flats is not None:
+            flat = master_flats.get(filter_name, None)
+            if flat is None:
+                logger.warning(
+                    "No master flat found for filter %s. %d frames will not be flat divided.",
+                    filter_name, len(group))
+        masters = [master for master in (dark, flat) if master is not None]
+        if len(masters) == 0:
+            groups.append((group, dark, flat, None))
+            continue
+
+        shape = masters[0].shape
+        if any(master.shape != shape for master in masters):
+            raise ValueError(
+                "The shapes of " +
+                " and ".join(f"{master.title} {master.shape}" for master in masters) +
+                " do not match.")
+        for file in group:
+            if file.shape is None:
+                raise ValueError(f"The FITS file {file.title} does not contain any data.")
+            if file.shape != shape:
+                raise ValueError(
+                    f"The shape of {file.title} {file.shape} does not match "
+                    f"the shape of its masters {shape}.")
+        groups.append((group, dark, flat, shape))
+
+    for group, dark, flat, shape in groups:
+        if shape is None:
+            done += len(group)
+            if progress_callback is not None:
+                progress_callback(done, len(files))
+            continue
+
+        # the masters are converted once per group, not once per frame
+        dark_data = None if dark is None else np.asarray(dark.data, dtype=dtype)
+        flat_data = None if flat is None else np.asarray(flat.data, dtype=dtype)
+
+        for file in group:
+            # frames already in memory in the working precision are not copied
+            in_place = file.materialized and file.data.dtype == dtype
+            data = file.data if in_place else np.empty(shape, dtype=dtype)
+            if dark_data is not None:
+                np.subtract(file.data, dark_data, out=data)
+            if flat_data is not None:
+                np.divide(data if dark_data is not None else file.data, flat_data, out=data)
+
+            if in_place:
+                file.data_changed()
+            else:
+                file.data = data
+            if dark is not None:
+                file.header["HISTORY"] = f"Subtracted dark frame: {dark.title}"
+            if flat is not None:
+                file.header["HISTORY"] = f"Divided by flat frame: {flat.title}"
+            file.modified = True
+
+            num_frames += 1
+            num_bytes += data.nbytes
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, len(files))
+
+    seconds = time.perf_counter() - start_time
+    return {
+        "frames": num_frames,
+        "bytes": num_bytes,
+        "seconds": seconds,
+        "frames_per_second": num_frames / seconds if seconds > 0 else 0.0,
+        "megabytes_per_second": num_bytes / 1024**2 / seconds if seconds > 0 else 0.0,
+    }
+
+def group_frames(files):
+    """Group frames by the masters used to calibrate them.
+
+    Arguments
+    ---------
+    files: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The frames to group.
+
+    Returns
+    -------
+    groups: dict
+    Lists of frames, with (exposure time, filter) as key. The attributes that
+    are missing from a frame are None in its key.
+    """
+    groups = {}
+    for file in files:
+        key = (getattr(file, "exposure_time", None), getattr(file, "filter", None))
+        groups.setdefault(key, []).append(file)
+    return groups
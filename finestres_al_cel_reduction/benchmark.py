@@ -0,0 +1,371 @@
+"""Benchmarks of the reduction steps on synthetic frames."""
+import datetime
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import astropy
+import numpy as np
+
+from finestres_al_cel_reduction.batch_calibration import calibrate_frames
+from finestres_al_cel_reduction.color_fits_file import ColorFitsFile
+from finestres_al_cel_reduction.combine import DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS
+from finestres_al_cel_reduction.compression import OutputCompression
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.master_fits_file import MasterFitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+from finestres_al_cel_reduction.synthetic import SyntheticCamera, write_frame
+
+# Frame sizes and stack depths benchmarked by default
+DEFAULT_SHAPES = [(1024, 1024), (2048, 2048)]
+DEFAULT_DEPTHS = [5, 10]
+
+# The steps of the reduction that are benchmarked
+BENCHMARK_STAGES = [
+    "load", "calibrate", "combine_mean", "combine_median", "color_combine", "save",
+    "save_rice", "save_gzip", "load_saved", "load_rice", "load_gzip"]
+
+# Compressions benchmarked by the save_* and load_* stages, against the
+# uncompressed files of the save and load_saved stages: the default
+# quantized Rice compression and lossless gzip
+BENCHMARK_COMPRESSIONS = {
+    "rice": OutputCompression("rice"),
+    "gzip": OutputCompression("gzip", quantize_level=0),
+}
+
+# Exposure time of the synthetic light frames, in seconds
+BENCHMARK_EXPOSURE_TIME = 60.0
+
+def compare_results(baseline, current):
+    """Compare the results of two benchmark runs.
+
+    Arguments
+    ---------
+    baseline: dict
+    The reference run, as returned by run_benchmarks.
+
+    current: dict
+    The new run, as returned by run_benchmarks.
+
+    Returns
+    -------
+    comparison: list of dict
+    One entry per benchmark found in both runs, with its "stage", "shape" and
+    "depth", and the ratios "time_ratio", "memory_ratio" and "size_ratio"
+    (of the files written or read, nan if there are none) of the current
+    to the baseline values (below 1 means the current run is better).
+    """
+    def key(result):
+        return result["stage"], tuple(result["shape"]), result["depth"]
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    comparison = []
+    for result in current["results"]:
+        reference = baseline_results.get(key(result))
+        if reference is None:
+            continue
+        comparison.append({
+            "stage": result["stage"],
+            "shape": result["shape"],
+            "depth": result["depth"],
+            "time_ratio": (
+                result["seconds"] / reference["seconds"] if reference["seconds"] > 0 else np.nan),
+            "memory_ratio": (
+                result["peak_bytes"] / reference["peak_bytes"]
+                if reference["peak_bytes"] > 0 else np.nan),
+            "size_ratio": (
+                result["file_bytes"] / reference["file_bytes"]
+                if result.get("file_bytes") and reference.get("file_bytes") else np.nan),
+        })
+    return comparison
+
+def get_metadata():
+    """Get a description of the environment the benchmarks run in.
+
+    Returns
+    -------
+    metadata: dict
+    The date, the versions of Python, numpy and astropy, the machine and the
+    working precision.
+    """
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "astropy": astropy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "precision": get_working_dtype().name,
+    }
+
+def measure(setup, operation, repeats=1):
+    """Measure the time and the peak memory of an operation.
+
+    The operation is timed repeats times and run once more with tracemalloc
+    to measure its peak memory, so tracing does not slow down the timed runs.
+    The setup is run before each run and it is not measured.
+
+    Arguments
+    ---------
+    setup: function
+    Called without arguments, it returns the arguments of the operation as a tuple.
+
+    operation: function
+    The operation to measure.
+
+    repeats: int - Default 1
+    Number of timed runs.
+
+    Returns
+    -------
+    seconds: list of float
+    The duration of each timed run.
+
+    peak_bytes: int
+    The peak memory allocated by the operation, in bytes.
+    """
+    seconds = []
+    for _ in range(repeats):
+        arguments = setup()
+        start = time.perf_counter()
+        operation(*arguments)
+        seconds.append(time.perf_counter() - start)
+        del arguments
+
+    arguments = setup()
+    tracemalloc.start()
+    try:
+        operation(*arguments)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+def run_benchmark(folder, shape, depth, stages=None, repeats=1,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS):
+    """Benchmark the reduction steps for a frame size and a stack depth.
+
+    Arguments
+    ---------
+    folder: str
+    Folder where the synthetic frames and the products are written.
+
+    shape: tuple of int
+    The (rows, columns) of the frames.
+
+    depth: int
+    Number of frames stacked.
+
+    stages: list of str or None - Default None
+    The stages to benchmark, from BENCHMARK_STAGES. If None, all of them.
+
+    repeats: int - Default 1
+    Number of timed runs of each stage.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    Returns
+    -------
+    results: list of dict
+    One entry per stage, with the "stage", "shape" and "depth", the best and
+    all "seconds" of the timed runs, the "peak_bytes", the throughput in
+    "megapixels_per_second" and, for the stages that save or load files, the
+    "file_bytes" written or read (None for the other stages).
+
+    Raises
+    ------
+    ValueError: If a stage is not valid.
+    """
+    if stages is None:
+        stages = BENCHMARK_STAGES
+    for stage in stages:
+        if stage not in BENCHMARK_STAGES:
+            raise ValueError(
+                f"Invalid benchmark stage '{stage}'. Valid stages are: {BENCHMARK_STAGES}.")
+
+    os.makedirs(folder, exist_ok=True)
+    camera = SyntheticCamera(shape)
+    light_filenames = []
+    for index in range(depth):
+        filename = os.path.join(folder, f"light_{index:03d}.fits")
+        write_frame(filename, *camera.light_frame("R", BENCHMARK_EXPOSURE_TIME))
+        light_filenames.append(filename)
+    master_dark_filename = os.path.join(folder, "master_dark.fits")
+    write_frame(master_dark_filename, *camera.dark_frame(BENCHMARK_EXPOSURE_TIME))
+    master_flat_filename = os.path.join(folder, "master_flat.fits")
+    flat, header = camera.flat_frame("R")
+    write_frame(master_flat_filename, flat / np.max(flat), header)
+
+    def get_saved_filenames(compression):
+        return [
+            os.path.join(folder, f"saved_{compression}_{index:03d}.fits")
+            for index in range(depth)]
+
+    def load_lights():
+        return [FitsFile(filename) for filename in light_filenames]
+
+    def load_saved(compression):
+        def operation():
+            return [FitsFile(filename) for filename in get_saved_filenames(compression)]
+        return operation
+
+    def load_masters():
+        return (
+            {BENCHMARK_EXPOSURE_TIME: FitsFile(master_dark_filename)},
+            {"R": FitsFile(master_flat_filename)})
+
+    def combine(average):
+        def operation(lights):
+            MasterFitsFile(
+                os.path.join(folder, "master_stack.fits"), lights, average=average,
+                memory_budget=memory_budget, workers=workers)
+        return operation
+
+    def save(compression="none"):
+        def operation(lights):
+            for file, filename in zip(lights, get_saved_filenames(compression)):
+                file.save(filename, compression=BENCHMARK_COMPRESSIONS.get(compression))
+        return operation
+
+    def save_once(compression):
+        # the files loaded by the load_* stages
+        def setup():
+            if not all(os.path.exists(name) for name in get_saved_filenames(compression)):
+                save(compression)(load_lights())
+            return ()
+        return setup
+
+    benchmarks = {
+        "load": (lambda: (), load_lights),
+        "calibrate": (lambda: (load_lights(), *load_masters()), calibrate_frames),
+        "combine_mean": (lambda: (load_lights(),), combine("mean")),
+        "combine_median": (lambda: (load_lights(),), combine("median")),
+        "color_combine": (
+            lambda: tuple(load_lights()[:1] * 3),
+            lambda red, green, blue: ColorFitsFile(
+                os.path.join(folder, "color_stack.fits"), red, green, blue, np.eye(3),
+                memory_budget=memory_budget)),
+        "save": (lambda: (load_lights(),), save()),
+        "save_rice": (lambda: (load_lights(),), save("rice")),
+        "save_gzip": (lambda: (load_lights(),), save("gzip")),
+        "load_saved": (save_once("none"), load_saved("none")),
+        "load_rice": (save_once("rice"), load_saved("rice")),
+        "load_gzip": (save_once("gzip"), load_saved("gzip")),
+    }
+
+    # pixels processed by each stage
+    num_pixels = shape[0] * shape[1]
+    stage_pixels = {
+        "load": depth * num_pixels,
+        "calibrate": depth * num_pixels,
+        "combine_mean": depth * num_pixels,
+        "combine_median": depth * num_pixels,
+        "color_combine": 3 * num_pixels,
+        "save": depth * num_pixels,
+        "save_rice": depth * num_pixels,
+        "save_gzip": depth * num_pixels,
+        "load_saved": depth * num_pixels,
+        "load_rice": depth * num_pixels,
+        "load_gzip": depth * num_pixels,
+    }
+
+    # files written or read by each stage, their size is reported
+    stage_files = {
+        "load": light_filenames,
+        "save": get_saved_filenames("none"),
+        "save_rice": get_saved_filenames("rice"),
+        "save_gzip": get_saved_filenames("gzip"),
+        "load_saved": get_saved_filenames("none"),
+        "load_rice": get_saved_filenames("rice"),
+        "load_gzip": get_saved_filenames("gzip"),
+    }
+
+    results = []
+    for stage in stages:
+        setup, operation = benchmarks[stage]
+        seconds, peak_bytes = measure(setup, operation, repeats=repeats)
+        file_bytes = None
+        if stage in stage_files:
+            file_bytes = sum(os.path.getsize(filename) for filename in stage_files[stage])
+        results.append({
+            "stage": stage,
+            "shape": list(shape),
+            "depth": depth,
+            "seconds": min(seconds),
+            "all_seconds": seconds,
+            "peak_bytes": peak_bytes,
+            "megapixels_per_second": stage_pixels[stage] / 1e6 / min(seconds),
+            "file_bytes": file_bytes,
+        })
+    return results
+
+def run_benchmarks(shapes=None, depths=None, stages=None, repeats=1, folder=None,
+                   memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                   progress_callback=None):
+    """Benchmark the reduction steps across frame sizes and stack depths.
+
+    Arguments
+    ---------
+    shapes: list of tuple of int or None - Default None
+    The (rows, columns) of the frames. If None, DEFAULT_SHAPES.
+
+    depths: list of int or None - Default None
+    Numbers of frames stacked. If None, DEFAULT_DEPTHS.
+
+    stages: list of str or None - Default None
+    The stages to benchmark, from BENCHMARK_STAGES. If None, all of them.
+
+    repeats: int - Default 1
+    Number of timed runs of each stage.
+
+    folder: str or None - Default None
+    Folder where the synthetic frames are written. If None, a temporary
+    folder is used and removed afterwards.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) after each frame
+    size and stack depth.
+
+    Returns
+    -------
+    benchmarks: dict
+    The "metadata" of the run (see get_metadata) and its "results" (see
+    run_benchmark). It can be saved as JSON and compared with compare_results.
+
+    Raises
+    ------
+    ValueError: If a stage is not valid.
+    """
+    if shapes is None:
+        shapes = DEFAULT_SHAPES
+    if depths is None:
+        depths = DEFAULT_DEPTHS
+    metadata = get_metadata()
+    metadata.update({
+        "repeats": repeats, "memory_budget": memory_budget, "workers": workers})
+
+    results = []
+    configurations = [(shape, depth) for shape in shapes for depth in depths]
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        for index, (shape, depth) in enumerate(configurations):
+            results += run_benchmark(
+                os.path.join(folder or temporary_folder, f"{shape[0]}x{shape[1]}_{depth}"),
+                shape, depth, stages=stages, repeats=repeats,
+                memory_budget=memory_budget, workers=workers)
+            if progress_callback is not None:
+                progress_callback(index + 1, len(configurations))
+
+    return {"metadata": metadata, "results": results}
@@ -0,0 +1,113 @@
+"""Fits file class for handling FITS files in the application."""
+import copy
+
+import numpy as np
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+class CalibratedFitsFile(FitsFile):
+    """Class representing an exposure calibrated when its pixels are read.
+
+    The dark is subtracted from (and the flat divides) each strip of rows as
+    it is read, so many exposures can be combined after calibrating them
+    (see finestres_al_cel_reduction.combine.combine_exposures) without
+    keeping any of them in memory. The original exposure is left unchanged.
+    """
+
+    # the calibrated data is computed when it is first accessed
+    header_only = True
+
+    def __init__(self, source, dark=None, flat=None):
+        """Initialize the CalibratedFitsFile instance.
+
+        Arguments
+        ---------
+        source: finestres_al_cel_reduction.fits_file.FitsFile
+        The original exposure.
+
+        dark: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+        The master dark subtracted from the exposure. If None, no dark is subtracted.
+
+        flat: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+        The master flat dividing the exposure. If None, no flat is divided.
+
+        Raises
+        ------
+        ValueError:
+        - If the source is not an image
+        - If the shape of a master does not match the shape of the source
+        """
+        if not isinstance(source, FitsFile) or source.type != "IMAGE":
+            raise ValueError("The source of a calibrated file must be an image.")
+        for master in (dark, flat):
+            if master is not None and master.shape != source.shape:
+                raise ValueError(
+                    f"The shape of {source.title} {source.shape} does not match "
+                    f"the shape of {master.title} {master.shape}.")
+        self.source = source
+        self.dark = dark
+        self.flat = flat
+
+        self.filename = source.filename
+        self.title = source.title
+        self.memmap = False
+
+        self.data = None
+        self.load_data()
+        self.type = source.type
+        for attribute in ("exposure_time", "filter", "image_type"):
+            if hasattr(source, attribute):
+                setattr(self, attribute, getattr(source, attribute))
+
+        self.modified = False
+
+    def load_data(self):
+        """Reset the header from the original exposure."""
+        self.header = copy.deepcopy(self.source.header)
+        if self.dark is not None:
+            self.header["HISTORY"] = f"Subtracted dark frame: {self.dark.title}"
+        if self.flat is not None:
+            self.header["HISTORY"] = f"Divided by flat frame: {self.flat.title}"
+
+    def load_pixels(self):
+        """Compute the full calibrated pixel data."""
+        self.data = self.read_rows(0, self.shape[0])
+
+    def read_rows(self, start, stop):
+        """Read a strip of rows of the calibrated pixel data.
+
+        Arguments
+        ---------
+        start: int
+        First row of the strip.
+
+        stop: int
+        Row after the last row of the strip.
+
+        Returns
+        -------
+        rows: np.ndarray
+        The calibrated pixel data in rows start to stop.
+        """
+        if self._data is not None:
+            return self._data[start:stop]
+
+        rows = np.array(self.source.read_rows(start, stop), dtype=get_working_dtype())
+        if self.dark is not None:
+            rows -= self.dark.read_rows(start, stop)
+        if self.flat is not None:
+            rows /= self.flat.read_rows(start, stop)
+        return rows
+
+    def release_data(self, discard_changes=False):
+        """Drop the calibrated pixel data and that of the original exposure.
+
+        Arguments
+        ---------
+        discard_changes: bool - Default False
+        If False, files modified since they were last saved keep their data.
+        If True, the modifications are discarded.
+        """
+        super().release_data(discard_changes=discard_changes)
+        self.source.release_data(discard_changes=discard_changes)
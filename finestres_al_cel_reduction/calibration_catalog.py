@@ -0,0 +1,123 @@
+"""Header-only catalog of the FITS files in a calibration folder."""
+import os
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+
+FITS_EXTENSIONS = (".fits", ".fit", ".fits.gz")
+
+class CalibrationCatalog:
+    """Class classifying the FITS files in a folder from their headers.
+
+    Files are opened in header-only mode, so scanning a folder does not read
+    any pixel data. The data of each file is memory-mapped when it is first
+    used, e.g. when a master is built from it.
+    """
+
+    def __init__(self, folder, scan=True, decompression_cache=None):
+        """Initialize the CalibrationCatalog instance.
+
+        Arguments
+        ---------
+        folder: str
+        The folder to scan for FITS files.
+
+        scan: bool - Default True
+        If True, the files already in the folder are classified. Otherwise,
+        the catalog starts empty and files are added with add_file.
+
+        decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+        If not None, the pixel data of the gzipped files scanned is read from
+        decompressed copies in the cache.
+        """
+        self.folder = folder
+        self.decompression_cache = decompression_cache
+
+        # dark and master dark frames are grouped by exposure time,
+        # flat and master flat frames are grouped by filter
+        self.biases = []
+        self.master_biases = []
+        self.darks = {}
+        self.flats = {}
+        self.master_darks = {}
+        self.master_flats = {}
+        self.lights = []
+
+        # list of (filename, reason) for the files that could not be classified
+        self.skipped = []
+
+        if scan:
+            self.scan()
+
+    @property
+    def calibration_filenames(self):
+        """The paths to the calibration frames and masters in the catalog."""
+        return [
+            file.filename
+            for files in (self.biases, self.master_biases,
+                          *self.darks.values(), *self.flats.values(),
+                          *self.master_darks.values(), *self.master_flats.values())
+            for file in files]
+
+    def add_file(self, file):
+        """Classify a FITS file from its header and add it to the catalog.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file to classify.
+
+        Returns
+        -------
+        added: bool
+        True if the file was added to the catalog, False if it was skipped.
+        """
+        if file.type != "IMAGE":
+            return False # Skip non-image files
+        if getattr(file, "exposure_time", None) is None:
+            self.skipped.append((file.filename, f"No exposure time in {file.filename}."))
+            return False
+        image_type = getattr(file, "image_type", None)
+
+        # Bias frames
+        if image_type == "Bias Frame":
+            self.biases.append(file)
+        # Dark frames
+        elif image_type == "Dark Frame":
+            self.darks.setdefault(file.exposure_time, []).append(file)
+        # Flat frames
+        elif image_type == "Flat":
+            filter_name = getattr(file, "filter", None)
+            if filter_name is None:
+                self.skipped.append((file.filename, f"No filter in {file.filename}."))
+                return False
+            self.flats.setdefault(filter_name, []).append(file)
+        # Master bias frames
+        elif image_type == "Master Bias Frame":
+            self.master_biases.append(file)
+        # Master dark frames
+        elif image_type == "Master Dark Frame":
+            self.master_darks.setdefault(file.exposure_time, []).append(file)
+        # Master flat frames
+        elif image_type == "Master Flat":
+            self.master_flats.setdefault(getattr(file, "filter", None), []).append(file)
+        # Light frames
+        elif image_type == "Light Frame":
+            self.lights.append(file)
+        # Unknown image type
+        else:
+            self.skipped.append((
+                file.filename,
+                f"Unknown image type '{image_type}' in {file.filename}."))
+            return False
+
+        return True
+
+    def scan(self):
+        """Scan the folder and classify all the FITS files in it."""
+        for fname in sorted(os.listdir(self.folder)):
+            if fname.lower().endswith(FITS_EXTENSIONS):
+                # Only read the header, pixel data is mapped on demand
+                file = FitsFile(
+                    os.path.join(self.folder, fname), header_only=True, memmap=True,
+                    decompression_cache=self.decompression_cache)
+                self.add_file(file)
@@ -3,14 +3,18 @@ from astropy.io import fits
 import numpy as np
 import copy
 
+from finestres_al_cel_reduction.combine import (
+    DEFAULT_MEMORY_BUDGET, VALID_AVERAGE_METHODS,
+    combine_color_channels,
+)
 from finestres_al_cel_reduction.fits_file import FitsFile
-
-VALID_AVERAGE_METHODS = ["mean", "median"]
+from finestres_al_cel_reduction.instrumentation import instrumented
 
 class ColorFitsFile(FitsFile):
     """Class representing a color FITS file, combined from individual exposures."""
 
-    def __init__(self, filename, red_file, green_file, blue_file, weights, average="mean"):
+    def __init__(self, filename, red_file, green_file, blue_file, weights, average="mean",
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
         """Initialize the FitsFile instance.
         
         Arguments
@@ -27,11 +31,17 @@ class ColorFitsFile(FitsFile):
         blue_file: FitsFile
         The blue channel FITS file.
 
-        weights: list of float
-        The weights for each channel in the color combination. Should be a list of three floats.
+        weights: array-like
+        The 3x3 colour matrix. Rows are the output channels (R, G, B) and
+        columns the input channels (R, G, B).
 
         average: str - Default "mean"
-        The method used to combine the individual exposures. Can be "mean" or "median".
+        The method used to combine the individual exposures. See
+        finestres_al_cel_reduction.combine.VALID_AVERAGE_METHODS.
+
+        memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+        Approximate maximum number of bytes used, on top of the colour image,
+        while combining the channels.
 
         Raises
         -------
@@ -57,6 +67,7 @@ class ColorFitsFile(FitsFile):
         self.blue_file = blue_file
     
         self.weights = weights
+        self.memory_budget = memory_budget
 
         self.filename = filename
         self.title = self.filename.split("/")[-1]  # Get the file name from the path
@@ -66,6 +77,7 @@ class ColorFitsFile(FitsFile):
         self.type = None
         self.combine_individual_exposures()
 
+    @instrumented("color_combine")
     def combine_individual_exposures(self):
         """Combine individual exposure FITS files into a master.
         List of individual exposure FITS files to combine.
@@ -74,32 +86,16 @@ class ColorFitsFile(FitsFile):
         -------
         ValueError: 
         - if the average method is not valid
+        - if the channels do not have the same shape
+        - if the colour matrix is not 3x3
         """    
         self.type = "COLOR IMAGE"
         self.image_type = "Color Stack"
         self.exposure_time = np.nan
         
-        # Get data arrays
-        red = self.red_file.data
-        green = self.green_file.data
-        blue = self.blue_file.data
-
-        # Check that all arrays have the same shape
-        if red.shape != green.shape or red.shape != blue.shape:
-            raise ValueError("Red, green, and blue images must have the same shape.")
-
-        # Apply weights (self.weights is a 3x3 matrix)
-        # weights: rows = output channels (R,G,B), cols = input channels (R,G,B)
-        # For standard RGB, this is the identity matrix.
-        weighted = []
-        for index in range(3):
-            # self.weights[index] is the weights for output channel index
-            channel = (
-                self.weights[index][0] * red +
-                self.weights[index][1] * green +
-                self.weights[index][2] * blue
-            )
-            weighted.append(channel)
-        # Stack into a 3D array (height, width, 3)
-        self.data = np.stack(weighted, axis=-1)
-
+        # self.weights is a 3x3 matrix with rows = output channels (R,G,B)
+        # and cols = input channels (R,G,B). For standard RGB, this is the
+        # identity matrix.
+        self.data = combine_color_channels(
+            self.red_file, self.green_file, self.blue_file, self.weights,
+            memory_budget=self.memory_budget)
@@ -0,0 +1,483 @@
+"""Combination of individual exposures into a single image."""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+
+import numpy as np
+
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+VALID_AVERAGE_METHODS = ["mean", "median", "sigma_clip", "minmax"]
+
+# Default parameters of the rejection methods
+SIGMA_CLIP_SIGMA = 3.0
+SIGMA_CLIP_MAX_ITERS = 5
+MINMAX_NUM_LOW = 1
+MINMAX_NUM_HIGH = 1
+
+# Default memory budget (in bytes) used while combining exposures
+DEFAULT_MEMORY_BUDGET = 1024**3
+
+# Memory used to combine a strip with each method, measured with tracemalloc.
+# STRIP_COPIES is the number of arrays the size of the stack of strips (the
+# stack itself plus the temporaries: numpy's nanmean and nanmedian copy it,
+# the rejection methods work in place, see minmax_rejected_mean and
+# sigma_clipped_mean). COMBINED_COPIES is the number of arrays the size of
+# the combined strip (counts, means, indices...), which matter for few exposures
+STRIP_COPIES = {"mean": 3, "median": 5, "sigma_clip": 3, "minmax": 2}
+COMBINED_COPIES = {"mean": 2, "median": 6, "sigma_clip": 5, "minmax": 4}
+
+# Default number of worker processes used to combine exposures
+DEFAULT_WORKERS = 1
+
+# Start method of the worker processes. The pool is created from the worker
+# threads of the graphical interface, and forking a multithreaded process
+# can deadlock the child on locks held by the other threads
+PROCESS_START_METHOD = "spawn"
+
+# process pools used to combine exposures, with the number of workers as key
+# (see get_process_pool)
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+def combine_color_channels(red_file, green_file, blue_file, weights,
+                           memory_budget=DEFAULT_MEMORY_BUDGET, out=None):
+    """Combine three exposures into a colour image with a colour matrix.
+
+    The channels are combined in strips of rows. For every strip, the rows
+    of each exposure are read into a (rows, columns, 3) buffer, which is
+    multiplied by the transposed colour matrix directly into the output, so
+    no full-size temporaries are created. The output may have any memory
+    layout (e.g. a transposed view).
+
+    Arguments
+    ---------
+    red_file: finestres_al_cel_reduction.fits_file.FitsFile
+    The red channel exposure.
+
+    green_file: finestres_al_cel_reduction.fits_file.FitsFile
+    The green channel exposure.
+
+    blue_file: finestres_al_cel_reduction.fits_file.FitsFile
+    The blue channel exposure.
+
+    weights: array-like
+    3x3 colour matrix. Rows are the output channels (R, G, B) and columns
+    the input channels (R, G, B).
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used to combine a strip.
+
+    out: np.ndarray or None - Default None
+    Array of shape (rows, columns, 3) where the colour image is written,
+    e.g. a np.memmap for images that do not fit in memory. If None, a new
+    array in the working precision is created.
+
+    Returns
+    -------
+    data: np.ndarray
+    The colour image, with shape (rows, columns, 3).
+
+    Raises
+    ------
+    ValueError:
+    - if the exposures do not have the same shape
+    - if the colour matrix is not 3x3
+    - if out does not have the shape of the colour image
+    """
+    shape = red_file.shape
+    if green_file.shape != shape or blue_file.shape != shape:
+        raise ValueError("Red, green, and blue images must have the same shape.")
+    dtype = get_working_dtype() if out is None else out.dtype
+    weights = np.asarray(weights, dtype=dtype)
+    if weights.shape != (3, 3):
+        raise ValueError(f"The colour matrix must be 3x3, got shape {weights.shape}.")
+    if out is None:
+        out = np.empty(shape + (3,), dtype=dtype)
+    elif out.shape != shape + (3,):
+        raise ValueError(
+            f"The output must have shape {shape + (3,)}, got shape {out.shape}.")
+
+    rows_per_strip = get_rows_per_strip(shape, 3, memory_budget)
+    strips = np.empty((rows_per_strip,) + shape[1:] + (3,), dtype=dtype)
+    for start in range(0, shape[0], rows_per_strip):
+        stop = min(start + rows_per_strip, shape[0])
+        strip = strips[:stop - start]
+        for index, item in enumerate((red_file, green_file, blue_file)):
+            strip[..., index] = item.read_rows(start, stop)
+        # a single (rows, columns, 3) x (3, 3) product, written in place into the
+        # output. It is not reshaped, which would copy non-contiguous outputs
+        np.matmul(strip, weights.T, out=out[start:stop])
+
+    return out
+
+def combine_exposures(individual_exposures, average="mean", memory_budget=DEFAULT_MEMORY_BUDGET,
+                      workers=DEFAULT_WORKERS):
+    """Combine the pixel data of individual exposures.
+
+    The exposures are combined in strips of rows. For every strip, only the
+    corresponding rows of each exposure are read, so the memory used is
+    bounded by the budget and not by the number of exposures. Each pixel is
+    combined independently, so the result is the same as combining the full
+    stack at once.
+
+    Arguments
+    ---------
+    individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+    List of individual exposure FITS files to combine.
+
+    average: str - Default "mean"
+    The method used to combine the individual exposures. Can be "mean",
+    "median", "sigma_clip" (iterative sigma-clipped mean) or "minmax" (mean
+    after rejecting the lowest and highest values).
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used to combine a strip.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes. If larger than 1, each strip is split into
+    tiles that are combined in a process pool (see combine_exposures_parallel).
+
+    Returns
+    -------
+    data: np.ndarray
+    The combined data.
+
+    Raises
+    ------
+    ValueError:
+    - if the average method is not valid
+    - if the exposures do not have the same shape
+    """
+    if average not in VALID_AVERAGE_METHODS:
+        raise ValueError(
+            f"Invalid average method '{average}'. "
+            f"Valid methods are: {VALID_AVERAGE_METHODS}.")
+    shape = individual_exposures[0].shape
+    if any(item.shape != shape for item in individual_exposures):
+        raise ValueError("All individual exposures must have the same shape.")
+
+    rows_per_strip = get_rows_per_strip(
+        shape, len(individual_exposures), memory_budget, average=average)
+    if workers > 1:
+        return combine_exposures_parallel(
+            individual_exposures, average, rows_per_strip, workers)
+
+    dtype = get_working_dtype()
+    data = np.empty(shape, dtype=dtype)
+    for start in range(0, shape[0], rows_per_strip):
+        stop = min(start + rows_per_strip, shape[0])
+        strips = np.empty((len(individual_exposures), stop - start) + shape[1:], dtype=dtype)
+        for index, item in enumerate(individual_exposures):
+            strips[index] = item.read_rows(start, stop)
+        data[start:stop] = combine_strips(strips, average)
+
+    return data
+
+def combine_exposures_parallel(individual_exposures, average, rows_per_strip, workers):
+    """Combine the pixel data of individual exposures in a process pool.
+
+    Strips are read in this process into a shared memory block. Each strip
+    is split into tiles of rows, one per worker, and the workers write the
+    combined tiles into a shared strip-sized output block, which is copied
+    into the combined data. Pixel data is therefore never pickled to or from
+    the workers. The pool is reused by later calls (see get_process_pool).
+
+    Arguments
+    ---------
+    individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+    List of individual exposure FITS files to combine.
+
+    average: str
+    The method used to combine the individual exposures. See VALID_AVERAGE_METHODS.
+
+    rows_per_strip: int
+    Number of rows read and combined at once.
+
+    workers: int
+    Number of worker processes.
+
+    Returns
+    -------
+    data: np.ndarray
+    The combined data.
+    """
+    shape = individual_exposures[0].shape
+    strips_shape = (len(individual_exposures), rows_per_strip) + shape[1:]
+    dtype = get_working_dtype()
+    itemsize = dtype.itemsize
+    executor = get_process_pool(workers)
+
+    data = np.empty(shape, dtype=dtype)
+    strips_memory = shared_memory.SharedMemory(
+        create=True, size=itemsize * int(np.prod(strips_shape)))
+    combined_memory = shared_memory.SharedMemory(
+        create=True, size=itemsize * int(np.prod(strips_shape[1:])))
+    try:
+        strips = np.ndarray(strips_shape, dtype=dtype, buffer=strips_memory.buf)
+        combined = np.ndarray(strips_shape[1:], dtype=dtype, buffer=combined_memory.buf)
+        for start in range(0, shape[0], rows_per_strip):
+            stop = min(start + rows_per_strip, shape[0])
+            for index, item in enumerate(individual_exposures):
+                strips[index, :stop - start] = item.read_rows(start, stop)
+
+            tile_edges = np.linspace(0, stop - start, min(workers, stop - start) + 1, dtype=int)
+            futures = [
+                executor.submit(
+                    _combine_shared_tile, strips_memory.name, strips_shape,
+                    combined_memory.name, dtype.str, tile_start, tile_stop, average)
+                for tile_start, tile_stop in zip(tile_edges[:-1], tile_edges[1:])
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except BrokenProcessPool:
+                # a worker died, the next call starts a new pool
+                discard_process_pool(executor)
+                raise
+            data[start:stop] = combined[:stop - start]
+    finally:
+        # views must be released before the shared memory can be closed
+        strips = None
+        combined = None
+        strips_memory.close()
+        strips_memory.unlink()
+        combined_memory.close()
+        combined_memory.unlink()
+
+    return data
+
+def _combine_shared_tile(strips_name, strips_shape, combined_name, dtype,
+                         tile_start, tile_stop, average):
+    """Combine a tile of a strip stored in shared memory.
+
+    This is run by the workers of combine_exposures_parallel.
+
+    Arguments
+    ---------
+    strips_name: str
+    Name of the shared memory block holding the strips.
+
+    strips_shape: tuple of int
+    Shape of the strips array. The combined strip has shape strips_shape[1:].
+
+    combined_name: str
+    Name of the shared memory block holding the combined strip.
+
+    dtype: str
+    Floating point type of both shared memory blocks. It is passed explicitly
+    because worker processes do not share the working precision of the session.
+
+    tile_start: int
+    First row of the tile within the strip.
+
+    tile_stop: int
+    Row after the last row of the tile within the strip.
+
+    average: str
+    The method used to combine the strips. See VALID_AVERAGE_METHODS.
+    """
+    strips_memory = shared_memory.SharedMemory(name=strips_name)
+    combined_memory = shared_memory.SharedMemory(name=combined_name)
+    try:
+        strips = np.ndarray(strips_shape, dtype=dtype, buffer=strips_memory.buf)
+        combined = np.ndarray(strips_shape[1:], dtype=dtype, buffer=combined_memory.buf)
+        combined[tile_start:tile_stop] = combine_strips(
+            strips[:, tile_start:tile_stop], average)
+    finally:
+        strips = None
+        combined = None
+        strips_memory.close()
+        combined_memory.close()
+
+def combine_strips(strips, average):
+    """Combine a stack of strips along the exposure axis.
+
+    Arguments
+    ---------
+    strips: np.ndarray
+    Array with the strips of each exposure along the first axis. It may be
+    modified by the rejection methods.
+
+    average: str
+    The method used to combine the strips. See VALID_AVERAGE_METHODS.
+
+    Returns
+    -------
+    combined: np.ndarray
+    The combined strip.
+    """
+    if average == "mean":
+        return np.nanmean(strips, axis=0)
+    if average == "median":
+        return np.nanmedian(strips, axis=0)
+    if average == "sigma_clip":
+        return sigma_clipped_mean(strips)
+    if average == "minmax":
+        return minmax_rejected_mean(strips)
+    # this should never happen as we check the average method before
+    raise ValueError( # pragma: no cover
+        f"Invalid average method '{average}'. Valid methods are: {VALID_AVERAGE_METHODS}.")
+
+def discard_process_pool(executor):
+    """Shut down a process pool and stop reusing it.
+
+    Arguments
+    ---------
+    executor: concurrent.futures.ProcessPoolExecutor
+    The pool, returned by get_process_pool.
+    """
+    with _process_pools_lock:
+        for workers, pool in list(_process_pools.items()):
+            if pool is executor:
+                del _process_pools[workers]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def get_process_pool(workers):
+    """Get the process pool used to combine exposures with a number of workers.
+
+    Starting the worker processes takes a noticeable time with the spawn
+    start method, so the pool is created on first use and reused by every
+    combine of the session (e.g. all the masters and stacks of a run).
+
+    Arguments
+    ---------
+    workers: int
+    Number of worker processes.
+
+    Returns
+    -------
+    executor: concurrent.futures.ProcessPoolExecutor
+    The pool.
+    """
+    with _process_pools_lock:
+        if workers not in _process_pools:
+            _process_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+        return _process_pools[workers]
+
+def get_rows_per_strip(shape, num_exposures, memory_budget, average=None):
+    """Compute the number of rows to combine at once within a memory budget.
+
+    Arguments
+    ---------
+    shape: tuple of int
+    Shape of each exposure.
+
+    num_exposures: int
+    Number of exposures combined.
+
+    memory_budget: int
+    Approximate maximum number of bytes used to combine a strip.
+
+    average: str or None - Default None
+    The method used to combine the strips, which sets the number of
+    strip-sized arrays used (see STRIP_COPIES and COMBINED_COPIES). If
+    None, only the strips themselves are counted.
+
+    Returns
+    -------
+    rows_per_strip: int
+    Number of rows per strip. At least one row is always combined.
+    """
+    row_bytes = get_working_dtype().itemsize * int(np.prod(shape[1:]))
+    copies = num_exposures
+    if average is not None:
+        copies = STRIP_COPIES[average] * num_exposures + COMBINED_COPIES[average]
+    rows_per_strip = memory_budget // (copies * row_bytes)
+    return int(min(max(rows_per_strip, 1), shape[0]))
+
+def minmax_rejected_mean(strips, num_low=MINMAX_NUM_LOW, num_high=MINMAX_NUM_HIGH):
+    """Average a stack of strips after rejecting the extreme values of each pixel.
+
+    Values are rejected one at a time for all pixels at once. The rejected
+    and NaN values are overwritten in place, with +inf while the lowest
+    values are searched and with -inf while the highest ones are, so no
+    strip-sized temporary is allocated. Pixels with no more valid values
+    than the number of rejections end up as NaN.
+
+    Arguments
+    ---------
+    strips: np.ndarray
+    Array with the strips of each exposure along the first axis. Modified in place.
+
+    num_low: int - Default MINMAX_NUM_LOW
+    Number of lowest values rejected for each pixel.
+
+    num_high: int - Default MINMAX_NUM_HIGH
+    Number of highest values rejected for each pixel.
+
+    Returns
+    -------
+    combined: np.ndarray
+    The combined strip.
+    """
+    nan_mask = np.isnan(strips)
+    np.copyto(strips, np.inf, where=nan_mask)
+    for _ in range(num_low):
+        # argmin along the first axis would copy the strips, the first
+        # exposure equal to the minimum is the same value
+        index = (strips == strips.min(axis=0)).argmax(axis=0)[np.newaxis]
+        np.put_along_axis(strips, index, np.inf, axis=0)
+        np.put_along_axis(nan_mask, index, True, axis=0)
+    np.copyto(strips, -np.inf, where=nan_mask)
+    for _ in range(num_high):
+        index = (strips == strips.max(axis=0)).argmax(axis=0)[np.newaxis]
+        np.put_along_axis(strips, index, -np.inf, axis=0)
+        np.put_along_axis(nan_mask, index, True, axis=0)
+
+    count = len(strips) - np.sum(nan_mask, axis=0)
+    np.copyto(strips, 0.0, where=nan_mask)
+    total = np.sum(strips, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / count
+
+def sigma_clipped_mean(strips, sigma=SIGMA_CLIP_SIGMA, max_iters=SIGMA_CLIP_MAX_ITERS):
+    """Average a stack of strips with iterative sigma clipping.
+
+    At each iteration, the mean and standard deviation of the values kept for
+    each pixel are computed, and values further than sigma standard
+    deviations from the mean are rejected. Iterations stop when no value is
+    rejected or after max_iters iterations. All pixels are processed at once.
+    The rejected and NaN values are set to 0 in place, and the deviations
+    are computed in a single reused buffer.
+
+    Arguments
+    ---------
+    strips: np.ndarray
+    Array with the strips of each exposure along the first axis. Modified in place.
+
+    sigma: float - Default SIGMA_CLIP_SIGMA
+    Rejection threshold, in units of the standard deviation.
+
+    max_iters: int - Default SIGMA_CLIP_MAX_ITERS
+    Maximum number of clipping iterations.
+
+    Returns
+    -------
+    combined: np.ndarray
+    The combined strip.
+    """
+    keep = ~np.isnan(strips)
+    np.copyto(strips, 0.0, where=~keep)
+    deviation = np.empty_like(strips)
+    reject = np.empty_like(keep)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iters):
+            count = np.sum(keep, axis=0)
+            mean = np.sum(strips, axis=0) / count
+            np.subtract(strips, mean, out=deviation)
+            deviation *= keep
+            # sum of squares without a temporary for the squares
+            std = np.sqrt(np.einsum("i...,i...->...", deviation, deviation) / count)
+            np.abs(deviation, out=deviation)
+            np.greater(deviation, sigma * std, out=reject)
+            if not reject.any():
+                break
+            keep &= ~reject
+            strips[reject] = 0.0
+
+        return np.sum(strips, axis=0) / np.sum(keep, axis=0)
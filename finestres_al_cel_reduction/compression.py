@@ -0,0 +1,111 @@
+"""Tile compression of the FITS files written by the reduction."""
+from astropy.io import fits
+
+VALID_COMPRESSIONS = ["none", "rice", "gzip"]
+
+# FITS tile compression algorithm of each method. GZIP_2 shuffles the bytes
+# of each pixel before compressing them, which compresses floating point
+# data better than GZIP_1
+COMPRESSION_TYPES = {"rice": "RICE_1", "gzip": "GZIP_2"}
+
+VALID_DITHERS = ["none", "subtractive", "subtractive_zero"]
+
+# FITS quantization method of each dither. "subtractive_zero" dithers like
+# "subtractive" but keeps the pixels that are exactly zero
+DITHER_METHODS = {"none": -1, "subtractive": 1, "subtractive_zero": 2}
+
+# Default quantization level of floating point data. Pixels are rounded to
+# a step of the noise of each tile divided by this level, larger levels keep
+# more precision and compress less
+DEFAULT_QUANTIZE_LEVEL = 16.0
+
+class OutputCompression:
+    """Class describing how the FITS files of a reduction step are compressed.
+
+    Compressed files are tile compressed (see astropy.io.fits.CompImageHDU):
+    the image is stored in the first extension, row by row, so strips of
+    rows can still be read without decompressing the whole image.
+    """
+
+    def __init__(self, method="none", quantize_level=DEFAULT_QUANTIZE_LEVEL,
+                 dither="subtractive"):
+        """Initialize the OutputCompression instance.
+
+        Arguments
+        ---------
+        method: str - Default "none"
+        The compression method. Can be "none" (uncompressed), "rice" or "gzip".
+
+        quantize_level: float - Default DEFAULT_QUANTIZE_LEVEL
+        Quantization level of floating point data. Positive values are
+        relative to the noise of each tile and negative values are absolute
+        steps. 0 disables quantization, so the compression is lossless; it
+        is only allowed with "gzip". Integer data is always stored losslessly.
+
+        dither: str - Default "subtractive"
+        The dither applied before quantizing floating point data. Can be
+        "none", "subtractive" or "subtractive_zero".
+
+        Raises
+        ------
+        ValueError:
+        - If the method is not valid
+        - If the dither is not valid
+        - If lossless compression is requested with "rice"
+        """
+        if method not in VALID_COMPRESSIONS:
+            raise ValueError(
+                f"Invalid compression '{method}'. "
+                f"Valid compressions are: {VALID_COMPRESSIONS}.")
+        if dither not in VALID_DITHERS:
+            raise ValueError(
+                f"Invalid dither '{dither}'. Valid dithers are: {VALID_DITHERS}.")
+        if method == "rice" and quantize_level == 0:
+            raise ValueError(
+                "Rice compression of floating point data needs quantization, "
+                "use gzip for lossless compression.")
+        self.method = method
+        self.quantize_level = float(quantize_level)
+        self.dither = dither
+
+    def __repr__(self):
+        return (
+            f"OutputCompression(method={self.method!r}, "
+            f"quantize_level={self.quantize_level}, dither={self.dither!r})")
+
+    @property
+    def compressed(self):
+        """True if the files are compressed."""
+        return self.method != "none"
+
+    def make_hdul(self, data, header):
+        """Create the HDU list of a FITS file.
+
+        Arguments
+        ---------
+        data: np.ndarray or None
+        The pixel data.
+
+        header: astropy.io.fits.Header or None
+        The header of the image.
+
+        Returns
+        -------
+        hdul: astropy.io.fits.HDUList
+        A primary HDU with the image if the files are not compressed.
+        Otherwise, an empty primary HDU and the compressed image.
+        """
+        if not self.compressed or data is None:
+            return fits.HDUList([fits.PrimaryHDU(data=data, header=header)])
+        # one tile per row, so strips of rows are decompressed independently
+        tile_shape = (1,) + data.shape[1:]
+        return fits.HDUList([
+            fits.PrimaryHDU(),
+            fits.CompImageHDU(
+                data=data,
+                header=header,
+                compression_type=COMPRESSION_TYPES[self.method],
+                tile_shape=tile_shape,
+                quantize_level=self.quantize_level,
+                quantize_method=DITHER_METHODS[self.dither]),
+        ])
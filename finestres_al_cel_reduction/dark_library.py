@@ -0,0 +1,112 @@
+"""Lookup of master darks by exposure time, scaling them when there is no exact match."""
+from finestres_al_cel_reduction.scaled_dark_fits_file import ScaledDarkFitsFile
+
+class DarkLibrary:
+    """Class finding the master dark to calibrate an exposure.
+
+    It can be used wherever a dict of master darks by exposure time is read
+    with get. Master darks matching the exposure time are used as they are.
+    Otherwise, if there is a master bias, the master dark with the closest
+    exposure time is scaled (see ScaledDarkFitsFile), so one master dark can
+    be used for all exposure times. Scaled darks are kept for later lookups.
+    """
+
+    def __init__(self, master_darks, master_bias=None):
+        """Initialize the DarkLibrary instance.
+
+        Arguments
+        ---------
+        master_darks: dict
+        Master darks, with the exposure time as key.
+
+        master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+        The master bias. If None, master darks are only used for their own
+        exposure time.
+        """
+        self.master_darks = master_darks
+        self.master_bias = master_bias
+        self.scaled_darks = {}
+
+    def get(self, exposure_time, default=None):
+        """Get the master dark for an exposure time.
+
+        Arguments
+        ---------
+        exposure_time: float
+        The exposure time.
+
+        default: object - Default None
+        Returned if there is no suitable master dark.
+
+        Returns
+        -------
+        dark: finestres_al_cel_reduction.fits_file.FitsFile or object
+        The master dark, scaled if needed, or default.
+
+        Raises
+        ------
+        ValueError: If the master dark cannot be scaled with the master bias.
+        """
+        dark = self.master_darks.get(exposure_time, None)
+        if dark is not None:
+            return dark
+        if exposure_time in self.scaled_darks:
+            return self.scaled_darks[exposure_time]
+
+        source = self.get_source(exposure_time)
+        if source is None:
+            return default
+        dark = ScaledDarkFitsFile(source, self.master_bias, exposure_time)
+        self.scaled_darks[exposure_time] = dark
+        return dark
+
+    def get_filenames(self, exposure_time):
+        """Get the files used to build the master dark for an exposure time.
+
+        Arguments
+        ---------
+        exposure_time: float
+        The exposure time.
+
+        Returns
+        -------
+        filenames: list of str
+        The master dark and, if it is scaled, the master bias. Empty if there
+        is no suitable master dark.
+        """
+        if exposure_time in self.master_darks:
+            return [self.master_darks[exposure_time].filename]
+        source = self.get_source(exposure_time)
+        if source is None:
+            return []
+        return [source.filename, self.master_bias.filename]
+
+    def get_source(self, exposure_time):
+        """Get the master dark scaled for an exposure time without a master dark.
+
+        The master dark with the closest exposure time is chosen, the longest
+        one in case of a tie since its dark current is less noisy.
+
+        Arguments
+        ---------
+        exposure_time: float
+        The exposure time.
+
+        Returns
+        -------
+        source: finestres_al_cel_reduction.fits_file.FitsFile or None
+        The master dark, None if there is no master bias, no master dark with
+        a non-zero exposure time or the exposure time is not known.
+        """
+        if self.master_bias is None or exposure_time is None:
+            return None
+        candidates = [
+            dark_exposure_time for dark_exposure_time in self.master_darks
+            if dark_exposure_time]
+        if len(candidates) == 0:
+            return None
+        closest = min(
+            candidates,
+            key=lambda dark_exposure_time: (
+                abs(dark_exposure_time - exposure_time), -dark_exposure_time))
+        return self.master_darks[closest]
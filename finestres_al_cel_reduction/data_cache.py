@@ -0,0 +1,265 @@
+"""Memory-bounded cache of the pixel data of the files open in a session."""
+from collections import OrderedDict
+import logging
+import shutil
+import tempfile
+import threading
+import weakref
+
+# Default maximum number of bytes of pixel data kept in memory
+DEFAULT_DATA_MEMORY_BUDGET = 4 * 1024**3
+
+logger = logging.getLogger(__name__)
+
+class DataCache:
+    """Class keeping the pixel data of the open files within a memory budget.
+
+    Files are kept in order of last access. When the pixel data in memory
+    exceeds the budget, the least recently used files drop their data (see
+    FitsFile.evict_data), which is read again the next time it is accessed.
+    Data that changed since it was read from disk is written to a scratch
+    folder first, so no modification is lost. The most recently used file
+    always keeps its data, even if it is larger than the budget, and so do
+    the files acquired by a task that may modify them (see acquire), as
+    eviction runs on whichever thread accesses pixel data.
+
+    The cache only holds weak references, so files closed elsewhere are
+    released as usual.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_DATA_MEMORY_BUDGET, scratch_folder=None):
+        """Initialize the DataCache instance.
+
+        Arguments
+        ---------
+        memory_budget: int - Default DEFAULT_DATA_MEMORY_BUDGET
+        Maximum number of bytes of pixel data kept in memory.
+
+        scratch_folder: str or None - Default None
+        Folder where the evicted data that changed is written. If None, a
+        temporary folder is created when it is first needed and removed on
+        close.
+
+        Raises
+        ------
+        ValueError: If memory_budget is not positive.
+        """
+        if memory_budget <= 0:
+            raise ValueError(f"The memory budget must be positive, got {memory_budget}.")
+        self.memory_budget = memory_budget
+        self._scratch_folder = scratch_folder
+        self._temporary_folder = None
+        # touch is called on every access to the data, possibly from workers
+        self._lock = threading.RLock()
+        # id of the file -> (weak reference, bytes in memory), least recently used first
+        self._entries = OrderedDict()
+        # id of the file -> number of tasks holding it, these are never evicted
+        self._acquired = {}
+
+    @property
+    def memory_used(self):
+        """Number of bytes of pixel data in memory of the files in the cache."""
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    @property
+    def scratch_folder(self):
+        """Folder where the evicted data that changed is written."""
+        if self._scratch_folder is None:
+            self._temporary_folder = tempfile.mkdtemp(prefix="finestres_al_cel_reduction_")
+            self._scratch_folder = self._temporary_folder
+        return self._scratch_folder
+
+    def acquire(self, files):
+        """Keep the data of files in memory until they are released.
+
+        Every call must be matched by a call to release with the same files.
+
+        Arguments
+        ---------
+        files: list of finestres_al_cel_reduction.fits_file.FitsFile
+        The files.
+        """
+        with self._lock:
+            for file in files:
+                self._acquired[id(file)] = self._acquired.get(id(file), 0) + 1
+
+    def add(self, file):
+        """Add a file to the cache, as the most recently used one.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file.
+        """
+        file.data_cache = self
+        self.update(file)
+
+    def close(self):
+        """Forget all the files and remove the temporary scratch folder."""
+        with self._lock:
+            for reference, _ in self._entries.values():
+                file = reference()
+                if file is not None:
+                    file.data_cache = None
+            self._entries.clear()
+        if self._temporary_folder is not None:
+            shutil.rmtree(self._temporary_folder, ignore_errors=True)
+            self._temporary_folder = None
+            self._scratch_folder = None
+
+    def evict(self, keep=None):
+        """Evict the least recently used data until the cache fits its budget.
+
+        Arguments
+        ---------
+        keep: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+        A file whose data is never evicted. The most recently used file is
+        never evicted either.
+
+        Returns
+        -------
+        freed: int
+        Number of bytes of pixel data evicted.
+        """
+        freed = 0
+        with self._lock:
+            total = self.memory_used
+            # the last entry is the most recently used one
+            for key in list(self._entries)[:-1]:
+                if total <= self.memory_budget:
+                    break
+                reference, nbytes = self._entries[key]
+                file = reference()
+                if (file is None or file is keep or nbytes == 0 or
+                        key in self._acquired):
+                    continue
+                try:
+                    evicted = file.evict_data(self.scratch_folder)
+                except OSError as error:
+                    logger.warning("Could not evict the data of %s: %s", file.title, error)
+                    continue
+                self._entries[key] = (reference, 0)
+                total -= nbytes
+                freed += evicted
+                logger.info("Evicted the data of %s", file.title)
+        return freed
+
+    def evict_file(self, file):
+        """Evict the data of a file, whatever the memory used.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file.
+        """
+        with self._lock:
+            entry = self._entries.get(id(file))
+            if entry is None or entry[0]() is not file or id(file) in self._acquired:
+                return
+            file.evict_data(self.scratch_folder)
+            self._entries[id(file)] = (entry[0], 0)
+
+    def release(self, files):
+        """Allow the data of files kept by acquire to be evicted again.
+
+        The least recently used data is evicted if the cache exceeds its budget.
+
+        Arguments
+        ---------
+        files: list of finestres_al_cel_reduction.fits_file.FitsFile
+        The files.
+        """
+        with self._lock:
+            for file in files:
+                count = self._acquired.get(id(file), 0) - 1
+                if count > 0:
+                    self._acquired[id(file)] = count
+                else:
+                    self._acquired.pop(id(file), None)
+        self.evict()
+
+    def remove(self, file):
+        """Remove a file from the cache. Its data is left as it is.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file.
+        """
+        with self._lock:
+            entry = self._entries.get(id(file))
+            if entry is not None and entry[0]() is file:
+                del self._entries[id(file)]
+                file.data_cache = None
+
+    def set_memory_budget(self, memory_budget):
+        """Change the memory budget, evicting data if needed.
+
+        Arguments
+        ---------
+        memory_budget: int
+        Maximum number of bytes of pixel data kept in memory.
+
+        Raises
+        ------
+        ValueError: If memory_budget is not positive.
+        """
+        if memory_budget <= 0:
+            raise ValueError(f"The memory budget must be positive, got {memory_budget}.")
+        self.memory_budget = memory_budget
+        self.evict()
+
+    def touch(self, file):
+        """Mark a file as the most recently used one.
+
+        This is called every time the pixel data is accessed, so it does not
+        evict anything unless the size of the data changed.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file.
+        """
+        with self._lock:
+            entry = self._entries.get(id(file))
+            if entry is not None and entry[0]() is file and entry[1] == file.loaded_bytes:
+                self._entries.move_to_end(id(file))
+                return
+        self.update(file)
+
+    def update(self, file):
+        """Record the data of a file after it is loaded or replaced.
+
+        The file becomes the most recently used one and the least recently
+        used data is evicted if the cache exceeds its budget.
+
+        Arguments
+        ---------
+        file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file.
+        """
+        key = id(file)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not file:
+                # ids are reused once a file is released
+                reference = weakref.ref(file, lambda _: self._forget(key))
+            else:
+                reference = entry[0]
+            self._entries[key] = (reference, file.loaded_bytes)
+            self._entries.move_to_end(key)
+            self.evict(keep=file)
+
+    def _forget(self, key):
+        """Remove the entry of a released file.
+
+        Arguments
+        ---------
+        key: int
+        The id the file had.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is None:
+                del self._entries[key]
@@ -0,0 +1,227 @@
+"""Size-bounded cache of decompressed copies of gzipped FITS files."""
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+# Default folder where the decompressed copies are kept between sessions
+DEFAULT_SCRATCH_FOLDER = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "finestres_al_cel_reduction", "decompressed")
+
+# Default maximum number of bytes of decompressed copies kept in the scratch folder
+DEFAULT_SCRATCH_SIZE = 10 * 1024**3
+
+# Default number of files decompressed at the same time. zlib releases the
+# GIL while decompressing, so threads run on several cores
+DEFAULT_DECOMPRESSION_WORKERS = min(8, os.cpu_count() or 1)
+
+# Size of the blocks copied from the gzip stream to the decompressed copy
+COPY_BLOCK_SIZE = 16 * 1024**2
+
+logger = logging.getLogger(__name__)
+
+class DecompressionCache:
+    """Class keeping decompressed copies of gzipped FITS files in a scratch folder.
+
+    Decompressed copies can be memory-mapped and read partially, which gzipped
+    files cannot. Copies are named after the path, size and modification time
+    of the original file, so they are reused across sessions and rebuilt if
+    the original file changes. When the copies exceed the size limit, the
+    least recently used ones are removed. The modification time of a copy is
+    updated every time it is used, so the order survives between sessions.
+    Copies used in this session are never removed, as open files may still
+    read from them, so the cache can exceed its size limit while they are
+    in use.
+    """
+
+    def __init__(self, folder=DEFAULT_SCRATCH_FOLDER, max_size=DEFAULT_SCRATCH_SIZE):
+        """Initialize the DecompressionCache instance.
+
+        Arguments
+        ---------
+        folder: str - Default DEFAULT_SCRATCH_FOLDER
+        The scratch folder where the decompressed copies are written. It is
+        created if it does not exist.
+
+        max_size: int - Default DEFAULT_SCRATCH_SIZE
+        Maximum number of bytes of decompressed copies kept in the folder. A
+        copy larger than this is still written.
+
+        Raises
+        ------
+        ValueError: If max_size is not positive.
+        """
+        if max_size <= 0:
+            raise ValueError(f"The cache size must be positive, got {max_size}.")
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        # copies used in this session, they are never evicted
+        self._in_use = set()
+
+    @property
+    def size(self):
+        """Number of bytes of decompressed copies in the scratch folder."""
+        return sum(size for _, _, size in self._list_copies())
+
+    def clear(self):
+        """Remove all the decompressed copies."""
+        with self._lock:
+            for filename, _, _ in self._list_copies():
+                os.remove(filename)
+            self._in_use.clear()
+
+    def evict(self):
+        """Remove the least recently used copies until the cache fits its size limit.
+
+        Copies used in this session are never removed.
+        """
+        with self._lock:
+            copies = sorted(self._list_copies(), key=lambda copy: copy[1])
+            total = sum(size for _, _, size in copies)
+            for filename, _, size in copies:
+                if total <= self.max_size:
+                    break
+                if filename in self._in_use:
+                    continue
+                try:
+                    os.remove(filename)
+                except OSError as error:
+                    logger.warning("Could not remove %s from the cache: %s", filename, error)
+                    continue
+                total -= size
+                logger.info("Removed %s from the cache", os.path.basename(filename))
+
+    def get(self, filename):
+        """Get the path to a decompressed copy of a file.
+
+        The copy is written if it is not in the cache yet, after which the
+        least recently used copies are evicted if needed.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the file.
+
+        Returns
+        -------
+        filename: str
+        The path to the decompressed copy, or the path to the file itself if
+        it is not gzipped.
+        """
+        copy_filename, written = self._get(filename)
+        if written:
+            self.evict()
+        return copy_filename
+
+    def get_copy_filename(self, filename):
+        """Get the path of the decompressed copy of a file, whether it exists or not.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the gzipped file.
+
+        Returns
+        -------
+        filename: str
+        The path to the decompressed copy.
+        """
+        stat = os.stat(filename)
+        content = f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+        key = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        name = os.path.basename(filename)[:-len(".gz")]
+        return os.path.join(self.folder, f"{key}_{name}")
+
+    def prefetch(self, filenames, workers=DEFAULT_DECOMPRESSION_WORKERS):
+        """Decompress several files concurrently.
+
+        Arguments
+        ---------
+        filenames: list of str
+        The paths to the files. Files that are not gzipped are ignored.
+
+        workers: int - Default DEFAULT_DECOMPRESSION_WORKERS
+        Number of files decompressed at the same time.
+
+        Returns
+        -------
+        filenames: list of str
+        The paths to the decompressed copies, see get.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self._get, filenames))
+        # the folder is scanned once, not after every copy
+        if any(written for _, written in results):
+            self.evict()
+        return [copy_filename for copy_filename, _ in results]
+
+    def _get(self, filename):
+        """Get the path to a decompressed copy of a file, writing it if needed.
+
+        The copy is claimed as in use before it is checked, so it cannot be
+        evicted before it is read.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the file.
+
+        Returns
+        -------
+        filename: str
+        The path to the decompressed copy, or the path to the file itself if
+        it is not gzipped.
+
+        written: bool
+        True if the copy was written.
+        """
+        if not filename.lower().endswith(".gz"):
+            return filename, False
+        copy_filename = self.get_copy_filename(filename)
+        with self._lock:
+            self._in_use.add(copy_filename)
+            exists = os.path.exists(copy_filename)
+            if exists:
+                # mark the copy as recently used
+                os.utime(copy_filename)
+        if exists:
+            return copy_filename, False
+
+        # write to a temporary file first, so an interrupted copy is never used
+        handle, temporary_filename = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with gzip.open(filename, "rb") as source, os.fdopen(handle, "wb") as target:
+                shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+            os.replace(temporary_filename, copy_filename)
+        except BaseException:
+            os.remove(temporary_filename)
+            raise
+        logger.info("Decompressed %s", os.path.basename(filename))
+        return copy_filename, True
+
+    def _list_copies(self):
+        """List the decompressed copies in the scratch folder.
+
+        Returns
+        -------
+        copies: list of tuple
+        The (filename, last use time, size) of each copy.
+        """
+        copies = []
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed by another session
+                continue
+            copies.append((entry.path, stat.st_mtime, stat.st_size))
+        return copies
@@ -0,0 +1,44 @@
+"""Fast statistics used to scale the display of images."""
+import numpy as np
+
+# Maximum number of pixels used to estimate the display percentiles. The
+# standard error of an estimated percentile p is sqrt(p (1 - p) / n) in rank,
+# i.e. below 0.1 percentile points for this number of samples
+DEFAULT_MAX_SAMPLES = 2**18
+
+# Weights of the red, green and blue channels in the luminance of a colour image
+LUMINANCE_WEIGHTS = (0.299, 0.587, 0.114)
+
+def estimate_percentiles(data, percentiles, max_samples=DEFAULT_MAX_SAMPLES):
+    """Estimate percentiles of an image from a regular subsample of its pixels.
+
+    The image is sampled with the same stride along both axes, so the cost
+    does not depend on its size, and the estimate is deterministic. For
+    colour images, the percentiles of the luminance are computed.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image, with shape (rows, columns) or (rows, columns, 3) for colour images.
+
+    percentiles: tuple of float
+    The percentiles to estimate, between 0 and 100.
+
+    max_samples: int - Default DEFAULT_MAX_SAMPLES
+    Maximum number of pixels sampled.
+
+    Returns
+    -------
+    values: tuple of float
+    The estimated percentiles, NaN if the image has no finite pixels.
+    """
+    num_pixels = data.shape[0] * data.shape[1]
+    stride = max(int(np.ceil(np.sqrt(num_pixels / max_samples))), 1)
+    sample = np.asarray(data[::stride, ::stride], dtype=float)
+    if sample.ndim == 3 and sample.shape[-1] == 3:
+        sample = sample @ np.asarray(LUMINANCE_WEIGHTS)
+
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return tuple(np.nan for _ in percentiles)
+    return tuple(float(value) for value in np.percentile(sample, percentiles))
@@ -1,20 +1,80 @@
 """Fits file class for handling FITS files in the application."""
+import mmap
+import os
+import tempfile
+
 from astropy.io import fits
+import numpy as np
+
+from finestres_al_cel_reduction.compression import OutputCompression
+from finestres_al_cel_reduction.display_stats import estimate_percentiles
+from finestres_al_cel_reduction.image_pyramid import ImagePyramid
+from finestres_al_cel_reduction.instrumentation import (
+    count_bytes_read, count_bytes_written, instrumented,
+)
+from finestres_al_cel_reduction.precision import get_working_dtype
 
 class FitsFile:
     """Class representing a FITS file."""
 
-    def __init__(self, filename):
+    # by default, pixel data is loaded together with the header
+    # and converted to the working precision (see precision) straight away
+    header_only = False
+    memmap = False
+    decompression_cache = None
+    # path of the decompressed copy the pixel data is read from, looked up
+    # once in the decompression cache
+    _data_filename = None
+
+    # counter increased every time the pixel data changes, used to know when
+    # anything derived from it (e.g. the display pyramid) is out of date
+    _data_version = 0
+    _pyramid = None
+    _display_percentiles = None
+
+    # files computed in memory (e.g. stacks) are modified until they are
+    # saved, files read from disk are not modified when they are opened
+    modified = True
+
+    # session cache bounding the memory used by the pixel data (see data_cache)
+    data_cache = None
+    # pixel data dropped from memory is read again on access: from disk if it
+    # is still the data version read from the file, otherwise from the
+    # scratch file it was written to
+    _evicted = False
+    _disk_version = None
+    _spill_filename = None
+
+    def __init__(self, filename, header_only=False, memmap=False, decompression_cache=None):
         """Initialize the FitsFile instance.
         
         Arguments
         ---------
         filename: str
         The path to the FITS file.
+
+        header_only: bool - Default False
+        If True, only the header is read when the file is opened. The pixel
+        data is loaded from disk the first time it is accessed.
+
+        memmap: bool - Default False
+        If True, the pixel data is a memory-mapped view of the file in its
+        on-disk type. It is only converted to an in-memory array in the
+        working precision when it is first modified (see materialize_data).
+        Scaled integer data (e.g. unsigned 16-bit images) cannot be mapped
+        and is read into memory in its integer type instead.
+
+        decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+        If not None, the pixel data of gzipped files is read from a
+        decompressed copy in the cache, which can be memory-mapped and read
+        partially. The header is still read from the gzipped file.
         """
         self.filename = filename
         self.title = self.filename.split("/")[-1]  # Get the file name from the path
 
+        self.header_only = header_only
+        self.memmap = memmap
+        self.decompression_cache = decompression_cache
         self.data = None
         self.header = None
         self.type = None
@@ -29,6 +89,78 @@ class FitsFile:
             return NotImplemented
         return self.title < other.title
 
+    @property
+    def data(self):
+        """The pixel data. For header-only files, it is loaded on first access.
+
+        Data evicted from memory (see evict_data) is read again on access.
+        """
+        if self._data is None:
+            if self._evicted:
+                self._restore_data()
+            elif self.header_only and self.type == "IMAGE":
+                self.load_pixels()
+        if self.data_cache is not None and self._data is not None:
+            self.data_cache.touch(self)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        # data assigned from outside is considered to be in its final form
+        self._materialized = True
+        self._evicted = False
+        self._remove_spill_file()
+        self.data_changed()
+        if self.data_cache is not None:
+            self.data_cache.update(self)
+
+    @property
+    def data_filename(self):
+        """The path the pixel data is read from, a decompressed copy if there is a cache.
+
+        The copy is looked up in the cache the first time, and again only if
+        it has been removed since.
+        """
+        if self.decompression_cache is None:
+            return self.filename
+        if self._data_filename is None or not os.path.exists(self._data_filename):
+            self._data_filename = self.decompression_cache.get(self.filename)
+        return self._data_filename
+
+    @property
+    def data_version(self):
+        """Counter increased every time the pixel data changes."""
+        return self._data_version
+
+    @property
+    def loaded_bytes(self):
+        """Number of bytes of pixel data held in memory by the file.
+
+        It is 0 if the data is not loaded or if it is a memory-mapped view
+        of the file, whose pages are read from disk and can be dropped by
+        the operating system at any time.
+        """
+        if self._data is None or (not self._materialized and _is_memory_mapped(self._data)):
+            return 0
+        return self._data.nbytes
+
+    @property
+    def materialized(self):
+        """True if the pixel data is an in-memory array that can be modified in place."""
+        return self._data is not None and self._materialized
+
+    @property
+    def shape(self):
+        """The shape of the pixel data, taken from the header if it is not loaded."""
+        if self._data is not None:
+            return self._data.shape
+        if self.header is None or self.header.get("NAXIS", 0) == 0:
+            return None
+        return tuple(
+            self.header[f"NAXIS{axis}"] for axis in range(self.header["NAXIS"], 0, -1))
+
+    @instrumented("calibrate")
     def calibrate(self, dark=None, flat=None):
         """Calibrate the FITS file with dark and flat frames.
         
@@ -46,6 +178,7 @@ class FitsFile:
         """
         if self.data is None:
             raise ValueError("The FITS file does not contain any data.")
+        self.materialize_data()
         
         if dark is not None:
             self.data -= dark.data
@@ -57,16 +190,111 @@ class FitsFile:
             self.header["HISTORY"] = f"Divided by flat frame: {flat.title}"
             self.modified = True
 
+        self.data_changed()
+
+    def data_changed(self):
+        """Record that the pixel data has changed.
+
+        This must be called after the data is modified in place.
+        """
+        self._data_version += 1
+
+    def evict_data(self, scratch_folder):
+        """Drop the pixel data from memory until it is accessed again.
+
+        Data that changed since it was read from disk first is written to a
+        scratch file, where it is read from on the next access. Otherwise, it
+        is read again from disk.
+
+        Arguments
+        ---------
+        scratch_folder: str
+        Folder where the data of modified files is written.
+
+        Returns
+        -------
+        freed: int
+        Number of bytes of pixel data dropped.
+        """
+        if self._data is None:
+            return 0
+        freed = self._data.nbytes
+        if self.modified or self._data_version != self._disk_version:
+            handle, filename = tempfile.mkstemp(dir=scratch_folder, suffix=".npy")
+            with os.fdopen(handle, "wb") as file:
+                np.save(file, self._data)
+            self._spill_filename = filename
+        self._data = None
+        self._evicted = True
+        return freed
+
+    def get_display_percentiles(self, low, high):
+        """Get the percentiles used to scale the display of the pixel data.
+
+        They are estimated from a subsample of the pixels of the coarsest
+        level of the display pyramid (see get_pyramid and
+        finestres_al_cel_reduction.display_stats.estimate_percentiles), so
+        the full-resolution data is not loaded, and cached until the data
+        changes.
+
+        Arguments
+        ---------
+        low: float
+        The lower percentile.
+
+        high: float
+        The upper percentile.
+
+        Returns
+        -------
+        vmin: float
+        The value at the lower percentile.
+
+        vmax: float
+        The value at the upper percentile.
+        """
+        if (self._display_percentiles is None or
+                self._display_percentiles[0] != self.data_version):
+            self._display_percentiles = (self.data_version, {})
+        cache = self._display_percentiles[1]
+        if (low, high) not in cache:
+            pyramid = self.get_pyramid()
+            image, _ = pyramid.get_region(
+                pyramid.num_levels - 1, 0, pyramid.shape[0], 0, pyramid.shape[1])
+            cache[(low, high)] = estimate_percentiles(image, (low, high))
+        return cache[(low, high)]
+
+    def get_pyramid(self):
+        """Get the multi-resolution pyramid used to display the pixel data.
+
+        The pyramid is cached and only built again when the data changes.
+
+        Returns
+        -------
+        pyramid: finestres_al_cel_reduction.image_pyramid.ImagePyramid
+        The pyramid of the pixel data.
+        """
+        if self._pyramid is None or self._pyramid.data_version != self.data_version:
+            self._pyramid = ImagePyramid(self)
+        return self._pyramid
+
+    @instrumented("load")
     def load_data(self):
-        """Load data from the FITS file."""
-        with fits.open(self.filename) as hdul:
+        """Load data from the FITS file.
+
+        If the file was opened in header-only mode, only the header is read.
+        """
+        filename = self.filename if self.header_only else self.data_filename
+        with fits.open(filename, memmap=self.memmap) as hdul:
             # Check if the file is empty
             if len(hdul) == 0:
                 raise ValueError(f"The FITS file '{self.filename}' is empty or not a valid FITS file.")
             # Image files
-            if isinstance(hdul[0], fits.ImageHDU) or isinstance(hdul[0], fits.PrimaryHDU):
-                self.data = hdul[0].data.astype(float)  # Convert data to float
-                self.header = hdul[0].header
+            hdu = _get_image_hdu(hdul)
+            if isinstance(hdu, fits.ImageHDU) or isinstance(hdu, fits.PrimaryHDU):
+                if not self.header_only:
+                    self._read_pixels(hdul)
+                self.header = hdu.header
                 self.type = "IMAGE"
 
                 if "EXPTIME" in self.header:
@@ -78,18 +306,188 @@ class FitsFile:
                 
             # TODO: check other types of HDU
 
-    def save(self, filename=None):
+    @instrumented("load_pixels")
+    def load_pixels(self):
+        """Load the pixel data from the FITS file, leaving the header untouched."""
+        with fits.open(self.data_filename, memmap=self.memmap) as hdul:
+            self._read_pixels(hdul)
+
+    def _read_pixels(self, hdul):
+        """Read the pixel data from the image HDU of an opened FITS file.
+
+        Arguments
+        ---------
+        hdul: astropy.io.fits.HDUList
+        The opened FITS file.
+        """
+        hdu = _get_image_hdu(hdul)
+        if not self.memmap or isinstance(hdu, fits.CompImageHDU):
+            # compressed images cannot be mapped, they are always decompressed
+            data = hdu.data
+            count_bytes_read(data.nbytes)
+            self.data = data.astype(get_working_dtype())  # Convert data to float
+            self._disk_version = self._data_version
+            return
+
+        try:
+            data = hdu.data
+        except ValueError:
+            # astropy refuses to map scaled data (BZERO/BSCALE keywords),
+            # read it into memory keeping its integer type instead
+            with fits.open(hdul.filename(), memmap=False) as unmapped_hdul:
+                data = _get_image_hdu(unmapped_hdul).data
+        # mapped pixels are read from disk when they are used, they are counted now
+        count_bytes_read(data.nbytes)
+        self.data = data
+        self._materialized = False
+        self._disk_version = self._data_version
+
+    def materialize_data(self):
+        """Convert memory-mapped pixel data into an in-memory array in the working precision.
+
+        This is called before the data is modified. It does nothing if the
+        data is already in memory.
+        """
+        if not self._materialized and self._data is not None:
+            self.data = self._data.astype(get_working_dtype())  # Convert data to float
+
+    def read_rows(self, start, stop):
+        """Read a strip of rows of the pixel data.
+
+        If the data is not loaded, only the requested rows are read from disk
+        and the data is left unloaded. Tile-compressed files only decompress
+        the tiles of the strip. Compressed (.gz) files cannot be read
+        partially, so their data is fully loaded instead, unless they are
+        read from a decompressed copy (see DecompressionCache).
+
+        Arguments
+        ---------
+        start: int
+        First row of the strip.
+
+        stop: int
+        Row after the last row of the strip.
+
+        Returns
+        -------
+        rows: np.ndarray
+        The pixel data in rows start to stop.
+        """
+        if self._data is None and self.header_only and self.type == "IMAGE":
+            data_filename = self.data_filename
+            if not data_filename.lower().endswith(".gz"):
+                with fits.open(data_filename) as hdul:
+                    rows = np.asarray(_get_image_hdu(hdul).section[start:stop])
+                count_bytes_read(rows.nbytes)
+                return rows
+        return self.data[start:stop]
+
+    def release_data(self, discard_changes=False):
+        """Drop the pixel data of a header-only file to free memory.
+
+        The data is read again from disk the next time it is accessed. Files
+        that are not header-only keep their data.
+
+        Arguments
+        ---------
+        discard_changes: bool - Default False
+        If False, files modified since they were last saved keep their data.
+        If True, the modifications are discarded.
+        """
+        if not self.header_only:
+            return
+        if self.modified and not discard_changes:
+            return
+        self.data = None
+        if self.modified:
+            # restore the header as well
+            self.load_data()
+            self.modified = False
+
+    def _remove_spill_file(self):
+        """Remove the scratch file of evicted modified data, if there is one."""
+        if self._spill_filename is not None:
+            try:
+                os.remove(self._spill_filename)
+            except FileNotFoundError:
+                pass
+            self._spill_filename = None
+
+    def _restore_data(self):
+        """Read evicted pixel data again, from its scratch file or from disk.
+
+        The data version is kept, so anything derived from the data (e.g.
+        the display pyramid) is still valid.
+        """
+        version = self._data_version
+        if self._spill_filename is not None:
+            self.data = np.load(self._spill_filename)
+        else:
+            self.load_pixels()
+            self._disk_version = version
+        self._data_version = version
+
+    @instrumented("save")
+    def save(self, filename=None, compression=None):
         """Save the FITS file.
         
         Arguments
         ---------
         filename: str - Default None
         The path to save the FITS file. If None, it will use the original filename
+
+        compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+        How the image is compressed. If None, it is written uncompressed.
         """
         if filename is None:
             filename = self.filename
-        hdu = fits.PrimaryHDU(data=self.data, header=self.header)
-        hdu.writeto(filename, overwrite=True)
+        data = self.data
+        if data is not None and np.issubdtype(data.dtype, np.floating):
+            # write floating point data in the working precision
+            data = data.astype(get_working_dtype(), copy=False)
+        if compression is None:
+            compression = OutputCompression()
+        compression.make_hdul(data, self.header).writeto(filename, overwrite=True)
+        count_bytes_written(os.path.getsize(filename))
 
         self.modified = False
-    
\ No newline at end of file
+    
+
+def _get_image_hdu(hdul):
+    """Get the HDU with the image of an opened FITS file.
+
+    Arguments
+    ---------
+    hdul: astropy.io.fits.HDUList
+    The opened FITS file.
+
+    Returns
+    -------
+    hdu: astropy.io.fits.hdu.base.ExtensionHDU
+    The primary HDU, or the first extension if the primary HDU is empty and
+    the extension is a tile-compressed image.
+    """
+    if (len(hdul) > 1 and hdul[0].header.get("NAXIS", 0) == 0 and
+            isinstance(hdul[1], fits.CompImageHDU)):
+        return hdul[1]
+    return hdul[0]
+
+def _is_memory_mapped(array):
+    """Check if an array is a view of a memory-mapped file.
+
+    Arguments
+    ---------
+    array: np.ndarray
+    The array.
+
+    Returns
+    -------
+    mapped: bool
+    True if the memory of the array belongs to a memory map.
+    """
+    base = array
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            return True
+        base = base.base
+    return isinstance(base, mmap.mmap)
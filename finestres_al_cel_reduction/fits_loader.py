@@ -0,0 +1,104 @@
+"""Loading of several FITS files at once."""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import struct
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+
+# Default number of files loaded concurrently
+DEFAULT_LOAD_WORKERS = min(8, os.cpu_count() or 1)
+
+# Default maximum number of bytes (uncompressed) of the files being loaded
+# at the same time
+DEFAULT_LOAD_MEMORY_LIMIT = 2 * 1024**3
+
+def estimate_file_size(filename):
+    """Estimate the uncompressed size of a FITS file.
+
+    For gzip files, the size is read from the gzip trailer. This is exact
+    for files smaller than 4 GB.
+
+    Arguments
+    ---------
+    filename: str
+    The path to the FITS file.
+
+    Returns
+    -------
+    size: int
+    The estimated size in bytes.
+    """
+    size = os.path.getsize(filename)
+    if filename.lower().endswith(".gz") and size >= 4:
+        with open(filename, "rb") as file:
+            file.seek(-4, os.SEEK_END)
+            size = max(size, struct.unpack("<I", file.read(4))[0])
+    return size
+
+def load_fits_files(filenames, memmap=True, workers=DEFAULT_LOAD_WORKERS,
+                    memory_limit=DEFAULT_LOAD_MEMORY_LIMIT, progress_callback=None,
+                    decompression_cache=None):
+    """Load several FITS files concurrently.
+
+    Files are loaded in a pool of threads, so gzipped files are also
+    decompressed concurrently. A new file only starts loading if the
+    estimated size of the files being loaded stays within the memory limit,
+    but at least one file is always loading.
+
+    Arguments
+    ---------
+    filenames: list of str
+    The paths to the FITS files.
+
+    memmap: bool - Default True
+    If True, the pixel data of the files is memory-mapped (see FitsFile).
+
+    workers: int - Default DEFAULT_LOAD_WORKERS
+    Maximum number of files loaded at the same time.
+
+    memory_limit: int - Default DEFAULT_LOAD_MEMORY_LIMIT
+    Maximum estimated size, in bytes, of the files being loaded at the same time.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total, file) as soon as
+    each file is loaded. It may raise an exception to stop loading.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, gzipped files are decompressed to the cache and their pixel
+    data is read (and memory-mapped) from the decompressed copies.
+
+    Returns
+    -------
+    files: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The loaded files, in the order in which they finished loading.
+    """
+    files = []
+    pending = deque((filename, estimate_file_size(filename)) for filename in filenames)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while pending or running:
+                # start as many files as the limits allow
+                while (pending and len(running) < workers and
+                       (not running or sum(running.values()) + pending[0][1] <= memory_limit)):
+                    filename, size = pending.popleft()
+                    future = executor.submit(
+                        FitsFile, filename, memmap=memmap,
+                        decompression_cache=decompression_cache)
+                    running[future] = size
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    file = future.result()
+                    files.append(file)
+                    if progress_callback is not None:
+                        progress_callback(len(files), len(filenames), file)
+        except BaseException:
+            # do not start the files still waiting
+            for future in running:
+                future.cancel()
+            raise
+
+    return files
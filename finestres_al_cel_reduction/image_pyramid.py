@@ -0,0 +1,148 @@
+"""Multi-resolution pyramid of an image, used to display large images."""
+import numpy as np
+
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+# Levels are added until the largest side of the coarsest one is not larger than this
+MIN_LEVEL_SIZE = 512
+
+# Number of full-resolution rows read at once while building the pyramid
+PYRAMID_STRIP_ROWS = 256
+
+def downsample(data):
+    """Halve the resolution of an image by averaging blocks of 2x2 pixels.
+
+    NaN pixels are ignored. Odd sides are padded with NaN, so the last row or
+    column of blocks only averages the pixels in the image.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image. Extra axes after the first two (e.g. colour channels) are kept.
+
+    Returns
+    -------
+    downsampled: np.ndarray
+    The image at half resolution. Integer images are converted to the
+    working precision, floating point ones keep their type.
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(get_working_dtype())
+    num_rows, num_cols = data.shape[:2]
+    if num_rows % 2 or num_cols % 2:
+        padding = [(0, num_rows % 2), (0, num_cols % 2)] + [(0, 0)] * (data.ndim - 2)
+        data = np.pad(data, padding, constant_values=np.nan)
+
+    blocks = data.reshape(
+        (data.shape[0] // 2, 2, data.shape[1] // 2, 2) + data.shape[2:])
+    valid = np.isfinite(blocks)
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    count = valid.sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total / count).astype(data.dtype, copy=False)
+
+class ImagePyramid:
+    """Class holding downsampled versions of the pixel data of a FITS file.
+
+    Level 0 is the full-resolution data, which is never copied: regions of
+    it are read from the file when they are requested. Each following level
+    halves the resolution of the previous one. Levels are built the first
+    time they are requested.
+    """
+
+    def __init__(self, fits_file):
+        """Initialize the ImagePyramid instance.
+
+        Arguments
+        ---------
+        fits_file: finestres_al_cel_reduction.fits_file.FitsFile
+        The file whose pixel data is displayed.
+        """
+        self.fits_file = fits_file
+        self.data_version = fits_file.data_version
+        self.shape = fits_file.shape
+
+        self.num_levels = 1
+        while max(self.shape[:2]) > MIN_LEVEL_SIZE * 2**(self.num_levels - 1):
+            self.num_levels += 1
+        self.levels = {}
+
+    def get_level(self, level):
+        """Get the pixel data of a downsampled level.
+
+        Arguments
+        ---------
+        level: int
+        The level, between 1 and num_levels - 1.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data at 1 / 2**level resolution.
+        """
+        if level not in self.levels:
+            if level == 1:
+                # read the full-resolution data in strips so that header-only
+                # files are not loaded in memory
+                strips = [
+                    downsample(self.fits_file.read_rows(start, start + PYRAMID_STRIP_ROWS))
+                    for start in range(0, self.shape[0], PYRAMID_STRIP_ROWS)
+                ]
+                self.levels[level] = np.concatenate(strips)
+            else:
+                self.levels[level] = downsample(self.get_level(level - 1))
+        return self.levels[level]
+
+    def get_region(self, level, row_start, row_stop, col_start, col_stop):
+        """Get a region of the image at a given level.
+
+        Arguments
+        ---------
+        level: int
+        The level, between 0 and num_levels - 1.
+
+        row_start, row_stop, col_start, col_stop: int
+        Bounds of the region, in full-resolution pixels.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data of the region at the requested level.
+
+        bounds: tuple of int
+        The (row_start, row_stop, col_start, col_stop) bounds actually
+        covered by data, in full-resolution pixels. They are the requested
+        bounds clipped to the image and aligned to the pixels of the level,
+        so the last pixels of a level may extend past the image.
+        """
+        scale = 2**level
+        row_start = max(row_start // scale, 0)
+        col_start = max(col_start // scale, 0)
+        row_stop = min(-(-row_stop // scale), -(-self.shape[0] // scale))
+        col_stop = min(-(-col_stop // scale), -(-self.shape[1] // scale))
+
+        if level == 0:
+            data = self.fits_file.read_rows(row_start, row_stop)[:, col_start:col_stop]
+        else:
+            data = self.get_level(level)[row_start:row_stop, col_start:col_stop]
+        bounds = (row_start * scale, row_stop * scale, col_start * scale, col_stop * scale)
+        return data, bounds
+
+    def select_level(self, pixels_per_screen_pixel):
+        """Select the coarsest level that keeps the displayed resolution.
+
+        Arguments
+        ---------
+        pixels_per_screen_pixel: float
+        Number of full-resolution pixels covered by one screen pixel.
+
+        Returns
+        -------
+        level: int
+        The selected level.
+        """
+        if not pixels_per_screen_pixel > 1:
+            return 0
+        level = int(np.floor(np.log2(pixels_per_screen_pixel)))
+        return min(level, self.num_levels - 1)
@@ -0,0 +1,334 @@
+"""Timing, I/O and memory instrumentation of the reduction stages.
+
+Instrumentation is disabled by default. While it is disabled, instrumented
+functions only check a flag before running, so it can be left in place on
+the reduction path. While it is enabled, every call to an instrumented
+function is recorded with its stage, the file it worked on, its wall time,
+the bytes it read and wrote and, optionally, its peak memory allocation.
+
+Times, bytes and peaks include the nested stages. Peak memory is measured
+with tracemalloc, which follows the allocations of all the threads of the
+process (not those of worker processes) and slows them down, so it can be
+turned off when only timings are needed. tracemalloc has a single peak for
+the whole process, so the peak of a stage is only recorded if no
+instrumented stage ran in another thread at the same time.
+"""
+import csv
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# Fields of each record, in the order they are exported
+RECORD_FIELDS = [
+    "stage", "file", "start", "seconds", "bytes_read", "bytes_written", "peak_bytes", "thread"]
+
+# Fields of the per-stage summary, in the order they are exported
+SUMMARY_FIELDS = [
+    "stage", "calls", "seconds", "mean_seconds", "bytes_read", "bytes_written", "peak_bytes"]
+
+_enabled = False
+_trace_memory = False
+_started_tracemalloc = False
+_start_time = 0.0
+_records = []
+# stages running in all the threads, to know which ones overlap
+_running_stages = []
+_lock = threading.Lock()
+_local = threading.local()
+
+class _Stage:
+    """Class holding the measurements of a stage while it runs."""
+
+    def __init__(self, stage, file):
+        """Initialize the _Stage instance.
+
+        Arguments
+        ---------
+        stage: str
+        The name of the stage.
+
+        file: str or None
+        The file the stage works on.
+        """
+        self.stage = stage
+        self.file = file
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start = 0.0
+        self.start_memory = 0
+        self.peak_memory = 0
+        self.thread = threading.current_thread()
+        # True if a stage ran in another thread meanwhile, its peak is not valid
+        self.overlapped = False
+
+    def __enter__(self):
+        with _lock:
+            for other in _running_stages:
+                if other.thread is not self.thread:
+                    other.overlapped = True
+                    self.overlapped = True
+            _running_stages.append(self)
+        stack = _get_stack()
+        if _trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset for this stage, keep the one reached by the outer stages
+            for outer in stack:
+                outer.peak_memory = max(outer.peak_memory, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+            self.peak_memory = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        stack = _get_stack()
+        stack.remove(self)
+        with _lock:
+            _running_stages.remove(self)
+        peak_bytes = None
+        if _trace_memory and tracemalloc.is_tracing():
+            peak = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+            for outer in stack:
+                outer.peak_memory = max(outer.peak_memory, peak)
+            if not self.overlapped:
+                peak_bytes = peak - self.start_memory
+        for outer in stack:
+            outer.bytes_read += self.bytes_read
+            outer.bytes_written += self.bytes_written
+
+        record = {
+            "stage": self.stage,
+            "file": self.file,
+            "start": self.start - _start_time,
+            "seconds": seconds,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "peak_bytes": peak_bytes,
+            "thread": self.thread.name,
+        }
+        with _lock:
+            _records.append(record)
+        return False
+
+class _DisabledStage:
+    """Class doing nothing, used as a stage while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_DISABLED_STAGE = _DisabledStage()
+
+def clear_records():
+    """Remove all the records."""
+    with _lock:
+        _records.clear()
+
+def count_bytes_read(num_bytes):
+    """Add bytes read from disk to the running stage of this thread.
+
+    Arguments
+    ---------
+    num_bytes: int
+    Number of bytes read.
+    """
+    if _enabled:
+        stack = _get_stack()
+        if stack:
+            stack[-1].bytes_read += int(num_bytes)
+
+def count_bytes_written(num_bytes):
+    """Add bytes written to disk to the running stage of this thread.
+
+    Arguments
+    ---------
+    num_bytes: int
+    Number of bytes written.
+    """
+    if _enabled:
+        stack = _get_stack()
+        if stack:
+            stack[-1].bytes_written += int(num_bytes)
+
+def disable_instrumentation():
+    """Stop recording the instrumented stages. The records are kept."""
+    global _enabled, _trace_memory, _started_tracemalloc
+    _enabled = False
+    _trace_memory = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+def enable_instrumentation(trace_memory=True):
+    """Start recording the instrumented stages.
+
+    Arguments
+    ---------
+    trace_memory: bool - Default True
+    If True, the peak memory allocated by each stage is measured with
+    tracemalloc. This slows down the instrumented code.
+    """
+    global _enabled, _trace_memory, _started_tracemalloc, _start_time
+    if not _enabled:
+        _start_time = time.perf_counter()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _trace_memory = trace_memory
+    _enabled = True
+
+def export_records(filename, records=None):
+    """Write records to a JSON or CSV file, depending on its extension.
+
+    The JSON file also contains the per-stage summary (see summarize_records).
+
+    Arguments
+    ---------
+    filename: str
+    The path to the file, ending in .json or .csv.
+
+    records: list of dict or None - Default None
+    The records to write. If None, all the records.
+
+    Raises
+    ------
+    ValueError: If the extension is not .json or .csv.
+    """
+    if records is None:
+        records = get_records()
+    if filename.lower().endswith(".csv"):
+        with open(filename, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    elif filename.lower().endswith(".json"):
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(
+                {"records": records, "summary": summarize_records(records)}, file, indent=2)
+    else:
+        raise ValueError(
+            f"Cannot export records to '{filename}', the extension must be .json or .csv.")
+
+def get_records():
+    """Get a copy of the records.
+
+    Returns
+    -------
+    records: list of dict
+    One record per call to an instrumented function, in the order they
+    finished. See RECORD_FIELDS. The start is in seconds since the
+    instrumentation was enabled, and peak_bytes is None if memory was not
+    traced or if another thread ran an instrumented stage at the same time.
+    """
+    with _lock:
+        return list(_records)
+
+def instrumented(stage, get_file=None):
+    """Decorator recording the calls to a function as a stage.
+
+    Arguments
+    ---------
+    stage: str
+    The name of the stage.
+
+    get_file: function or None - Default None
+    Called with the arguments of the function, it returns the file the
+    call works on. If None, the title of the first argument is used, if any.
+
+    Returns
+    -------
+    decorator: function
+    The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            if get_file is not None:
+                file = get_file(*args, **kwargs)
+            else:
+                file = getattr(args[0], "title", None) if args else None
+            with record_stage(stage, file):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def is_instrumentation_enabled():
+    """Check if the instrumented stages are being recorded.
+
+    Returns
+    -------
+    enabled: bool
+    True if instrumentation is enabled.
+    """
+    return _enabled
+
+def record_stage(stage, file=None):
+    """Get a context manager recording a block of code as a stage.
+
+    Arguments
+    ---------
+    stage: str
+    The name of the stage.
+
+    file: str or None - Default None
+    The file the stage works on.
+
+    Returns
+    -------
+    context: context manager
+    The stage. It does nothing if instrumentation is disabled.
+    """
+    if not _enabled:
+        return _DISABLED_STAGE
+    return _Stage(stage, file)
+
+def summarize_records(records=None):
+    """Add up the records of each stage.
+
+    Arguments
+    ---------
+    records: list of dict or None - Default None
+    The records. If None, all the records.
+
+    Returns
+    -------
+    summary: list of dict
+    One entry per stage, sorted by decreasing total time. See SUMMARY_FIELDS.
+    peak_bytes is the largest recorded peak of the stage, None if there is none.
+    """
+    if records is None:
+        records = get_records()
+    stages = {}
+    for record in records:
+        summary = stages.setdefault(record["stage"], {
+            "stage": record["stage"], "calls": 0, "seconds": 0.0,
+            "bytes_read": 0, "bytes_written": 0, "peak_bytes": None})
+        summary["calls"] += 1
+        summary["seconds"] += record["seconds"]
+        summary["bytes_read"] += record["bytes_read"]
+        summary["bytes_written"] += record["bytes_written"]
+        if record["peak_bytes"] is not None:
+            summary["peak_bytes"] = max(summary["peak_bytes"] or 0, record["peak_bytes"])
+    for summary in stages.values():
+        summary["mean_seconds"] = summary["seconds"] / summary["calls"]
+    return sorted(stages.values(), key=lambda summary: -summary["seconds"])
+
+def _get_stack():
+    """Get the stages running in this thread, innermost last.
+
+    Returns
+    -------
+    stack: list of _Stage
+    The running stages.
+    """
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
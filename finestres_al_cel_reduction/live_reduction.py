@@ -0,0 +1,409 @@
+"""Reduction of the exposures written to an acquisition folder as they arrive."""
+import logging
+import os
+import queue
+import threading
+import time
+
+from finestres_al_cel_reduction.calibration_catalog import FITS_EXTENSIONS, CalibrationCatalog
+from finestres_al_cel_reduction.combine import DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS
+from finestres_al_cel_reduction.dark_library import DarkLibrary
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.pipeline import (
+    DEFAULT_OUTPUT_SUBFOLDER, calibrate_lights_streaming, get_catalog_masters,
+)
+from finestres_al_cel_reduction.running_stack_fits_file import (
+    VALID_RUNNING_AVERAGE_METHODS, RunningStackFitsFile,
+)
+
+# Seconds between two scans of the watched folder
+DEFAULT_POLL_INTERVAL = 2.0
+
+# Seconds a file must stay unchanged before it is considered fully written
+DEFAULT_SETTLE_TIME = 5.0
+
+# Maximum number of files waiting to be processed. When the queue is full,
+# the folder is not scanned until there is room again
+DEFAULT_QUEUE_SIZE = 8
+
+# Uncompressed FITS files are always a whole number of blocks of this size
+FITS_BLOCK_SIZE = 2880
+
+logger = logging.getLogger(__name__)
+
+class FolderWatcher:
+    """Class polling a folder for new FITS files.
+
+    A file is only reported once its size and modification time have not
+    changed for settle_time seconds, so files still being written by the
+    acquisition software are not read. Each file is reported once.
+    """
+
+    def __init__(self, folder, settle_time=DEFAULT_SETTLE_TIME, include_existing=False):
+        """Initialize the FolderWatcher instance.
+
+        Arguments
+        ---------
+        folder: str
+        The folder to watch.
+
+        settle_time: float - Default DEFAULT_SETTLE_TIME
+        Seconds a file must stay unchanged before it is reported.
+
+        include_existing: bool - Default False
+        If True, the files already in the folder are reported as well.
+        Otherwise, only files written from now on are reported.
+        """
+        self.folder = folder
+        self.settle_time = settle_time
+
+        # for each file not yet reported: its last (size, modification time),
+        # when that state was first seen and when the file was first seen
+        self.pending = {}
+        self.reported = set()
+        if not include_existing:
+            self.reported.update(self._list_files())
+
+    def _list_files(self):
+        """List the FITS files in the folder.
+
+        Returns
+        -------
+        filenames: list of str
+        The paths to the FITS files, sorted by name.
+        """
+        return sorted(
+            os.path.join(self.folder, fname) for fname in os.listdir(self.folder)
+            if fname.lower().endswith(FITS_EXTENSIONS))
+
+    def poll(self):
+        """Scan the folder once.
+
+        Returns
+        -------
+        filenames: list of str
+        The paths to the files that have just settled, in the order they
+        were first seen.
+        """
+        now = time.monotonic()
+        settled = []
+        for filename in self._list_files():
+            if filename in self.reported:
+                continue
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                # removed while scanning
+                self.pending.pop(filename, None)
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            previous = self.pending.get(filename)
+            if previous is None or previous[0] != state:
+                self.pending[filename] = (state, now, previous[2] if previous else now)
+                continue
+            if now - previous[1] < self.settle_time:
+                continue
+            if not filename.lower().endswith(".gz") and stat.st_size % FITS_BLOCK_SIZE != 0:
+                # a truncated file, it is still being written
+                continue
+            del self.pending[filename]
+            self.reported.add(filename)
+            settled.append((previous[2], filename))
+
+        return [filename for _, filename in sorted(settled)]
+
+class LiveReduction:
+    """Class reducing the exposures written to an acquisition folder as they arrive.
+
+    New files are classified from their headers. Light frames are calibrated
+    with the current masters, written to the output folder and added to a
+    running stack of their filter, which is saved after each frame.
+    Calibration frames are only added to the catalog.
+
+    A watcher thread scans the folder and feeds a bounded queue, while the
+    files are processed one at a time in the calling thread.
+    """
+
+    def __init__(self, folder, output_folder, master_darks, master_flats, average="mean",
+                 poll_interval=DEFAULT_POLL_INTERVAL, settle_time=DEFAULT_SETTLE_TIME,
+                 queue_size=DEFAULT_QUEUE_SIZE, include_existing=False, master_bias=None,
+                 light_compression=None, stack_compression=None, decompression_cache=None):
+        """Initialize the LiveReduction instance.
+
+        Arguments
+        ---------
+        folder: str
+        The acquisition folder to watch.
+
+        output_folder: str
+        Folder where the calibrated frames and the stacks are written.
+
+        master_darks: dict
+        Master darks, with the exposure time as key.
+
+        master_flats: dict
+        Master flats, with the filter as key.
+
+        average: str - Default "mean"
+        The method used to stack the light frames. See
+        finestres_al_cel_reduction.running_stack_fits_file.VALID_RUNNING_AVERAGE_METHODS.
+
+        poll_interval: float - Default DEFAULT_POLL_INTERVAL
+        Seconds between two scans of the folder.
+
+        settle_time: float - Default DEFAULT_SETTLE_TIME
+        Seconds a file must stay unchanged before it is processed.
+
+        queue_size: int - Default DEFAULT_QUEUE_SIZE
+        Maximum number of files waiting to be processed.
+
+        include_existing: bool - Default False
+        If True, the files already in the folder are processed as well.
+
+        master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+        If not None, master darks are scaled with it to the exposure times
+        without a master dark (see finestres_al_cel_reduction.dark_library.DarkLibrary).
+
+        light_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+        How the calibrated frames are compressed. If None, they are written uncompressed.
+
+        stack_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+        How the stacks are compressed. If None, they are written uncompressed.
+
+        decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+        If not None, new gzipped frames are read from decompressed copies in the cache.
+
+        Raises
+        ------
+        ValueError:
+        - If the average method is not valid
+        - If the output folder is the watched folder
+        """
+        if average not in VALID_RUNNING_AVERAGE_METHODS:
+            raise ValueError(
+                f"Invalid average method '{average}'. "
+                f"Valid methods are: {VALID_RUNNING_AVERAGE_METHODS}.")
+        if os.path.abspath(output_folder) == os.path.abspath(folder):
+            # the calibrated frames would be processed again as new light frames
+            raise ValueError("The output folder must be different from the watched folder.")
+        self.folder = folder
+        self.output_folder = output_folder
+        # scaled darks are kept for the following frames
+        self.master_darks = DarkLibrary(master_darks, master_bias)
+        self.master_flats = master_flats
+        self.average = average
+        self.poll_interval = poll_interval
+        self.light_compression = light_compression
+        self.stack_compression = stack_compression
+        self.decompression_cache = decompression_cache
+
+        self.catalog = CalibrationCatalog(folder, scan=False)
+        self.stacks = {}
+        self.watcher = FolderWatcher(
+            folder, settle_time=settle_time, include_existing=include_existing)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+
+    def process_file(self, filename):
+        """Classify a new file and, if it is a light frame, calibrate and stack it.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the new file.
+
+        Returns
+        -------
+        stack: finestres_al_cel_reduction.running_stack_fits_file.RunningStackFitsFile or None
+        The updated stack, or None if the file is not a light frame.
+
+        Raises
+        ------
+        ValueError: If the file cannot be calibrated or stacked.
+        """
+        file = FitsFile(
+            filename, header_only=True, memmap=True, decompression_cache=self.decompression_cache)
+        if not self.catalog.add_file(file):
+            if self.catalog.skipped and self.catalog.skipped[-1][0] == filename:
+                logger.warning("%s Skipping.", self.catalog.skipped[-1][1])
+            return None
+        if file.image_type != "Light Frame":
+            logger.info("New %s: %s", file.image_type.lower(), file.title)
+            return None
+
+        calibrated = calibrate_lights_streaming(
+            [filename], self.master_darks, self.master_flats, self.output_folder,
+            compression=self.light_compression,
+            decompression_cache=self.decompression_cache)[0]
+        filter_name = getattr(calibrated, "filter", "Unknown")
+        stack = self.stacks.get(filter_name)
+        if stack is None:
+            stack = RunningStackFitsFile(
+                os.path.join(self.output_folder, f"live_stack_{filter_name}.fits"),
+                [calibrated], average=self.average)
+            self.stacks[filter_name] = stack
+        else:
+            stack.add_exposure(calibrated)
+        stack.save(compression=self.stack_compression)
+        logger.info("Added %s to %s (%d frames)", file.title, stack.title, stack.num_exposures)
+        return stack
+
+    def run(self, progress_callback=None):
+        """Watch the folder and process new files until stop is called.
+
+        Errors while processing a file are logged and the file is skipped.
+
+        Arguments
+        ---------
+        progress_callback: function or None - Default None
+        If not None, called as progress_callback(done, total, stack) after
+        each file is processed, where total includes the queued files and
+        stack is the updated stack or None. It may raise an exception to stop.
+
+        Returns
+        -------
+        stacks: dict
+        The running stacks, with the filter as key.
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        watcher_thread = threading.Thread(target=self._watch, daemon=True)
+        watcher_thread.start()
+        done = 0
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    filename = self.queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                try:
+                    stack = self.process_file(filename)
+                except (OSError, ValueError) as error:
+                    logger.error("Error processing %s: %s", filename, str(error))
+                    stack = None
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, done + self.queue.qsize(), stack)
+        finally:
+            self.stop()
+            watcher_thread.join()
+
+        return self.stacks
+
+    def stop(self):
+        """Stop watching the folder. Files still queued are not processed."""
+        self.stop_event.set()
+
+    def _watch(self):
+        """Scan the folder periodically and queue the new files.
+
+        This runs in the watcher thread. When the queue is full, it waits for
+        room, so a burst of exposures is processed at the pace of the reduction.
+        """
+        while not self.stop_event.is_set():
+            for filename in self.watcher.poll():
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(filename, timeout=self.poll_interval)
+                        break
+                    except queue.Full:
+                        continue
+            self.stop_event.wait(self.poll_interval)
+
+def run_live_reduction(folder, calibration_folder=None, output_folder=None, average="median",
+                       stack_average="mean", memory_budget=DEFAULT_MEMORY_BUDGET,
+                       workers=DEFAULT_WORKERS, use_cache=True, poll_interval=DEFAULT_POLL_INTERVAL,
+                       settle_time=DEFAULT_SETTLE_TIME, queue_size=DEFAULT_QUEUE_SIZE,
+                       progress_callback=None, master_compression=None, light_compression=None,
+                       stack_compression=None, decompression_cache=None):
+    """Generate the masters and reduce the light frames of a folder as they arrive.
+
+    The light frames already in the folder are processed first. This runs
+    until the progress callback raises an exception, e.g. KeyboardInterrupt.
+
+    Arguments
+    ---------
+    folder: str
+    The acquisition folder to watch.
+
+    calibration_folder: str or None - Default None
+    Folder with the calibration frames. If None, they are taken from folder.
+
+    output_folder: str or None - Default None
+    Folder where the products are written. If None, a DEFAULT_OUTPUT_SUBFOLDER
+    subfolder of folder is used.
+
+    average: str - Default "median"
+    The method used to combine the calibration frames.
+
+    stack_average: str - Default "mean"
+    The method used to stack the light frames. See
+    finestres_al_cel_reduction.running_stack_fits_file.VALID_RUNNING_AVERAGE_METHODS.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine frames.
+
+    use_cache: bool - Default True
+    If True, masters whose inputs and parameters have not changed since they
+    were last generated in output_folder are reused instead of rebuilt.
+
+    poll_interval: float - Default DEFAULT_POLL_INTERVAL
+    Seconds between two scans of the folder.
+
+    settle_time: float - Default DEFAULT_SETTLE_TIME
+    Seconds a file must stay unchanged before it is processed.
+
+    queue_size: int - Default DEFAULT_QUEUE_SIZE
+    Maximum number of files waiting to be processed.
+
+    progress_callback: function or None - Default None
+    See LiveReduction.run.
+
+    master_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the masters are compressed. If None, they are written uncompressed.
+
+    light_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the calibrated light frames are compressed. If None, they are written uncompressed.
+
+    stack_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the stacks are compressed. If None, they are written uncompressed.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, gzipped frames are decompressed to the cache and read from
+    the decompressed copies.
+
+    Returns
+    -------
+    stacks: dict
+    The running stacks, with the filter as key.
+
+    Raises
+    ------
+    ValueError: If the masters cannot be generated or stack_average is not valid.
+    """
+    if output_folder is None:
+        output_folder = os.path.join(folder, DEFAULT_OUTPUT_SUBFOLDER)
+    os.makedirs(output_folder, exist_ok=True)
+
+    calibration_catalog = CalibrationCatalog(
+        folder if calibration_folder is None else calibration_folder,
+        decompression_cache=decompression_cache)
+    for _, reason in calibration_catalog.skipped:
+        logger.warning("%s Skipping.", reason)
+    master_darks, master_flats, master_bias = get_catalog_masters(
+        calibration_catalog, output_folder, average=average,
+        memory_budget=memory_budget, workers=workers, use_cache=use_cache,
+        compression=master_compression, decompression_cache=decompression_cache)
+
+    live_reduction = LiveReduction(
+        folder, output_folder, master_darks, master_flats, average=stack_average,
+        poll_interval=poll_interval, settle_time=settle_time, queue_size=queue_size,
+        include_existing=True, master_bias=master_bias,
+        light_compression=light_compression, stack_compression=stack_compression,
+        decompression_cache=decompression_cache)
+    # calibration frames already used for the masters are not reported again
+    live_reduction.watcher.reported.update(calibration_catalog.calibration_filenames)
+    logger.info("Watching %s", folder)
+    return live_reduction.run(progress_callback=progress_callback)
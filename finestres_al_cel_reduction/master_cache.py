@@ -0,0 +1,141 @@
+"""On-disk cache of master calibration frames."""
+import hashlib
+import json
+import os
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+
+# Name of the file, in the folder of the masters, that stores the cache index
+CACHE_INDEX_FILENAME = ".master_cache.json"
+
+# Size of the blocks read when hashing the content of a file
+HASH_BLOCK_SIZE = 1024**2
+
+def get_file_fingerprint(filename, hash_contents=False):
+    """Get a fingerprint identifying the current version of a file.
+
+    Arguments
+    ---------
+    filename: str
+    The path to the file.
+
+    hash_contents: bool - Default False
+    If True, the fingerprint contains a hash of the content of the file.
+    Otherwise, it relies on its size and modification time.
+
+    Returns
+    -------
+    fingerprint: list
+    The absolute path of the file, and either its size and modification time
+    or the hash of its content.
+    """
+    if hash_contents:
+        file_hash = hashlib.sha256()
+        with open(filename, "rb") as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        return [os.path.abspath(filename), file_hash.hexdigest()]
+
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+class MasterCache:
+    """Class keeping track of the inputs used to build the masters in a folder.
+
+    Each master is stored with a key computed from the files it was built
+    from and the combination parameters. A master is reused if it is still
+    on disk, unchanged, and its key matches.
+    """
+
+    def __init__(self, folder, hash_contents=False):
+        """Initialize the MasterCache instance.
+
+        Arguments
+        ---------
+        folder: str
+        Folder where the masters are written.
+
+        hash_contents: bool - Default False
+        If True, input files are identified by a hash of their content instead
+        of their size and modification time.
+        """
+        self.folder = folder
+        self.hash_contents = hash_contents
+        self.index_filename = os.path.join(folder, CACHE_INDEX_FILENAME)
+
+        self.index = {}
+        if os.path.isfile(self.index_filename):
+            try:
+                with open(self.index_filename, encoding="utf-8") as index_file:
+                    self.index = json.load(index_file)
+            except (OSError, ValueError):
+                # a damaged index only means the masters are rebuilt
+                self.index = {}
+
+    def compute_key(self, files, **parameters):
+        """Compute the cache key of a master.
+
+        Arguments
+        ---------
+        files: list of finestres_al_cel_reduction.fits_file.FitsFile
+        The files the master is built from.
+
+        **parameters:
+        Any other value the master depends on (e.g. the combination method).
+        Values must be serializable to JSON.
+
+        Returns
+        -------
+        key: str
+        The cache key.
+        """
+        fingerprints = sorted(
+            get_file_fingerprint(file.filename, self.hash_contents) for file in files)
+        content = json.dumps(
+            {"files": fingerprints, "parameters": parameters}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, filename, key):
+        """Get a cached master.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the master.
+
+        key: str
+        The cache key of the master.
+
+        Returns
+        -------
+        master: finestres_al_cel_reduction.fits_file.FitsFile or None
+        The cached master, opened in header-only mode, or None if it is not in
+        the cache, has a different key, or was modified after being cached.
+        """
+        entry = self.index.get(os.path.basename(filename), None)
+        if entry is None or entry["key"] != key or not os.path.isfile(filename):
+            return None
+        if entry["fingerprint"] != get_file_fingerprint(filename):
+            return None
+        return FitsFile(filename, header_only=True, memmap=True)
+
+    def set(self, filename, key):
+        """Add a master that has just been written to the cache.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the master.
+
+        key: str
+        The cache key of the master.
+        """
+        self.index[os.path.basename(filename)] = {
+            "key": key,
+            "fingerprint": get_file_fingerprint(filename),
+        }
+        # write to a temporary file first so that the index is never left half written
+        temporary_filename = f"{self.index_filename}.tmp"
+        with open(temporary_filename, "w", encoding="utf-8") as index_file:
+            json.dump(self.index, index_file, indent=2, sort_keys=True)
+        os.replace(temporary_filename, self.index_filename)
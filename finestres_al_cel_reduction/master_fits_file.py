@@ -3,14 +3,20 @@ from astropy.io import fits
 import numpy as np
 import copy
 
+from finestres_al_cel_reduction.combine import (
+    DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS, VALID_AVERAGE_METHODS, combine_exposures,
+)
 from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.instrumentation import instrumented
 
-VALID_AVERAGE_METHODS = ["mean", "median"]
+# image types taken without a filter
+FILTERLESS_IMAGE_TYPES = ["Bias Frame", "Dark Frame"]
 
 class MasterFitsFile(FitsFile):
     """Class representing a master FITS file, combined from individual exposures."""
 
-    def __init__(self, filename, individual_exposures, average="mean"):
+    def __init__(self, filename, individual_exposures, average="mean",
+                 memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS):
         """Initialize the FitsFile instance.
         
         Arguments
@@ -22,7 +28,15 @@ class MasterFitsFile(FitsFile):
         List of individual exposure FITS files used to create this master.
 
         average: str - Default "mean"
-        The method used to combine the individual exposures. Can be "mean" or "median".
+        The method used to combine the individual exposures. Can be "mean",
+        "median", "sigma_clip" or "minmax" (see finestres_al_cel_reduction.combine).
+
+        memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+        Approximate maximum number of bytes used while combining the exposures.
+        The exposures are combined in strips of rows fitting in this budget.
+
+        workers: int - Default DEFAULT_WORKERS
+        Number of worker processes used to combine the exposures.
 
         Raises
         -------
@@ -34,6 +48,8 @@ class MasterFitsFile(FitsFile):
                 f"Invalid average method '{average}'. "
                 f"Valid methods are: {VALID_AVERAGE_METHODS}.")
         self.average = average
+        self.memory_budget = memory_budget
+        self.workers = workers
 
         self.filename = filename
         self.title = self.filename.split("/")[-1]  # Get the file name from the path
@@ -43,9 +59,12 @@ class MasterFitsFile(FitsFile):
         self.type = None
         self.combine_individual_exposures(individual_exposures)
 
-    def combine_individual_exposures(self, individual_exposures):
-        """Combine individual exposure FITS files into a master.
-        
+    def check_individual_exposures(self, individual_exposures):
+        """Check that individual exposures can be combined into a master.
+
+        The type, image type, exposure time and filter of the master are
+        taken from the first exposure.
+
         Arguments
         ---------
         individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
@@ -58,8 +77,7 @@ class MasterFitsFile(FitsFile):
         - if they are not valid FITS files
         - if they are not of the same type
         - if they do not have the same exposure time
-        - if they do not have the same filter (flats only)
-        - if the average method is not valid
+        - if they do not have the same filter (not for bias and dark frames)
         """
         if len(individual_exposures) == 0:
             raise ValueError("No individual exposures provided.")
@@ -71,27 +89,46 @@ class MasterFitsFile(FitsFile):
         self.type = "IMAGE"
         self.image_type = individual_exposures[0].image_type
         self.exposure_time = individual_exposures[0].exposure_time
-        if self.image_type != "Dark Frame":
+        if self.image_type not in FILTERLESS_IMAGE_TYPES:
             self.filter = individual_exposures[0].filter if hasattr(individual_exposures[0], "filter") else None
         for item in individual_exposures:
             if item.image_type != self.image_type:
                 raise ValueError("All individual exposures must be of the same type.")
             if item.exposure_time != individual_exposures[0].exposure_time:
                 raise ValueError("All individual exposures must have the same exposure time.")
-            if self.image_type != "Dark Frame":
+            if self.image_type not in FILTERLESS_IMAGE_TYPES:
                 if item.filter != individual_exposures[0].filter:
                     raise ValueError("All individual exposures must have the same filter.")
+
+    @instrumented("combine")
+    def combine_individual_exposures(self, individual_exposures):
+        """Combine individual exposure FITS files into a master.
+        
+        Arguments
+        ---------
+        individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+        List of individual exposure FITS files to combine.
+
+        Raises
+        -------
+        ValueError: 
+        - If no individual exposures are provided
+        - if they are not valid FITS files
+        - if they are not of the same type
+        - if they do not have the same exposure time
+        - if they do not have the same filter (not for bias and dark frames)
+        - if they do not have the same shape
+        - if the average method is not valid
+        """
+        self.check_individual_exposures(individual_exposures)
+
         # update image type to recognize it as a master file
         self.image_type = f"Master {self.image_type}"
 
         # Combine the data and headers of the individual exposures
-        if self.average == "mean":
-            self.data = np.nanmean([item.data for item in individual_exposures], axis=0)
-        elif self.average == "median":
-            self.data = np.nanmedian([item.data for item in individual_exposures], axis=0)
-        # this should never happen as we check the average method at initialization
-        else: # pragma: no cover
-            raise ValueError(f"Invalid average method '{self.average}'. Valid methods are: {VALID_AVERAGE_METHODS}.")
+        self.data = combine_exposures(
+            individual_exposures, self.average, memory_budget=self.memory_budget,
+            workers=self.workers)
         
         self.header = copy.deepcopy(individual_exposures[0].header)
         self.header["IMAGETYP"] = self.image_type
@@ -0,0 +1,835 @@
+"""Batch reduction pipeline, independent of the graphical interface."""
+import logging
+import math
+import os
+
+from finestres_al_cel_reduction.batch_calibration import group_frames
+from finestres_al_cel_reduction.calibrated_fits_file import CalibratedFitsFile
+from finestres_al_cel_reduction.calibration_catalog import CalibrationCatalog
+from finestres_al_cel_reduction.combine import DEFAULT_MEMORY_BUDGET, DEFAULT_WORKERS
+from finestres_al_cel_reduction.dark_library import DarkLibrary
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.master_cache import MasterCache, get_file_fingerprint
+from finestres_al_cel_reduction.master_fits_file import MasterFitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+from finestres_al_cel_reduction.registered_fits_file import RegisteredFitsFile
+from finestres_al_cel_reduction.registration import (
+    DEFAULT_REGISTRATION_WORKERS, VALID_REGISTRATION_METHODS, estimate_transforms,
+)
+
+# Name of the folder where the reduced files are written by default,
+# relative to the raw data folder
+DEFAULT_OUTPUT_SUBFOLDER = "reduced"
+
+logger = logging.getLogger(__name__)
+
+class ReductionCancelled(Exception):
+    """Exception raised by a progress callback to cancel a reduction step"""
+
+def align_lights(lights, registration="shift", workers=DEFAULT_REGISTRATION_WORKERS,
+                 progress_callback=None):
+    """Align light frames with the first one.
+
+    Arguments
+    ---------
+    lights: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The light frames to align. The first one is used as reference.
+
+    registration: str - Default "shift"
+    The transforms corrected. See VALID_REGISTRATION_METHODS. If "none", the
+    frames are returned unchanged.
+
+    workers: int - Default DEFAULT_REGISTRATION_WORKERS
+    Number of frames registered at the same time.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) after each frame
+    is registered. It may raise ReductionCancelled to stop.
+
+    Returns
+    -------
+    aligned: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The aligned light frames, resampled when they are read.
+
+    Raises
+    ------
+    ValueError: If the registration method is not valid or the frames cannot be aligned.
+    """
+    if registration not in VALID_REGISTRATION_METHODS:
+        raise ValueError(
+            f"Invalid registration method '{registration}'. "
+            f"Valid methods are: {VALID_REGISTRATION_METHODS}.")
+    if registration == "none" or len(lights) < 2:
+        return list(lights)
+
+    transforms = estimate_transforms(
+        lights, rotation=registration == "shift+rotation", workers=workers,
+        progress_callback=progress_callback)
+    for file, (shift_row, shift_col, angle) in zip(lights, transforms):
+        logger.info(
+            "Registered %s: shift (%.2f, %.2f) px, rotation %.3f deg",
+            file.title, shift_row, shift_col, math.degrees(angle))
+    return [RegisteredFitsFile(file, transform) for file, transform in zip(lights, transforms)]
+
+def calibrate_lights_streaming(filenames, master_darks, master_flats, output_folder,
+                               progress_callback=None, compression=None,
+                               decompression_cache=None):
+    """Calibrate light frames one at a time and write them to disk.
+
+    Each frame is read, calibrated, written and released before the next one
+    is read, so only one light frame is in memory at any time regardless of
+    the number of frames. Frames without a matching master dark or master
+    flat are calibrated without it, and a warning is logged.
+
+    Arguments
+    ---------
+    filenames: list of str
+    The paths to the light frames to calibrate.
+
+    master_darks: dict or finestres_al_cel_reduction.dark_library.DarkLibrary
+    Master darks, with the exposure time as key.
+
+    master_flats: dict
+    Master flats, with the filter as key.
+
+    output_folder: str
+    Folder where the calibrated files are written.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    frame and after each frame. It may raise ReductionCancelled to stop.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the calibrated files are compressed. If None, they are written uncompressed.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, gzipped light frames are decompressed to the cache in parallel before the first frame is calibrated.
+
+    Returns
+    -------
+    calibrated: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The calibrated files, opened in header-only mode.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    calibrated = []
+    _report_progress(progress_callback, 0, len(filenames))
+    if decompression_cache is not None:
+        decompression_cache.prefetch(filenames)
+    for filename in filenames:
+        file = FitsFile(
+            filename, header_only=True, memmap=True, decompression_cache=decompression_cache)
+        dark, flat = find_masters(file, master_darks, master_flats)
+        file.calibrate(dark=dark, flat=flat)
+        calibrated_filename = get_calibrated_filename(file, output_folder)
+        file.save(calibrated_filename, compression=compression)
+        logger.info("Calibrated %s", file.title)
+        # release the pixel data before reading the next frame
+        file.release_data()
+        del file
+
+        calibrated.append(FitsFile(calibrated_filename, header_only=True, memmap=True))
+        _report_progress(progress_callback, len(calibrated), len(filenames))
+
+    return calibrated
+
+def find_masters(file, master_darks, master_flats):
+    """Find the master dark and flat to calibrate a file.
+
+    A warning is logged for each missing master.
+
+    Arguments
+    ---------
+    file: finestres_al_cel_reduction.fits_file.FitsFile
+    The file to calibrate.
+
+    master_darks: dict or finestres_al_cel_reduction.dark_library.DarkLibrary
+    Master darks, with the exposure time as key.
+
+    master_flats: dict
+    Master flats, with the filter as key.
+
+    Returns
+    -------
+    dark: finestres_al_cel_reduction.fits_file.FitsFile or None
+    The master dark, None if there is no master dark for the exposure time.
+
+    flat: finestres_al_cel_reduction.fits_file.FitsFile or None
+    The master flat, None if there is no master flat for the filter.
+    """
+    dark = master_darks.get(file.exposure_time, None)
+    if dark is None:
+        logger.warning(
+            "No master dark found for %ss exposure time. %s will not be dark subtracted.",
+            file.exposure_time, file.title)
+
+    filter_name = getattr(file, "filter", None)
+    flat = master_flats.get(filter_name, None)
+    if flat is None:
+        logger.warning(
+            "No master flat found for filter %s. %s will not be flat divided.",
+            filter_name, file.title)
+
+    return dark, flat
+
+def generate_master_bias(biases, output_folder, average="median",
+                         memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS, cache=None,
+                         compression=None):
+    """Generate and save the master bias.
+
+    Arguments
+    ---------
+    biases: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The bias frames.
+
+    output_folder: str
+    Folder where the master bias is written.
+
+    average: str - Default "median"
+    The method used to combine the bias frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    cache: finestres_al_cel_reduction.master_cache.MasterCache or None - Default None
+    If not None, the master bias is loaded from disk instead of being rebuilt
+    if its inputs and parameters have not changed since it was cached.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the master bias is compressed. If None, it is written uncompressed.
+
+    Returns
+    -------
+    master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None
+    The master bias, None if there are no bias frames.
+
+    Raises
+    ------
+    ValueError: If the master bias cannot be generated.
+    """
+    if len(biases) == 0:
+        return None
+    filename = os.path.join(output_folder, "master_bias.fits")
+    if cache is not None:
+        key = cache.compute_key(
+            biases, image_type="Master Bias Frame", average=average,
+            precision=get_working_dtype().name, **_get_compression_parameters(compression))
+        master_bias = cache.get(filename, key)
+        if master_bias is not None:
+            logger.info("Reusing %s, its inputs have not changed", master_bias.title)
+            return master_bias
+    try:
+        master_bias = MasterFitsFile(
+            filename, biases, average=average, memory_budget=memory_budget, workers=workers)
+    except ValueError as error:
+        raise ValueError(f"Error generating master bias: {str(error)}") from error
+    master_bias.save(compression=compression)
+    if cache is not None:
+        cache.set(filename, key)
+    # individual frames are no longer needed in memory
+    for file in biases:
+        file.release_data()
+    logger.info("Generated %s from %d frames", master_bias.title, len(biases))
+    return master_bias
+
+def generate_master_darks(darks, output_folder, average="median",
+                          memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                          progress_callback=None, cache=None, compression=None):
+    """Generate and save one master dark per exposure time.
+
+    Arguments
+    ---------
+    darks: dict
+    Lists of dark frames, with the exposure time as key.
+
+    output_folder: str
+    Folder where the master darks are written.
+
+    average: str - Default "median"
+    The method used to combine the dark frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    master and after each one. It may raise ReductionCancelled to stop.
+
+    cache: finestres_al_cel_reduction.master_cache.MasterCache or None - Default None
+    If not None, masters whose inputs and parameters have not changed since
+    they were cached are loaded from disk instead of being rebuilt.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the master darks are compressed. If None, they are written uncompressed.
+
+    Returns
+    -------
+    master_darks: dict
+    The master darks, with the exposure time as key.
+
+    Raises
+    ------
+    ValueError: If a master dark cannot be generated.
+    """
+    master_darks = {}
+    _report_progress(progress_callback, 0, len(darks))
+    for index, (exposure_time, files) in enumerate(darks.items()):
+        if len(files) == 0:
+            continue
+        filename = os.path.join(output_folder, f"master_dark_{exposure_time}s.fits")
+        if cache is not None:
+            key = cache.compute_key(
+                files, image_type="Master Dark Frame", average=average,
+                precision=get_working_dtype().name, **_get_compression_parameters(compression))
+            master_dark = cache.get(filename, key)
+            if master_dark is not None:
+                master_darks[exposure_time] = master_dark
+                logger.info("Reusing %s, its inputs have not changed", master_dark.title)
+                _report_progress(progress_callback, index + 1, len(darks))
+                continue
+        try:
+            master_dark = MasterFitsFile(
+                filename, files, average=average, memory_budget=memory_budget, workers=workers)
+        except ValueError as error:
+            raise ValueError(
+                f"Error generating master dark for {exposure_time}s: {str(error)}") from error
+        master_dark.save(compression=compression)
+        if cache is not None:
+            cache.set(filename, key)
+        # individual frames are no longer needed in memory
+        for file in files:
+            file.release_data()
+        master_darks[exposure_time] = master_dark
+        logger.info("Generated %s from %d frames", master_dark.title, len(files))
+        _report_progress(progress_callback, index + 1, len(darks))
+
+    return master_darks
+
+def generate_master_flats(flats, master_darks, output_folder, average="median",
+                          memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                          progress_callback=None, cache=None, master_bias=None,
+                          compression=None):
+    """Generate and save one normalized master flat per filter.
+
+    The flat frames are dark subtracted with the master dark of their
+    exposure time as they are combined (see CalibratedFitsFile), so they are
+    never all in memory. If there is a master bias, flats without a master
+    dark of their exposure time are dark subtracted with a scaled master dark
+    (see finestres_al_cel_reduction.dark_library.DarkLibrary).
+
+    Arguments
+    ---------
+    flats: dict
+    Lists of flat frames, with the filter as key.
+
+    master_darks: dict
+    Master darks, with the exposure time as key.
+
+    output_folder: str
+    Folder where the master flats are written.
+
+    average: str - Default "median"
+    The method used to combine the flat frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    master and after each one. It may raise ReductionCancelled to stop.
+
+    cache: finestres_al_cel_reduction.master_cache.MasterCache or None - Default None
+    If not None, masters whose inputs and parameters have not changed since
+    they were cached are loaded from disk instead of being rebuilt.
+
+    master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+    The master bias used to scale the master darks.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the master flats are compressed. If None, they are written uncompressed.
+
+    Returns
+    -------
+    master_flats: dict
+    The master flats, with the filter as key.
+
+    Raises
+    ------
+    ValueError: If a master flat cannot be generated.
+    """
+    darks = DarkLibrary(master_darks, master_bias)
+    master_flats = {}
+    _report_progress(progress_callback, 0, len(flats))
+    for index, (filter_name, files) in enumerate(flats.items()):
+        if len(files) == 0:
+            continue
+        filename = os.path.join(output_folder, f"master_flat_{filter_name}.fits")
+        if cache is not None:
+            # the master flat also depends on the master darks used to calibrate it
+            dark_fingerprints = sorted(
+                get_file_fingerprint(dark_filename)
+                for exposure_time in {file.exposure_time for file in files}
+                for dark_filename in darks.get_filenames(exposure_time))
+            key = cache.compute_key(
+                files, image_type="Master Flat", average=average, darks=dark_fingerprints,
+                precision=get_working_dtype().name, **_get_compression_parameters(compression))
+            master_flat = cache.get(filename, key)
+            if master_flat is not None:
+                master_flats[filter_name] = master_flat
+                logger.info("Reusing %s, its inputs have not changed", master_flat.title)
+                _report_progress(progress_callback, index + 1, len(flats))
+                continue
+        try:
+            # No flat calibration for flats. They are dark subtracted strip by
+            # strip while they are combined, so they are never all in memory
+            calibrated_files = []
+            for (exposure_time, _), group in group_frames(files).items():
+                dark = darks.get(exposure_time, None)
+                if dark is None:
+                    logger.warning(
+                        "No master dark found for %ss exposure time. "
+                        "%d flats will not be dark subtracted.", exposure_time, len(group))
+                calibrated_files += [CalibratedFitsFile(file, dark=dark) for file in group]
+            master_flat = MasterFitsFile(
+                filename, calibrated_files, average=average, memory_budget=memory_budget,
+                workers=workers)
+            master_flat.normalize()  # Normalize the master flat
+        except ValueError as error:
+            raise ValueError(
+                f"Error generating master flat for filter {filter_name}: {str(error)}") from error
+        master_flat.save(compression=compression)
+        if cache is not None:
+            cache.set(filename, key)
+        # individual frames are no longer needed in memory
+        for file in files:
+            file.release_data()
+        master_flats[filter_name] = master_flat
+        logger.info("Generated %s from %d frames", master_flat.title, len(files))
+        _report_progress(progress_callback, index + 1, len(flats))
+
+    return master_flats
+
+def generate_masters(darks, flats, output_folder, average="median",
+                     memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                     progress_callback=None, use_cache=True, biases=None, master_bias=None,
+                     compression=None, decompression_cache=None):
+    """Generate and save the master bias, the master darks and then the master flats.
+
+    Arguments
+    ---------
+    darks: dict
+    Lists of dark frames, with the exposure time as key.
+
+    flats: dict
+    Lists of flat frames, with the filter as key.
+
+    output_folder: str
+    Folder where the masters are written.
+
+    average: str - Default "median"
+    The method used to combine the frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    master and after each one. It may raise ReductionCancelled to stop.
+
+    use_cache: bool - Default True
+    If True, masters whose inputs and parameters have not changed since they
+    were last generated in output_folder are reused instead of rebuilt.
+
+    biases: list or None - Default None
+    Bias frames. If there are any, the master darks are scaled with the
+    master bias to dark subtract flats without a master dark of their
+    exposure time.
+
+    master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+    Master bias used if there are no bias frames.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, the gzipped frames are decompressed to the cache in
+    parallel before the masters are generated. The frames must have been
+    opened with the same cache to read the decompressed copies.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the masters are compressed. If None, they are written uncompressed.
+
+    Returns
+    -------
+    master_darks: dict
+    The master darks, with the exposure time as key.
+
+    master_flats: dict
+    The master flats, with the filter as key.
+
+    master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None
+    The master bias, None if there are no bias frames and no master bias.
+
+    Raises
+    ------
+    ValueError: If a master cannot be generated.
+    """
+    cache = MasterCache(output_folder) if use_cache else None
+    num_masters = len(darks) + len(flats)
+    if decompression_cache is not None:
+        decompression_cache.prefetch([
+            file.filename
+            for files in (biases or [], *darks.values(), *flats.values()) for file in files])
+    if biases:
+        master_bias = generate_master_bias(
+            biases, output_folder, average=average, memory_budget=memory_budget,
+            workers=workers, cache=cache, compression=compression)
+    master_darks = generate_master_darks(
+        darks, output_folder, average=average, memory_budget=memory_budget, workers=workers,
+        progress_callback=_offset_progress(progress_callback, 0, num_masters), cache=cache,
+        compression=compression)
+    master_flats = generate_master_flats(
+        flats, master_darks, output_folder, average=average, memory_budget=memory_budget,
+        workers=workers,
+        progress_callback=_offset_progress(progress_callback, len(darks), num_masters),
+        cache=cache, master_bias=master_bias, compression=compression)
+    return master_darks, master_flats, master_bias
+
+def get_catalog_masters(calibration_catalog, output_folder, average="median",
+                        memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                        use_cache=True, compression=None, decompression_cache=None):
+    """Get the masters of a catalog, generating them from its calibration frames.
+
+    Masters already in the catalog are used, unless there are calibration
+    frames to generate them again.
+
+    Arguments
+    ---------
+    calibration_catalog: finestres_al_cel_reduction.calibration_catalog.CalibrationCatalog
+    The catalog of the calibration frames.
+
+    output_folder: str
+    Folder where the masters are written.
+
+    average: str - Default "median"
+    The method used to combine the frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    use_cache: bool - Default True
+    If True, masters whose inputs and parameters have not changed since they
+    were last generated in output_folder are reused instead of rebuilt.
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the masters generated are compressed. If None, they are written uncompressed.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, the gzipped files of the catalog are decompressed to the
+    cache in parallel before the masters are generated. The catalog must
+    have been scanned with the same cache to read the decompressed copies.
+
+    Returns
+    -------
+    master_darks: dict
+    The master darks, with the exposure time as key.
+
+    master_flats: dict
+    The master flats, with the filter as key.
+
+    master_bias: finestres_al_cel_reduction.fits_file.FitsFile or None
+    The master bias, None if there is none in the catalog and no bias
+    frames to generate it.
+
+    Raises
+    ------
+    ValueError: If a master cannot be generated.
+    """
+    cache = MasterCache(output_folder) if use_cache else None
+    if decompression_cache is not None:
+        decompression_cache.prefetch(calibration_catalog.calibration_filenames)
+    master_bias = generate_master_bias(
+        calibration_catalog.biases, output_folder, average=average,
+        memory_budget=memory_budget, workers=workers, cache=cache, compression=compression)
+    if master_bias is None and len(calibration_catalog.master_biases) > 0:
+        master_bias = calibration_catalog.master_biases[0]
+    master_darks = {
+        exposure_time: files[0]
+        for exposure_time, files in calibration_catalog.master_darks.items()}
+    master_darks.update(generate_master_darks(
+        calibration_catalog.darks, output_folder, average=average,
+        memory_budget=memory_budget, workers=workers, cache=cache, compression=compression))
+    master_flats = {
+        filter_name: files[0]
+        for filter_name, files in calibration_catalog.master_flats.items()}
+    master_flats.update(generate_master_flats(
+        calibration_catalog.flats, master_darks, output_folder, average=average,
+        memory_budget=memory_budget, workers=workers, cache=cache, master_bias=master_bias,
+        compression=compression))
+    return master_darks, master_flats, master_bias
+
+def get_calibrated_filename(file, output_folder):
+    """Get the path where the calibrated version of a file is written.
+
+    Arguments
+    ---------
+    file: finestres_al_cel_reduction.fits_file.FitsFile
+    The file to calibrate.
+
+    output_folder: str
+    Folder where the calibrated files are written.
+
+    Returns
+    -------
+    filename: str
+    The path to the calibrated file.
+    """
+    return os.path.join(output_folder, f"calibrated_{file.title}")
+
+def _get_compression_parameters(compression):
+    """Get the cache parameters describing how a master is compressed.
+
+    Uncompressed masters add no parameters, so their cache keys are the same
+    as before compression was supported.
+
+    Arguments
+    ---------
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None
+    How the master is compressed.
+
+    Returns
+    -------
+    parameters: dict
+    The parameters to add to the cache key.
+    """
+    if compression is None or not compression.compressed:
+        return {}
+    return {"compression": repr(compression)}
+
+def _offset_progress(progress_callback, offset, total):
+    """Wrap a progress callback to report the progress of a step within a larger task.
+
+    Arguments
+    ---------
+    progress_callback: function or None
+    The progress callback of the larger task.
+
+    offset: int
+    Number of items of the larger task done before this step starts.
+
+    total: int
+    Total number of items of the larger task.
+
+    Returns
+    -------
+    step_progress_callback: function or None
+    Progress callback for the step, None if progress_callback is None.
+    """
+    if progress_callback is None:
+        return None
+    return lambda done, _: progress_callback(offset + done, total)
+
+def _report_progress(progress_callback, done, total):
+    """Report progress through a progress callback, if there is one.
+
+    Arguments
+    ---------
+    progress_callback: function or None
+    The progress callback.
+
+    done: int
+    Number of items done.
+
+    total: int
+    Total number of items.
+    """
+    if progress_callback is not None:
+        progress_callback(done, total)
+
+def run_pipeline(raw_folder, calibration_folder=None, output_folder=None, average="median",
+                 stack_average="median", memory_budget=DEFAULT_MEMORY_BUDGET,
+                 workers=DEFAULT_WORKERS, use_cache=True, registration="none",
+                 master_compression=None, light_compression=None, stack_compression=None,
+                 decompression_cache=None, registration_workers=DEFAULT_REGISTRATION_WORKERS):
+    """Run the full reduction of a night.
+
+    Master biases, darks and flats are generated from the calibration frames,
+    the light frames are calibrated one at a time, and one stack per filter is
+    produced from the calibrated files on disk. All products are written to
+    the output folder.
+
+    Arguments
+    ---------
+    raw_folder: str
+    Folder with the light frames. It may also contain the calibration frames.
+
+    calibration_folder: str or None - Default None
+    Folder with the calibration frames. If None, they are taken from raw_folder.
+
+    output_folder: str or None - Default None
+    Folder where the products are written. If None, a DEFAULT_OUTPUT_SUBFOLDER
+    subfolder of raw_folder is used.
+
+    average: str - Default "median"
+    The method used to combine the calibration frames.
+
+    stack_average: str - Default "median"
+    The method used to combine the light frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine frames.
+
+    use_cache: bool - Default True
+    If True, masters whose inputs and parameters have not changed since they
+    were last generated in output_folder are reused instead of rebuilt.
+
+    registration: str - Default "none"
+    The transforms corrected when aligning the light frames before stacking.
+    See finestres_al_cel_reduction.registration.VALID_REGISTRATION_METHODS.
+
+    master_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the masters are compressed. If None, they are written uncompressed.
+
+    light_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the calibrated light frames are compressed. If None, they are written uncompressed.
+
+    stack_compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the stacks are compressed. If None, they are written uncompressed.
+
+    decompression_cache: finestres_al_cel_reduction.decompression_cache.DecompressionCache or None - Default None
+    If not None, gzipped frames are decompressed to the cache in parallel
+    and read from the decompressed copies.
+
+    registration_workers: int - Default DEFAULT_REGISTRATION_WORKERS
+    Number of light frames registered at the same time.
+
+    Returns
+    -------
+    master_darks: dict
+    The master darks, with the exposure time as key.
+
+    master_flats: dict
+    The master flats, with the filter as key.
+
+    stacks: dict
+    The stacked light frames, with the filter as key.
+
+    Raises
+    ------
+    ValueError: If any of the products cannot be generated.
+    """
+    if output_folder is None:
+        output_folder = os.path.join(raw_folder, DEFAULT_OUTPUT_SUBFOLDER)
+    os.makedirs(output_folder, exist_ok=True)
+
+    raw_catalog = CalibrationCatalog(raw_folder, decompression_cache=decompression_cache)
+    if calibration_folder is None or os.path.abspath(calibration_folder) == os.path.abspath(raw_folder):
+        calibration_catalog = raw_catalog
+    else:
+        calibration_catalog = CalibrationCatalog(
+            calibration_folder, decompression_cache=decompression_cache)
+    skipped = raw_catalog.skipped
+    if calibration_catalog is not raw_catalog:
+        skipped = skipped + calibration_catalog.skipped
+    for _, reason in skipped:
+        logger.warning("%s Skipping.", reason)
+
+    master_darks, master_flats, master_bias = get_catalog_masters(
+        calibration_catalog, output_folder, average=average,
+        memory_budget=memory_budget, workers=workers, use_cache=use_cache,
+        compression=master_compression, decompression_cache=decompression_cache)
+
+    # master darks are scaled to the exposure times without a master dark
+    calibrated = calibrate_lights_streaming(
+        [file.filename for file in raw_catalog.lights],
+        DarkLibrary(master_darks, master_bias), master_flats, output_folder,
+        compression=light_compression, decompression_cache=decompression_cache)
+    stacks = stack_lights(
+        calibrated, output_folder, average=stack_average,
+        memory_budget=memory_budget, workers=workers, registration=registration,
+        compression=stack_compression, registration_workers=registration_workers)
+
+    return master_darks, master_flats, stacks
+
+def stack_lights(lights, output_folder, average="median",
+                 memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_WORKERS,
+                 progress_callback=None, registration="none", compression=None,
+                 registration_workers=DEFAULT_REGISTRATION_WORKERS):
+    """Stack light frames and save one stack per filter.
+
+    Arguments
+    ---------
+    lights: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The light frames to stack.
+
+    output_folder: str
+    Folder where the stacks are written.
+
+    average: str - Default "median"
+    The method used to combine the light frames.
+
+    memory_budget: int - Default DEFAULT_MEMORY_BUDGET
+    Approximate maximum number of bytes used while combining the frames.
+
+    workers: int - Default DEFAULT_WORKERS
+    Number of worker processes used to combine the frames.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) before the first
+    stack and after each one. It may raise ReductionCancelled to stop.
+
+    registration: str - Default "none"
+    The transforms corrected when aligning the frames of each filter before
+    stacking them (see align_lights).
+
+    compression: finestres_al_cel_reduction.compression.OutputCompression or None - Default None
+    How the stacks are compressed. If None, they are written uncompressed.
+
+    registration_workers: int - Default DEFAULT_REGISTRATION_WORKERS
+    Number of frames registered at the same time.
+
+    Returns
+    -------
+    stacks: dict
+    The stacked light frames, with the filter as key.
+
+    Raises
+    ------
+    ValueError: If a stack cannot be generated.
+    """
+    lights_by_filter = {}
+    for file in lights:
+        lights_by_filter.setdefault(getattr(file, "filter", "Unknown"), []).append(file)
+
+    stacks = {}
+    _report_progress(progress_callback, 0, len(lights_by_filter))
+    for filter_name, files in sorted(lights_by_filter.items()):
+        filename = os.path.join(output_folder, f"master_stack_{filter_name}.fits")
+        try:
+            files = align_lights(
+                files, registration=registration, workers=registration_workers)
+            stack = MasterFitsFile(
+                filename, files, average=average, memory_budget=memory_budget, workers=workers)
+        except ValueError as error:
+            raise ValueError(
+                f"Error stacking images for filter {filter_name}: {str(error)}") from error
+        stack.save(compression=compression)
+        stacks[filter_name] = stack
+        logger.info("Generated %s from %d frames", stack.title, len(files))
+        _report_progress(progress_callback, len(stacks), len(lights_by_filter))
+
+    return stacks
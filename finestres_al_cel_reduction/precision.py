@@ -0,0 +1,41 @@
+"""Working precision of the pixel data during the reduction."""
+import numpy as np
+
+VALID_PRECISIONS = ["float32", "float64"]
+
+# Floating point type used for all pixel data loaded, calibrated, combined
+# and saved in this session
+_working_dtype = np.dtype("float64")
+
+def get_working_dtype():
+    """Get the floating point type used for the pixel data.
+
+    Returns
+    -------
+    dtype: np.dtype
+    The working floating point type.
+    """
+    return _working_dtype
+
+def set_working_precision(precision):
+    """Set the floating point type used for the pixel data in this session.
+
+    Files already loaded keep their current type. Single precision (float32)
+    halves the memory and the size of the saved files, and is enough for
+    16-bit camera data.
+
+    Arguments
+    ---------
+    precision: str
+    The working precision. Can be "float32" or "float64".
+
+    Raises
+    ------
+    ValueError: If the precision is not valid
+    """
+    global _working_dtype # pylint: disable=global-statement
+    if precision not in VALID_PRECISIONS:
+        raise ValueError(
+            f"Invalid precision '{precision}'. "
+            f"Valid precisions are: {VALID_PRECISIONS}.")
+    _working_dtype = np.dtype(precision)
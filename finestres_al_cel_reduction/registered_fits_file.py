@@ -0,0 +1,107 @@
+"""Fits file class for handling FITS files in the application."""
+import copy
+
+import numpy as np
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+from finestres_al_cel_reduction.registration import bilinear_sample, get_source_coordinates
+
+class RegisteredFitsFile(FitsFile):
+    """Class representing an exposure resampled onto the pixel grid of a reference.
+
+    The resampled pixels are computed from the original exposure when they
+    are read, so registering a file does not use any memory until its data
+    is needed. Pixels falling outside the original exposure are NaN.
+    """
+
+    # the resampled data is computed when it is first accessed
+    header_only = True
+
+    def __init__(self, source, transform):
+        """Initialize the RegisteredFitsFile instance.
+
+        Arguments
+        ---------
+        source: finestres_al_cel_reduction.fits_file.FitsFile
+        The original exposure.
+
+        transform: tuple of float
+        The (row shift, column shift, angle) transform aligning the exposure
+        with the reference. See finestres_al_cel_reduction.registration.get_transform.
+
+        Raises
+        ------
+        ValueError: If the source is not an image.
+        """
+        if not isinstance(source, FitsFile) or source.type != "IMAGE":
+            raise ValueError("The source of a registered file must be an image.")
+        self.source = source
+        self.transform = tuple(float(value) for value in transform)
+
+        self.filename = source.filename
+        self.title = source.title
+        self.memmap = False
+
+        self.data = None
+        self.header = copy.deepcopy(source.header)
+        self.header["HISTORY"] = (
+            f"Registered: shift ({self.transform[0]:.2f}, {self.transform[1]:.2f}) px, "
+            f"rotation {np.degrees(self.transform[2]):.3f} deg")
+        self.type = source.type
+        for attribute in ("exposure_time", "filter", "image_type"):
+            if hasattr(source, attribute):
+                setattr(self, attribute, getattr(source, attribute))
+
+        self.modified = False
+
+    def load_data(self):
+        """Reset the header from the original exposure."""
+        self.header = copy.deepcopy(self.source.header)
+
+    def load_pixels(self):
+        """Compute the full resampled pixel data."""
+        self.data = self.read_rows(0, self.shape[0])
+
+    def read_rows(self, start, stop):
+        """Read a strip of rows of the resampled pixel data.
+
+        Only the rows of the original exposure covering the strip are read.
+
+        Arguments
+        ---------
+        start: int
+        First row of the strip.
+
+        stop: int
+        Row after the last row of the strip.
+
+        Returns
+        -------
+        rows: np.ndarray
+        The resampled pixel data in rows start to stop.
+        """
+        if self._data is not None:
+            return self._data[start:stop]
+
+        shape = self.shape
+        rows, cols = get_source_coordinates(self.transform, shape, start, stop)
+
+        # band of rows of the original exposure needed for this strip,
+        # at least two rows are needed to interpolate
+        band_start = int(np.clip(np.floor(rows.min()), 0, shape[0] - 2))
+        band_stop = int(np.clip(np.ceil(rows.max()) + 1, band_start + 2, shape[0]))
+        band = np.asarray(self.source.read_rows(band_start, band_stop), dtype=get_working_dtype())
+        return bilinear_sample(band, rows - band_start, cols)
+
+    def release_data(self, discard_changes=False):
+        """Drop the resampled pixel data and that of the original exposure.
+
+        Arguments
+        ---------
+        discard_changes: bool - Default False
+        If False, files modified since they were last saved keep their data.
+        If True, the modifications are discarded.
+        """
+        super().release_data(discard_changes=discard_changes)
+        self.source.release_data(discard_changes=discard_changes)
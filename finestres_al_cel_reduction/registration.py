@@ -0,0 +1,363 @@
+"""Registration of individual exposures onto the pixel grid of a reference."""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+
+import numpy as np
+
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+VALID_REGISTRATION_METHODS = ["none", "shift", "shift+rotation"]
+
+# Default number of exposures registered at the same time. numpy releases the
+# GIL while computing the FFTs, so threads are enough
+DEFAULT_REGISTRATION_WORKERS = min(8, os.cpu_count() or 1)
+
+# Sampling of the amplitude spectra in polar coordinates, used to estimate
+# rotations. Angles cover 180 degrees as the amplitude spectrum is symmetric
+POLAR_ANGLES = 720
+POLAR_RADII = 128
+
+def bilinear_sample(data, rows, cols):
+    """Sample an image at fractional pixel coordinates.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image. It must have at least two rows and two columns.
+
+    rows: np.ndarray
+    Row coordinates of the samples.
+
+    cols: np.ndarray
+    Column coordinates of the samples, with the same shape as rows.
+
+    Returns
+    -------
+    samples: np.ndarray
+    The interpolated values, in the working precision. Samples outside the
+    image are NaN.
+    """
+    num_rows, num_cols = data.shape
+    inside = (rows >= 0) & (rows <= num_rows - 1) & (cols >= 0) & (cols <= num_cols - 1)
+    rows = np.clip(rows, 0, num_rows - 1)
+    cols = np.clip(cols, 0, num_cols - 1)
+    row_0 = np.minimum(rows.astype(np.intp), num_rows - 2)
+    col_0 = np.minimum(cols.astype(np.intp), num_cols - 2)
+
+    dtype = get_working_dtype()
+    row_weight = (rows - row_0).astype(dtype)
+    col_weight = (cols - col_0).astype(dtype)
+    top = (data[row_0, col_0] * (1 - col_weight) +
+           data[row_0, col_0 + 1] * col_weight)
+    bottom = (data[row_0 + 1, col_0] * (1 - col_weight) +
+              data[row_0 + 1, col_0 + 1] * col_weight)
+    samples = (top * (1 - row_weight) + bottom * row_weight).astype(dtype, copy=False)
+    samples[~inside] = np.nan
+    return samples
+
+def estimate_rotation(reference_polar, data_polar):
+    """Estimate the rotation between two images from their polar amplitude spectra.
+
+    The amplitude spectrum does not depend on shifts, and a rotation of the
+    image is a shift of its polar spectrum along the angle axis. As the
+    spectrum is symmetric, the rotation is only known modulo 180 degrees.
+
+    Arguments
+    ---------
+    reference_polar: np.ndarray
+    Polar amplitude spectrum of the reference image (see get_polar_spectrum).
+
+    data_polar: np.ndarray
+    Polar amplitude spectrum of the image (see get_polar_spectrum).
+
+    Returns
+    -------
+    angle: float
+    The counter-clockwise rotation of the image with respect to the
+    reference, in radians, between -pi/2 and pi/2.
+    """
+    # correlate along the angle axis only, averaging over the radii
+    cross_power = np.fft.rfft(data_polar, axis=0) * np.conj(np.fft.rfft(reference_polar, axis=0))
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(cross_power.real.dtype).tiny)
+    correlation = np.fft.irfft(cross_power.mean(axis=1), n=POLAR_ANGLES)
+
+    peak = int(np.argmax(correlation))
+    neighbours = correlation[[(peak - 1) % POLAR_ANGLES, peak, (peak + 1) % POLAR_ANGLES]]
+    curvature = neighbours[0] - 2 * neighbours[1] + neighbours[2]
+    subpixel = 0.5 * (neighbours[0] - neighbours[2]) / curvature if curvature < 0 else 0.0
+    shift = (peak + subpixel + POLAR_ANGLES / 2) % POLAR_ANGLES - POLAR_ANGLES / 2
+    return shift * np.pi / POLAR_ANGLES
+
+def estimate_shift(reference_fft, data_fft, shape):
+    """Estimate the shift between two images with phase correlation.
+
+    Arguments
+    ---------
+    reference_fft: np.ndarray
+    Real FFT of the reference image (see get_fft).
+
+    data_fft: np.ndarray
+    Real FFT of the image (see get_fft).
+
+    shape: tuple of int
+    Shape of both images.
+
+    Returns
+    -------
+    shift: np.ndarray
+    The (row, column) shift, with subpixel precision, such that
+    image(p) = reference(p - shift).
+
+    peak: float
+    Height of the correlation peak, between 0 and 1. Higher values mean a
+    more reliable match.
+    """
+    cross_power = data_fft * np.conj(reference_fft)
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(cross_power.real.dtype).tiny)
+    correlation = np.fft.irfft2(cross_power, s=shape)
+
+    peak_index = np.unravel_index(np.argmax(correlation), shape)
+    shift = np.zeros(2)
+    for axis, size in enumerate(shape):
+        # fit a parabola to the peak and its two neighbours along this axis
+        neighbours = []
+        for offset in (-1, 0, 1):
+            index = list(peak_index)
+            index[axis] = (index[axis] + offset) % size
+            neighbours.append(correlation[tuple(index)])
+        curvature = neighbours[0] - 2 * neighbours[1] + neighbours[2]
+        subpixel = 0.5 * (neighbours[0] - neighbours[2]) / curvature if curvature < 0 else 0.0
+        # shifts larger than half the image wrap around
+        shift[axis] = (peak_index[axis] + subpixel + size / 2) % size - size / 2
+
+    return shift, float(correlation[peak_index])
+
+def estimate_transforms(individual_exposures, reference=None, rotation=False,
+                        workers=DEFAULT_REGISTRATION_WORKERS, progress_callback=None):
+    """Estimate the transforms aligning several exposures with a reference.
+
+    Each exposure is registered independently against the reference in a
+    pool of threads. Header-only exposures are released as soon as they are
+    registered.
+
+    Arguments
+    ---------
+    individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+    The exposures to register.
+
+    reference: finestres_al_cel_reduction.fits_file.FitsFile or None - Default None
+    The exposure defining the common pixel grid. If None, the first exposure is used.
+
+    rotation: bool - Default False
+    If True, rotations are estimated as well as shifts.
+
+    workers: int - Default DEFAULT_REGISTRATION_WORKERS
+    Number of exposures registered at the same time.
+
+    progress_callback: function or None - Default None
+    If not None, called as progress_callback(done, total) after each
+    exposure. It may raise an exception to stop the registration.
+
+    Returns
+    -------
+    transforms: list of tuple
+    The transform of each exposure (see get_transform), in the same order.
+
+    Raises
+    ------
+    ValueError: If no exposures are given or they do not have the same shape.
+    """
+    if len(individual_exposures) == 0:
+        raise ValueError("No individual exposures provided.")
+    if reference is None:
+        reference = individual_exposures[0]
+    shape = reference.shape
+    if any(item.shape != shape for item in individual_exposures):
+        raise ValueError("All individual exposures must have the same shape.")
+
+    reference_fft = get_fft(reference.data)
+    reference_polar = get_polar_spectrum(reference.data) if rotation else None
+    reference.release_data()
+
+    def register(item):
+        transform = get_transform(reference_fft, reference_polar, item.data)
+        item.release_data()
+        return transform
+
+    transforms = [None] * len(individual_exposures)
+    pending = list(enumerate(individual_exposures))
+    running = {}
+    done_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while pending or running:
+                # only keep as many frames in memory as workers
+                while pending and len(running) < workers:
+                    index, item = pending.pop(0)
+                    running[executor.submit(register, item)] = index
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    transforms[running.pop(future)] = future.result()
+                    done_count += 1
+                    if progress_callback is not None:
+                        progress_callback(done_count, len(individual_exposures))
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+    return transforms
+
+def get_fft(data):
+    """Compute the real FFT used to register an image.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image.
+
+    Returns
+    -------
+    data_fft: np.ndarray
+    The real FFT of the tapered image (see _taper).
+    """
+    return np.fft.rfft2(_taper(data))
+
+def get_polar_spectrum(data):
+    """Compute the amplitude spectrum of an image in polar coordinates.
+
+    The spectrum is computed on the largest centred square of the image, so
+    that both frequency axes have the same scale.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image.
+
+    Returns
+    -------
+    polar: np.ndarray
+    The logarithm of the amplitude spectrum sampled at POLAR_ANGLES angles
+    (first axis) and POLAR_RADII radii (second axis). The lowest frequencies,
+    dominated by the background, are excluded.
+    """
+    size = min(data.shape)
+    row_start = (data.shape[0] - size) // 2
+    col_start = (data.shape[1] - size) // 2
+    square = data[row_start:row_start + size, col_start:col_start + size]
+    amplitude = np.log1p(np.abs(np.fft.fftshift(np.fft.fft2(_taper(square)))))
+
+    center = size // 2
+    angles = np.linspace(0, np.pi, POLAR_ANGLES, endpoint=False)
+    radii = np.linspace(size / 16, 0.9 * center, POLAR_RADII)
+    rows = center + np.outer(np.sin(angles), radii)
+    cols = center + np.outer(np.cos(angles), radii)
+    return bilinear_sample(amplitude, rows, cols)
+
+def get_source_coordinates(transform, shape, start, stop):
+    """Compute where the pixels of a registered image are taken from.
+
+    Arguments
+    ---------
+    transform: tuple of float
+    The (row shift, column shift, angle) transform of the image (see
+    get_transform).
+
+    shape: tuple of int
+    Shape of the image.
+
+    start: int
+    First row of the registered image.
+
+    stop: int
+    Row after the last row of the registered image.
+
+    Returns
+    -------
+    rows: np.ndarray
+    Row coordinates, in the original image, of each pixel in rows start to
+    stop of the registered image.
+
+    cols: np.ndarray
+    Column coordinates, in the original image, of the same pixels.
+    """
+    shift_row, shift_col, angle = transform
+    center_row = (shape[0] - 1) / 2
+    center_col = (shape[1] - 1) / 2
+    offset_rows = np.arange(start, stop, dtype=float)[:, np.newaxis] - center_row
+    offset_cols = np.arange(shape[1], dtype=float)[np.newaxis, :] - center_col
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+    rows = sin * offset_cols + cos * offset_rows + center_row + shift_row
+    cols = cos * offset_cols - sin * offset_rows + center_col + shift_col
+    return rows, cols
+
+def get_transform(reference_fft, reference_polar, data):
+    """Estimate the transform aligning an image with a reference.
+
+    Arguments
+    ---------
+    reference_fft: np.ndarray
+    Real FFT of the reference image (see get_fft).
+
+    reference_polar: np.ndarray or None
+    Polar amplitude spectrum of the reference image (see get_polar_spectrum).
+    If None, only the shift is estimated.
+
+    data: np.ndarray
+    The image.
+
+    Returns
+    -------
+    transform: tuple of float
+    The (row shift, column shift, angle) transform. The pixel p of the
+    registered image is taken from the position R(angle) (p - c) + c + shift
+    of the image, where c is its centre.
+    """
+    shape = data.shape
+    if reference_polar is None:
+        shift, _ = estimate_shift(reference_fft, get_fft(data), shape)
+        return (shift[0], shift[1], 0.0)
+
+    # the rotation is known modulo 180 degrees, keep the candidate that
+    # correlates best once derotated
+    angle = estimate_rotation(reference_polar, get_polar_spectrum(data))
+    best = None
+    for candidate in (angle, angle + np.pi):
+        rows, cols = get_source_coordinates((0.0, 0.0, candidate), shape, 0, shape[0])
+        shift, peak = estimate_shift(
+            reference_fft, get_fft(bilinear_sample(data, rows, cols)), shape)
+        if best is None or peak > best[0]:
+            best = (peak, shift, candidate)
+
+    # the shift was measured on the derotated image, rotate it back
+    _, (shift_row, shift_col), angle = best
+    angle = (angle + np.pi) % (2 * np.pi) - np.pi
+    return (np.sin(angle) * shift_col + np.cos(angle) * shift_row,
+            np.cos(angle) * shift_col - np.sin(angle) * shift_row,
+            angle)
+
+def _taper(data):
+    """Prepare an image to be registered.
+
+    Missing values are filled with the median, and the image is tapered with
+    a Hann window so that its edges do not dominate the correlation.
+
+    Arguments
+    ---------
+    data: np.ndarray
+    The image.
+
+    Returns
+    -------
+    tapered: np.ndarray
+    The tapered image, in the working precision.
+    """
+    dtype = get_working_dtype()
+    data = np.asarray(data, dtype=dtype)
+    finite = np.isfinite(data)
+    fill = np.median(data[finite]) if finite.any() else 0
+    data = np.where(finite, data, fill) - fill
+    window = np.outer(np.hanning(data.shape[0]), np.hanning(data.shape[1])).astype(dtype)
+    return data * window
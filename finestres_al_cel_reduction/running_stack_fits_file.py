@@ -0,0 +1,220 @@
+"""Fits file class for handling FITS files in the application."""
+import copy
+
+import numpy as np
+
+from finestres_al_cel_reduction.combine import (
+    DEFAULT_MEMORY_BUDGET, SIGMA_CLIP_SIGMA, combine_strips,
+)
+from finestres_al_cel_reduction.master_fits_file import FILTERLESS_IMAGE_TYPES, MasterFitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+VALID_RUNNING_AVERAGE_METHODS = ["mean", "median", "sigma_clip"]
+
+# Number of exposures combined exactly before the "median" and "sigma_clip"
+# running estimators start. They are initialized from the median and the
+# median absolute deviation of these exposures, so that outliers in the
+# first exposures do not bias the stack
+RUNNING_WARMUP_EXPOSURES = 5
+
+# Ratio between the standard deviation and the median absolute deviation
+# of a normal distribution
+MAD_TO_STD = 1.4826
+
+class RunningStackFitsFile(MasterFitsFile):
+    """Class representing a stack that is updated as new exposures arrive.
+
+    Instead of the individual exposures, only a few running statistics are
+    kept for each pixel, so adding an exposure costs the same regardless of
+    the number of exposures already stacked. For each pixel:
+    - "mean" keeps the number of values and their running mean;
+    - "sigma_clip" does the same, but a new value is not added if it is further
+      than SIGMA_CLIP_SIGMA standard deviations from the running mean;
+    - "median" keeps a stochastic approximation of the median, which moves
+      towards each new value by a step that shrinks as 1 / count.
+    The first RUNNING_WARMUP_EXPOSURES exposures of the "median" and
+    "sigma_clip" stacks are kept and combined exactly. The pixel data is a
+    copy of the running statistics, so it can be modified (or evicted from
+    memory) without changing the stack.
+    """
+
+    def __init__(self, filename, individual_exposures, average="mean"):
+        """Initialize the RunningStackFitsFile instance.
+
+        Arguments
+        ---------
+        filename: str
+        The path to the FITS file.
+
+        individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+        List of individual exposure FITS files the stack starts with. More
+        can be added with add_exposure.
+
+        average: str - Default "mean"
+        The method used to combine the individual exposures. See
+        VALID_RUNNING_AVERAGE_METHODS.
+
+        Raises
+        -------
+        ValueError:
+        - If the average method is not valid
+        """
+        if average not in VALID_RUNNING_AVERAGE_METHODS:
+            raise ValueError(
+                f"Invalid average method '{average}'. "
+                f"Valid methods are: {VALID_RUNNING_AVERAGE_METHODS}.")
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.median = None
+        self.scale = None
+        self.warmup = []
+        super().__init__(
+            filename, individual_exposures, average=average,
+            memory_budget=DEFAULT_MEMORY_BUDGET, workers=1)
+
+    def add_exposure(self, exposure):
+        """Add an exposure to the stack.
+
+        The pixel data of header-only exposures is released afterwards.
+
+        Arguments
+        ---------
+        exposure: finestres_al_cel_reduction.fits_file.FitsFile
+        The exposure to add.
+
+        Raises
+        -------
+        ValueError:
+        - If the exposure is not an image
+        - if it is not of the same type as the stacked exposures
+        - if it does not have the same exposure time
+        - if it does not have the same filter (not for bias and dark frames)
+        - if it does not have the same shape
+        """
+        if exposure.type != "IMAGE":
+            raise ValueError("The exposure must be of type 'IMAGE'.")
+        if exposure.image_type != self.exposure_image_type:
+            raise ValueError("The exposure must be of the same type as the stacked exposures.")
+        if exposure.exposure_time != self.exposure_time:
+            raise ValueError("The exposure must have the same exposure time as the stacked exposures.")
+        if (self.exposure_image_type not in FILTERLESS_IMAGE_TYPES and
+                exposure.filter != self.filter):
+            raise ValueError("The exposure must have the same filter as the stacked exposures.")
+        if self.count is not None and exposure.shape != self.count.shape:
+            raise ValueError("The exposure must have the same shape as the stacked exposures.")
+
+        values = np.asarray(exposure.data, dtype=get_working_dtype())
+        exposure.release_data()
+        if self.count is None:
+            self.count = np.zeros(values.shape, dtype=np.int32)
+            self.mean = np.full(values.shape, np.nan, dtype=values.dtype)
+            self.m2 = np.zeros(values.shape, dtype=values.dtype)
+
+        if self.average == "mean":
+            self._update_moments(values, np.isfinite(values))
+            self.data = self.mean.copy()
+        elif self.warmup is not None:
+            self.warmup.append(values)
+            self.data = combine_strips(np.array(self.warmup), self.average)
+            if len(self.warmup) == RUNNING_WARMUP_EXPOSURES:
+                self._start_running_estimator()
+        elif self.average == "sigma_clip":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                std = np.sqrt(self.m2 / self.count)
+                clipped = (np.abs(values - self.mean) > SIGMA_CLIP_SIGMA * std) & (std > 0)
+            self._update_moments(values, np.isfinite(values) & ~clipped)
+            self.data = self.mean.copy()
+        else:
+            valid = np.isfinite(values)
+            self._update_moments(values, valid)
+            # the warm-up scale of quantized data is often 0, which would freeze
+            # the median, so it is floored by the running standard deviation
+            with np.errstate(invalid="ignore", divide="ignore"):
+                scale = np.fmax(self.scale, np.sqrt(self.m2 / self.count))
+            # the optimal step for a normal distribution is
+            # 1 / (count * density at the median) = sqrt(2 pi) std / count
+            step = np.sqrt(2 * np.pi) * scale / np.maximum(self.count, 1)
+            update = valid & np.isfinite(self.median)
+            self.median[update] += (step * np.sign(values - self.median))[update]
+            new = valid & ~np.isfinite(self.median)
+            self.median[new] = values[new]
+            self.data = self.median.copy()
+
+        self.num_exposures += 1
+        self.header["NCOMBINE"] = self.num_exposures
+        self.modified = True
+
+    def combine_individual_exposures(self, individual_exposures):
+        """Start the stack from a list of individual exposures.
+
+        Arguments
+        ---------
+        individual_exposures: list of finestres_al_cel_reduction.fits_file.FitsFile
+        List of individual exposure FITS files to combine.
+
+        Raises
+        -------
+        ValueError:
+        - If no individual exposures are provided
+        - if they are not valid FITS files
+        - if they are not of the same type
+        - if they do not have the same exposure time
+        - if they do not have the same filter (not for bias and dark frames)
+        - if they do not have the same shape
+        """
+        self.check_individual_exposures(individual_exposures)
+        self.exposure_image_type = self.image_type
+        self.image_type = f"Master {self.image_type}"
+
+        self.header = copy.deepcopy(individual_exposures[0].header)
+        self.header["IMAGETYP"] = self.image_type
+        self.header["HISTORY"] = f"Running stack using {self.average} method."
+        self.type = "IMAGE"
+
+        self.num_exposures = 0
+        for item in individual_exposures:
+            self.add_exposure(item)
+
+    def _start_running_estimator(self):
+        """Initialize the running estimator from the warm-up exposures and drop them."""
+        warmup = np.array(self.warmup)
+        self.warmup = None
+        with np.errstate(invalid="ignore"):
+            center = np.nanmedian(warmup, axis=0)
+            self.scale = MAD_TO_STD * np.nanmedian(np.abs(warmup - center), axis=0)
+        self.scale = np.nan_to_num(self.scale).astype(warmup.dtype)
+
+        self.count[:] = 0
+        self.mean[:] = np.nan
+        self.m2[:] = 0
+        for values in warmup:
+            valid = np.isfinite(values)
+            if self.average == "sigma_clip":
+                with np.errstate(invalid="ignore"):
+                    valid &= ~((np.abs(values - center) > SIGMA_CLIP_SIGMA * self.scale) &
+                               (self.scale > 0))
+            self._update_moments(values, valid)
+        if self.average == "median":
+            self.median = center
+
+    def _update_moments(self, values, valid):
+        """Add new values to the running count, mean and sum of squared deviations.
+
+        Welford's algorithm is used, as it stays accurate in single precision.
+
+        Arguments
+        ---------
+        values: np.ndarray
+        The new value of each pixel.
+
+        valid: np.ndarray
+        Boolean mask of the pixels whose value is added.
+        """
+        self.count += valid
+        first = valid & (self.count == 1)
+        self.mean[first] = 0
+        delta = np.where(valid, values - self.mean, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean += np.where(valid, delta / self.count, 0)
+        self.m2 += np.where(valid, delta * (values - self.mean), 0)
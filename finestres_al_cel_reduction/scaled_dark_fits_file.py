@@ -0,0 +1,71 @@
+"""Fits file class for handling FITS files in the application."""
+import copy
+import os
+
+import numpy as np
+
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.precision import get_working_dtype
+
+class ScaledDarkFitsFile(FitsFile):
+    """Class representing a master dark scaled to another exposure time.
+
+    The bias does not depend on the exposure time while the dark current
+    grows linearly with it, so a master dark of exposure time t0 is scaled
+    to an exposure time t as bias + (dark - bias) * t / t0.
+    """
+
+    def __init__(self, master_dark, master_bias, exposure_time):
+        """Initialize the ScaledDarkFitsFile instance.
+
+        Arguments
+        ---------
+        master_dark: finestres_al_cel_reduction.fits_file.FitsFile
+        The master dark to scale.
+
+        master_bias: finestres_al_cel_reduction.fits_file.FitsFile
+        The master bias, subtracted before scaling and added back afterwards.
+
+        exposure_time: float
+        The exposure time of the scaled dark.
+
+        Raises
+        ------
+        ValueError:
+        - If the master dark has no exposure time
+        - if the shapes of the master dark and the master bias do not match
+        """
+        if not master_dark.exposure_time:
+            raise ValueError(f"Cannot scale {master_dark.title}, its exposure time is zero.")
+        if master_dark.shape != master_bias.shape:
+            raise ValueError(
+                f"The shapes of {master_dark.title} {master_dark.shape} and "
+                f"{master_bias.title} {master_bias.shape} do not match.")
+        self.master_dark = master_dark
+        self.master_bias = master_bias
+
+        self.filename = os.path.join(
+            os.path.dirname(master_dark.filename), f"scaled_dark_{exposure_time}s.fits")
+        self.title = f"{master_dark.title} scaled to {exposure_time}s"
+        self.header_only = False
+        self.memmap = False
+
+        # scale the dark current without any temporary array
+        dtype = get_working_dtype()
+        bias = np.asarray(master_bias.data, dtype=dtype)
+        data = np.array(master_dark.data, dtype=dtype)
+        data -= bias
+        data *= exposure_time / master_dark.exposure_time
+        data += bias
+        self.data = data
+
+        self.header = copy.deepcopy(master_dark.header)
+        self.header["EXPTIME"] = exposure_time
+        self.header["HISTORY"] = (
+            f"Scaled from {master_dark.exposure_time}s to {exposure_time}s "
+            f"using master bias: {master_bias.title}")
+        self.type = "IMAGE"
+        self.image_type = master_dark.image_type
+        self.exposure_time = exposure_time
+
+        self.modified = True
@@ -0,0 +1,312 @@
+"""Synthetic bias, dark, flat and light frames, used to benchmark the reduction."""
+import datetime
+import os
+
+from astropy.io import fits
+import numpy as np
+
+# Mean bias level and its pixel to pixel variation, in ADU
+BIAS_LEVEL = 1000.0
+BIAS_PATTERN = 5.0
+
+# Read noise, in ADU
+READ_NOISE = 8.0
+
+# Mean dark current, in ADU per second. It varies by up to 50% between pixels,
+# and a few hot pixels have 100 times the mean
+DARK_CURRENT = 0.05
+HOT_PIXEL_FRACTION = 1e-4
+
+# Relative drop of the flat field at the corners of the frame
+VIGNETTING = 0.3
+
+# Flat frames are exposed to this level, in ADU above the bias
+FLAT_LEVEL = 20000.0
+
+# Sky background and flux of the brightest star, in ADU per second
+SKY_LEVEL = 5.0
+MAX_STAR_FLUX = 2000.0
+
+# Number of stars per million pixels and their Gaussian width, in pixels
+STAR_DENSITY = 200
+STAR_SIGMA = 1.5
+
+# Maximum offset between light frames, in pixels
+MAX_DITHER = 3.0
+
+# Largest value of the 16-bit unsigned integers written by the camera
+SATURATION = 65535
+
+class SyntheticCamera:
+    """Class generating the frames taken by a simulated CCD camera.
+
+    The bias pattern, the dark current, the flat field and the star field
+    are fixed when the camera is created, so all the frames of a camera can
+    be calibrated and stacked together. Frames are 16-bit unsigned integers
+    with headers like the ones written by the acquisition software.
+    """
+
+    def __init__(self, shape=(1024, 1024), seed=0):
+        """Initialize the SyntheticCamera instance.
+
+        Arguments
+        ---------
+        shape: tuple of int - Default (1024, 1024)
+        The (rows, columns) of the frames.
+
+        seed: int - Default 0
+        Seed of the random number generator.
+        """
+        self.shape = tuple(shape)
+        self.rng = np.random.default_rng(seed)
+        self.start_time = datetime.datetime(2025, 1, 1, 20, 0, 0)
+        self.num_frames = 0
+
+        self.bias = BIAS_LEVEL + self.rng.normal(0, BIAS_PATTERN, self.shape)
+        self.dark_current = DARK_CURRENT * self.rng.uniform(0.5, 1.5, self.shape)
+        hot_pixels = self.rng.random(self.shape) < HOT_PIXEL_FRACTION
+        self.dark_current[hot_pixels] *= 100
+
+        rows, cols = np.indices(self.shape, dtype=float)
+        radius2 = (
+            ((rows - self.shape[0] / 2) / (self.shape[0] / 2))**2 +
+            ((cols - self.shape[1] / 2) / (self.shape[1] / 2))**2) / 2
+        self.flat = (1 - VIGNETTING * radius2) * self.rng.normal(1, 0.01, self.shape)
+
+        num_stars = max(int(STAR_DENSITY * self.shape[0] * self.shape[1] / 1e6), 1)
+        self.star_rows = self.rng.uniform(0, self.shape[0], num_stars)
+        self.star_cols = self.rng.uniform(0, self.shape[1], num_stars)
+        # a power law: many faint stars and a few bright ones
+        self.star_fluxes = MAX_STAR_FLUX * self.rng.pareto(1.5, num_stars) / 10
+
+    def bias_frame(self):
+        """Take a bias frame.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data.
+
+        header: astropy.io.fits.Header
+        The header.
+        """
+        return self._read_out(np.zeros(self.shape), "Bias Frame", 0.0)
+
+    def dark_frame(self, exposure_time):
+        """Take a dark frame.
+
+        Arguments
+        ---------
+        exposure_time: float
+        The exposure time, in seconds.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data.
+
+        header: astropy.io.fits.Header
+        The header.
+        """
+        return self._read_out(np.zeros(self.shape), "Dark Frame", exposure_time)
+
+    def flat_frame(self, filter_name, exposure_time=1.0):
+        """Take a flat frame.
+
+        Arguments
+        ---------
+        filter_name: str
+        The filter.
+
+        exposure_time: float - Default 1.0
+        The exposure time, in seconds.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data.
+
+        header: astropy.io.fits.Header
+        The header.
+        """
+        return self._read_out(
+            FLAT_LEVEL * self.flat, "Flat", exposure_time, filter_name=filter_name)
+
+    def light_frame(self, filter_name, exposure_time, target="Synthetic Field"):
+        """Take a light frame of the star field, with a random dither.
+
+        Arguments
+        ---------
+        filter_name: str
+        The filter.
+
+        exposure_time: float
+        The exposure time, in seconds.
+
+        target: str - Default "Synthetic Field"
+        The name of the target.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data.
+
+        header: astropy.io.fits.Header
+        The header.
+        """
+        signal = np.full(self.shape, SKY_LEVEL * exposure_time)
+        dither_row, dither_col = self.rng.uniform(-MAX_DITHER, MAX_DITHER, 2)
+        half_size = int(np.ceil(4 * STAR_SIGMA))
+        offsets = np.arange(-half_size, half_size + 1)
+        for row, col, flux in zip(
+                self.star_rows + dither_row, self.star_cols + dither_col, self.star_fluxes):
+            stamp_rows = int(row) + offsets
+            stamp_cols = int(col) + offsets
+            valid_rows = (stamp_rows >= 0) & (stamp_rows < self.shape[0])
+            valid_cols = (stamp_cols >= 0) & (stamp_cols < self.shape[1])
+            if not valid_rows.any() or not valid_cols.any():
+                continue
+            profile_rows = np.exp(-0.5 * ((stamp_rows[valid_rows] - row) / STAR_SIGMA)**2)
+            profile_cols = np.exp(-0.5 * ((stamp_cols[valid_cols] - col) / STAR_SIGMA)**2)
+            stamp = np.outer(profile_rows, profile_cols)
+            signal[np.ix_(stamp_rows[valid_rows], stamp_cols[valid_cols])] += (
+                flux * exposure_time * stamp / (2 * np.pi * STAR_SIGMA**2))
+
+        return self._read_out(
+            signal * self.flat, "Light Frame", exposure_time, filter_name=filter_name,
+            target=target)
+
+    def _read_out(self, signal, image_type, exposure_time, filter_name=None, target=None):
+        """Add the bias, the dark current and the noise, and build the header.
+
+        Arguments
+        ---------
+        signal: np.ndarray
+        The light reaching each pixel during the exposure, in ADU.
+
+        image_type: str
+        The IMAGETYP of the frame.
+
+        exposure_time: float
+        The exposure time, in seconds.
+
+        filter_name: str or None - Default None
+        The filter, if any.
+
+        target: str or None - Default None
+        The name of the target, if any.
+
+        Returns
+        -------
+        data: np.ndarray
+        The pixel data.
+
+        header: astropy.io.fits.Header
+        The header.
+        """
+        signal = signal + self.dark_current * exposure_time
+        # photon noise, approximated as Gaussian, and read noise
+        noise = np.sqrt(np.maximum(signal, 0) + READ_NOISE**2)
+        data = self.bias + signal + noise * self.rng.standard_normal(self.shape)
+        data = np.clip(np.round(data), 0, SATURATION).astype(np.uint16)
+
+        date = self.start_time + datetime.timedelta(minutes=self.num_frames)
+        self.num_frames += 1
+        header = fits.Header()
+        header["IMAGETYP"] = image_type
+        header["EXPTIME"] = (float(exposure_time), "Exposure time in seconds")
+        header["EXPOSURE"] = (float(exposure_time), "Exposure time in seconds")
+        header["DATE-OBS"] = date.isoformat()
+        header["CCD-TEMP"] = (-20.0 + self.rng.normal(0, 0.1), "CCD temperature in C")
+        header["SET-TEMP"] = (-20.0, "CCD temperature setpoint in C")
+        header["XBINNING"] = 1
+        header["YBINNING"] = 1
+        header["XPIXSZ"] = (5.4, "Pixel width in microns")
+        header["YPIXSZ"] = (5.4, "Pixel height in microns")
+        header["INSTRUME"] = "Synthetic CCD"
+        header["TELESCOP"] = "Synthetic Telescope"
+        if filter_name is not None:
+            header["FILTER"] = filter_name
+        if target is not None:
+            header["OBJECT"] = target
+        return data, header
+
+def write_frame(filename, data, header):
+    """Write a synthetic frame to a FITS file.
+
+    Arguments
+    ---------
+    filename: str
+    The path to the FITS file.
+
+    data: np.ndarray
+    The pixel data. 16-bit unsigned integers are written with BZERO = 32768,
+    as cameras do.
+
+    header: astropy.io.fits.Header
+    The header.
+    """
+    fits.PrimaryHDU(data=data, header=header).writeto(filename, overwrite=True)
+
+def write_synthetic_night(folder, shape=(1024, 1024), num_biases=5, num_darks=5,
+                          num_flats=5, num_lights=5, exposure_time=60.0,
+                          filters=("R", "G", "B"), seed=0):
+    """Write the frames of a synthetic night.
+
+    Arguments
+    ---------
+    folder: str
+    Folder where the frames are written. It is created if needed.
+
+    shape: tuple of int - Default (1024, 1024)
+    The (rows, columns) of the frames.
+
+    num_biases: int - Default 5
+    Number of bias frames.
+
+    num_darks: int - Default 5
+    Number of dark frames, with the exposure time of the light frames.
+
+    num_flats: int - Default 5
+    Number of flat frames per filter.
+
+    num_lights: int - Default 5
+    Number of light frames per filter.
+
+    exposure_time: float - Default 60.0
+    Exposure time of the light frames, in seconds.
+
+    filters: tuple of str - Default ("R", "G", "B")
+    The filters.
+
+    seed: int - Default 0
+    Seed of the random number generator.
+
+    Returns
+    -------
+    filenames: dict
+    Lists of file names, with the image type as key ("Bias Frame",
+    "Dark Frame", "Flat" and "Light Frame").
+    """
+    os.makedirs(folder, exist_ok=True)
+    camera = SyntheticCamera(shape, seed=seed)
+    filenames = {"Bias Frame": [], "Dark Frame": [], "Flat": [], "Light Frame": []}
+
+    def write(name, frame):
+        filename = os.path.join(folder, name)
+        write_frame(filename, *frame)
+        filenames[frame[1]["IMAGETYP"]].append(filename)
+
+    for index in range(num_biases):
+        write(f"bias_{index:03d}.fits", camera.bias_frame())
+    for index in range(num_darks):
+        write(f"dark_{exposure_time}s_{index:03d}.fits", camera.dark_frame(exposure_time))
+    for filter_name in filters:
+        for index in range(num_flats):
+            write(f"flat_{filter_name}_{index:03d}.fits", camera.flat_frame(filter_name))
+        for index in range(num_lights):
+            write(
+                f"light_{filter_name}_{index:03d}.fits",
+                camera.light_frame(filter_name, exposure_time))
+
+    return filenames
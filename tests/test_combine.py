@@ -0,0 +1,141 @@
+"""Tests of the strip-based combination of exposures against full-stack references."""
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from finestres_al_cel_reduction.combine import (
+    DEFAULT_MEMORY_BUDGET, MINMAX_NUM_HIGH, MINMAX_NUM_LOW, SIGMA_CLIP_MAX_ITERS,
+    SIGMA_CLIP_SIGMA, VALID_AVERAGE_METHODS, combine_exposures,
+)
+from finestres_al_cel_reduction.fits_file import FitsFile
+
+# Exposures combined. The number of rows is odd and not a multiple of the
+# strip sizes, so the last strip is shorter than the others. A single value
+# can only be further than SIGMA_CLIP_SIGMA standard deviations from the
+# mean with more than 10 exposures
+SHAPE = (37, 23)
+NUM_EXPOSURES = 25
+
+# Memory budgets: a single row per strip, a few rows per strip and the
+# whole exposure in one strip
+MEMORY_BUDGETS = [1, 50_000, DEFAULT_MEMORY_BUDGET]
+
+# Warnings of the pixels with no valid values
+EMPTY_SLICE_WARNINGS = "ignore:.*slice:RuntimeWarning"
+
+# Tolerance of the rejection methods, whose sums are not done in the same
+# order as in the references
+RTOL = 1e-12
+
+@pytest.fixture(name="stack", scope="module")
+def fixture_stack():
+    """Pixel data of the exposures, with outliers and missing values."""
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000.0, 10.0, (NUM_EXPOSURES,) + SHAPE)
+    # cosmic rays and dead pixels
+    stack[rng.integers(0, NUM_EXPOSURES, 100), rng.integers(0, SHAPE[0], 100),
+          rng.integers(0, SHAPE[1], 100)] = 60000.0
+    stack[rng.integers(0, NUM_EXPOSURES, 20), rng.integers(0, SHAPE[0], 20),
+          rng.integers(0, SHAPE[1], 20)] = 0.0
+    # a pixel whose second outlier is only rejected in the second iteration
+    stack[:, 1, 1] = 1000.0 + rng.normal(0.0, 1.0, NUM_EXPOSURES)
+    stack[:2, 1, 1] = [60000.0, 1010.0]
+    # pixels with no, one and two valid values, and a few scattered NaN
+    stack[:, 0, 0] = np.nan
+    stack[1:, 0, 1] = np.nan
+    stack[2:, 0, 2] = np.nan
+    stack[rng.integers(0, NUM_EXPOSURES, 30), rng.integers(1, SHAPE[0], 30),
+          rng.integers(0, SHAPE[1], 30)] = np.nan
+    return stack
+
+@pytest.fixture(name="exposures", scope="module")
+def fixture_exposures(tmp_path_factory, stack):
+    """Header-only, memory-mapped exposures, so strips are read from disk."""
+    folder = tmp_path_factory.mktemp("exposures")
+    exposures = []
+    for index, data in enumerate(stack):
+        filename = os.path.join(str(folder), f"light_{index}.fits")
+        fits.PrimaryHDU(data).writeto(filename)
+        exposures.append(FitsFile(filename, header_only=True, memmap=True))
+    return exposures
+
+def reference_sigma_clipped_mean(stack):
+    """Sigma-clipped mean of each pixel, computed with masked arrays.
+
+    Arguments
+    ---------
+    stack: np.ndarray
+    The exposures along the first axis.
+
+    Returns
+    -------
+    combined: np.ndarray
+    The combined data.
+    """
+    values = np.ma.masked_invalid(stack)
+    for _ in range(SIGMA_CLIP_MAX_ITERS):
+        reject = np.abs(values - values.mean(axis=0)) > SIGMA_CLIP_SIGMA * values.std(axis=0)
+        if not reject.filled(False).any():
+            break
+        values = np.ma.masked_where(reject.filled(False), values)
+    return values.mean(axis=0).filled(np.nan)
+
+def reference_minmax_rejected_mean(stack):
+    """Mean of each pixel after dropping its lowest and highest valid values.
+
+    Arguments
+    ---------
+    stack: np.ndarray
+    The exposures along the first axis.
+
+    Returns
+    -------
+    combined: np.ndarray
+    The combined data.
+    """
+    # NaN values are sorted last
+    values = np.sort(stack, axis=0)
+    count = np.sum(np.isfinite(stack), axis=0)
+    combined = np.full(stack.shape[1:], np.nan)
+    for index in np.ndindex(combined.shape):
+        kept = values[(slice(MINMAX_NUM_LOW, count[index] - MINMAX_NUM_HIGH),) + index]
+        if len(kept) > 0:
+            combined[index] = np.mean(kept)
+    return combined
+
+@pytest.mark.filterwarnings(EMPTY_SLICE_WARNINGS)
+@pytest.mark.parametrize("memory_budget", MEMORY_BUDGETS)
+@pytest.mark.parametrize("average", ["mean", "median"])
+def test_mean_median_match_numpy(exposures, stack, average, memory_budget):
+    """Mean and median combined in strips are exactly np.nanmean and np.nanmedian."""
+    reference = {"mean": np.nanmean, "median": np.nanmedian}[average]
+    expected = reference(stack, axis=0)
+    data = combine_exposures(exposures, average=average, memory_budget=memory_budget)
+    np.testing.assert_array_equal(data, expected)
+
+@pytest.mark.parametrize("memory_budget", MEMORY_BUDGETS)
+def test_sigma_clip_matches_reference(exposures, stack, memory_budget):
+    """The in-place sigma clipping agrees with a masked array implementation."""
+    expected = reference_sigma_clipped_mean(stack)
+    data = combine_exposures(exposures, average="sigma_clip", memory_budget=memory_budget)
+    np.testing.assert_allclose(data, expected, rtol=RTOL)
+
+@pytest.mark.parametrize("memory_budget", MEMORY_BUDGETS)
+def test_minmax_matches_reference(exposures, stack, memory_budget):
+    """The in-place min/max rejection agrees with a sort-based implementation."""
+    expected = reference_minmax_rejected_mean(stack)
+    data = combine_exposures(exposures, average="minmax", memory_budget=memory_budget)
+    np.testing.assert_allclose(data, expected, rtol=RTOL)
+
+@pytest.mark.filterwarnings(EMPTY_SLICE_WARNINGS)
+@pytest.mark.parametrize("memory_budget", MEMORY_BUDGETS[1:])
+@pytest.mark.parametrize("average", VALID_AVERAGE_METHODS)
+def test_parallel_matches_serial(exposures, average, memory_budget):
+    """Combining in a process pool gives exactly the serial result."""
+    serial = combine_exposures(
+        exposures, average=average, memory_budget=memory_budget, workers=1)
+    parallel = combine_exposures(
+        exposures, average=average, memory_budget=memory_budget, workers=2)
+    np.testing.assert_array_equal(parallel, serial)
@@ -0,0 +1,107 @@
+"""Tests of the reduction in single precision against double precision."""
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from finestres_al_cel_reduction.batch_calibration import calibrate_frames
+from finestres_al_cel_reduction.combine import VALID_AVERAGE_METHODS
+from finestres_al_cel_reduction.fits_file import FitsFile
+from finestres_al_cel_reduction.master_fits_file import MasterFitsFile
+from finestres_al_cel_reduction.precision import set_working_precision
+from finestres_al_cel_reduction.synthetic import write_synthetic_night
+
+# Frames of the synthetic night. They are small so the test is fast, but
+# large enough to have stars and hot pixels
+SHAPE = (64, 48)
+EXPOSURE_TIME = 60.0
+
+# Tolerance of the float32 results. Calibrated pixels are a few hundred ADU,
+# computed from raw values around 1000 ADU, and float32 keeps about 7
+# significant digits, so they agree to about 1e-4 ADU
+RTOL = 1e-5
+ATOL = 1e-3
+
+# BITPIX of the saved files in each precision
+BITPIX = {"float32": -32, "float64": -64}
+
+@pytest.fixture(name="raw_folder", scope="module")
+def fixture_raw_folder(tmp_path_factory):
+    """Write a synthetic night, shared by all the tests."""
+    folder = str(tmp_path_factory.mktemp("raw"))
+    write_synthetic_night(
+        folder, shape=SHAPE, num_biases=0, num_darks=5, num_flats=5, num_lights=7,
+        exposure_time=EXPOSURE_TIME, filters=("R",))
+    return folder
+
+@pytest.fixture(name="restore_precision", autouse=True)
+def fixture_restore_precision():
+    """Restore the default precision after each test."""
+    yield
+    set_working_precision("float64")
+
+def reduce_night(raw_folder, output_folder, precision, average):
+    """Calibrate, combine, save and reload the lights of the synthetic night.
+
+    Arguments
+    ---------
+    raw_folder: str
+    Folder with the synthetic night.
+
+    output_folder: str
+    Folder where the stack is saved.
+
+    precision: str
+    The working precision.
+
+    average: str
+    The method used to combine the lights.
+
+    Returns
+    -------
+    data: np.ndarray
+    The reloaded stack.
+
+    bitpix: int
+    The BITPIX of the saved stack.
+    """
+    set_working_precision(precision)
+    filenames = sorted(os.listdir(raw_folder))
+
+    def load(prefix):
+        return [
+            FitsFile(os.path.join(raw_folder, filename))
+            for filename in filenames if filename.startswith(prefix)]
+
+    master_dark = MasterFitsFile(
+        os.path.join(output_folder, "master_dark.fits"), load("dark"), average="median")
+    master_flat = MasterFitsFile(
+        os.path.join(output_folder, "master_flat.fits"), load("flat"), average="median")
+    master_flat.normalize()
+
+    lights = load("light")
+    calibrate_frames(lights, {EXPOSURE_TIME: master_dark}, {"R": master_flat})
+    # the stack is combined with combine_exposures, see MasterFitsFile
+    stack = MasterFitsFile(
+        os.path.join(output_folder, f"stack_{average}.fits"), lights, average=average)
+    stack.save()
+
+    with fits.open(stack.filename) as hdul:
+        bitpix = hdul[0].header["BITPIX"]
+    return FitsFile(stack.filename).data, bitpix
+
+@pytest.mark.parametrize("average", VALID_AVERAGE_METHODS)
+def test_float32_matches_float64(raw_folder, tmp_path, average):
+    """The float32 reduction agrees with the float64 one within RTOL and ATOL."""
+    results = {}
+    for precision in ("float64", "float32"):
+        output_folder = tmp_path / precision
+        output_folder.mkdir()
+        data, bitpix = reduce_night(raw_folder, str(output_folder), precision, average)
+        assert bitpix == BITPIX[precision]
+        assert data.dtype == np.dtype(precision)
+        results[precision] = data
+
+    np.testing.assert_allclose(
+        results["float32"], results["float64"], rtol=RTOL, atol=ATOL)